@@ -0,0 +1,97 @@
+"""
+A fake SES email backend, for testing without network access.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import threading
+import time
+from uuid import uuid4
+
+from boto.ses.exceptions import SESAddressBlacklistedError, SESMaxSendingRateExceededError
+from django_ses import SESBackend
+
+
+class FakeSES(object):
+
+    """An in-process stand-in for the SES API, with the part of the interface
+    of boto's SESConnection that SESBackend uses, which accepts messages into
+    `sent` instead of delivering them.
+
+    It enforces `max_send_rate` (messages per second, over a one second
+    window) the way SES does, and rejects messages to any of the addresses in
+    `rejected` as blacklisted. `calls` counts the API calls made.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, max_send_rate=14, rejected=()):
+        """
+        Forgets all sent messages, and sets new limits.
+        """
+        with self._lock:
+            self.max_send_rate = max_send_rate
+            self.rejected = set(rejected)
+            self.sent = []
+            self.calls = 0
+            self._send_times = []
+
+    def _accept(self, count):
+        # called with the lock held
+        self.calls += 1
+        now = time.time()
+        self._send_times = [t for t in self._send_times if t > now - 1]
+        if len(self._send_times) + count > self.max_send_rate:
+            raise SESMaxSendingRateExceededError(400, 'Throttling', 'Maximum sending rate exceeded.')
+        self._send_times.extend([now] * count)
+
+    def _send(self, raw_message, source, destinations):
+        # called with the lock held
+        if self.rejected.intersection(destinations):
+            raise SESAddressBlacklistedError(400, 'Address blacklisted.', 'Address blacklisted.')
+        message_id = uuid4().hex
+        self.sent.append({
+            'message_id': message_id,
+            'source': source,
+            'destinations': list(destinations),
+            'raw_message': raw_message,
+        })
+        return message_id
+
+    def get_send_quota(self):
+        return {'GetSendQuotaResponse': {'GetSendQuotaResult': {
+            'MaxSendRate': str(self.max_send_rate),
+            'SentLast24Hours': str(len(self.sent)),
+        }}}
+
+    def send_raw_email(self, raw_message, source=None, destinations=None):
+        with self._lock:
+            self._accept(1)
+            message_id = self._send(raw_message, source, destinations)
+        return {'SendRawEmailResponse': {
+            'SendRawEmailResult': {'MessageId': message_id},
+            'ResponseMetadata': {'RequestId': uuid4().hex},
+        }}
+
+    def close(self):
+        pass
+
+
+fake_ses = FakeSES()
+
+
+class FakeSESBackend(SESBackend):
+
+    """An SESBackend which sends to `fake_ses` instead of SES, for testing
+    throughput and error handling without network access.
+    """
+
+    def open(self):
+        if self.connection:
+            return False
+        self.connection = fake_ses
+        return True
+
+    def get_rate_limit(self):
+        return float(fake_ses.max_send_rate)
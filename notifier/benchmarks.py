@@ -0,0 +1,437 @@
+"""
+Micro-benchmarks for the code paths that run once per digest recipient.
+
+These are not part of the test suite; run them with
+``python manage.py benchmark``.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import base64
+from datetime import datetime, timedelta
+import timeit
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+import logging
+
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.backends import locmem
+from django.utils.html import strip_tags
+from kombu import compression, serialization
+from kombu.exceptions import SerializerNotInstalled
+import six
+
+from notifier.connection_wrapper import BackendWrapper
+from notifier.digest import (
+    Digest, DigestCourse, DigestThread, DigestItem, render_digest, _make_text_list, _strip_tags, _trunc,
+    _trunc_code_points, MAX_COURSE_THREADS, MAX_THREAD_ITEMS, THREAD_ITEM_MAXLEN
+)
+from notifier.message import DigestMessageBuilder
+from notifier.pull import process_cs_response, _build_digest_course
+from notifier.user import DIGEST_NOTIFICATION_PREFERENCE_KEY, LANGUAGE_PREFERENCE_KEY, compact_users
+from six.moves import range
+
+
+def make_user(n):
+    """
+    Make a user dict shaped like the ones returned by the user service.
+    """
+    return {
+        'id': str(n),
+        'name': 'user{}'.format(n),
+        'email': 'user{}@example.org'.format(n),
+        'preferences': {
+            DIGEST_NOTIFICATION_PREFERENCE_KEY: 'token{}'.format(n),
+        },
+        'course_info': {},
+    }
+
+
+def make_subscriber(n, num_courses=10):
+    """
+    Make a user dict like make_user, enrolled in `num_courses` of 50 courses,
+    in a cohort in most of them.
+    """
+    user = make_user(n)
+    user['preferences'][LANGUAGE_PREFERENCE_KEY] = 'en'
+    first = n * 7 % 40
+    user['course_info'] = dict(
+        ('course-v1:OrgX+Course{}+2014_T{}'.format(c, c % 3 + 1),
+         {'see_all_cohorts': c % 4 == 0, 'cohort_id': None if c % 4 == 0 else c % 5})
+        for c in range(first, first + num_courses)
+    )
+    return user
+
+
+def make_digest(num_courses=2, num_threads=10, num_items=5, markup=True):
+    """
+    Make a synthetic Digest with the given number of courses, threads per
+    course and items per thread.  If `markup` is False, thread titles and item
+    bodies are plain text.
+    """
+    title = '<p>Thread {0} about <b>something</b> interesting</p>'
+    body = '<p>Reply number {0} with a few words of <i>body</i> text.</p>' * 4
+    if not markup:
+        title, body = strip_tags(title), strip_tags(body)
+    now = datetime(2013, 1, 1)
+    courses = []
+    for c in range(num_courses):
+        course_id = 'org{0}/course{0}/run'.format(c)
+        threads = [
+            DigestThread(
+                't{}'.format(t),
+                course_id,
+                'commentable{}'.format(t),
+                title.format(t),
+                [
+                    DigestItem(body.format(i), 'author{}'.format(i), now - timedelta(minutes=i))
+                    for i in range(num_items)
+                ]
+            )
+            for t in range(num_threads)
+        ]
+        courses.append(DigestCourse(course_id, threads))
+    return Digest(courses)
+
+
+def make_cs_course(num_threads=10, num_items=5, num_cohorts=0):
+    """
+    Make the comments service's content for one course, with the given number
+    of threads and items per thread.  If `num_cohorts` is given, threads are
+    spread over that many cohorts and threads without one.
+    """
+    threads = {}
+    for t in range(num_threads):
+        thread = {
+            'commentable_id': 'commentable{}'.format(t % 5),
+            'title': '<p>Thread {0} about <b>something</b> interesting</p>'.format(t),
+            'content': [
+                {
+                    'body': '<p>Reply number {0} with a few words of <i>body</i> text.</p>'.format(i) * 4,
+                    'username': 'author{}'.format(i),
+                    'updated_at': '2013-06-23T14:55:{:02d}-04:00'.format(i % 60),
+                }
+                for i in range(num_items)
+            ],
+        }
+        if num_cohorts:
+            thread['group_id'] = t % (num_cohorts + 1) or None
+        threads['thread{}'.format(t)] = thread
+    return threads
+
+
+def make_cs_payload(num_users, num_courses=2, num_threads=10, num_items=5):
+    """
+    Make a comments service notifications response for `num_users` users, and
+    the user service's info for them, for `process_cs_response`.
+    """
+    payload = {}
+    user_info = {}
+    for n in range(num_users):
+        course_ids = ['org{0}/course{0}/run'.format(c) for c in range(num_courses)]
+        payload[str(n)] = dict((course_id, make_cs_course(num_threads, num_items)) for course_id in course_ids)
+        user_info[str(n)] = {
+            'course_info': dict(
+                (course_id, {'see_all_cohorts': True, 'cohort_id': None}) for course_id in course_ids
+            ),
+        }
+    return payload, user_info
+
+
+def _timing(label, func, number):
+    """
+    Return a benchmark result giving the mean time taken by one call to `func`.
+    """
+    return (label, timeit.timeit(func, number=number) / number * 1e6, 'us/call')
+
+
+def bench_process_cs_response(number=200):
+    """
+    Time `process_cs_response` for a comments service response for one user,
+    for a batch of users and for a batch of users with large digests.
+    """
+    # (label, make_cs_payload arguments, fraction of `number` to time)
+    sizes = (
+        ('1 user', dict(num_users=1, num_courses=1, num_threads=2, num_items=2), 1),
+        ('5 users', dict(num_users=5), 10),
+        ('5 users, large', dict(num_users=5, num_courses=3, num_threads=MAX_COURSE_THREADS, num_items=10), 100),
+    )
+    results = []
+    for label, kwargs, divisor in sizes:
+        payload, user_info = make_cs_payload(**kwargs)
+        results.append(_timing(
+            'process_cs_response ({})'.format(label),
+            lambda: list(process_cs_response(payload, user_info)),
+            max(number // divisor, 1)
+        ))
+    return results
+
+
+def bench_build_digest_course(number=200):
+    """
+    Time `_build_digest_course` for a small and a large course, with threads
+    spread over cohorts of which the user sees one.
+    """
+    user_course_info = {'see_all_cohorts': False, 'cohort_id': 1}
+    results = []
+    for num_threads in (5, 50):
+        course = make_cs_course(num_threads=num_threads, num_cohorts=3)
+        results.append(_timing(
+            '_build_digest_course ({} threads)'.format(num_threads),
+            lambda: _build_digest_course('org/course/run', course, user_course_info),
+            max(number // num_threads, 1)
+        ))
+    return results
+
+
+def bench_make_text_list(number=200):
+    """
+    Time `_make_text_list` for lists of one, three and ten items.
+    """
+    return [
+        _timing(
+            '_make_text_list ({} items)'.format(size),
+            lambda: _make_text_list(['course {}'.format(i) for i in range(size)]),
+            number * 10
+        )
+        for size in (1, 3, 10)
+    ]
+
+
+def bench_send_messages(number=200):
+    """
+    Time `BackendWrapper.send_messages` sending a batch of digest emails (as
+    many as there are users in a task) to the locmem backend.
+    """
+    text, html = render_digest(make_user(1), make_digest(), 'title', 'description')
+    builder = DigestMessageBuilder('Daily Discussion Digest', 'notifications@example.org')
+    batch_size = 5
+
+    def send():
+        msgs = [builder.build(['user{}@example.org'.format(n)], text, html) for n in range(batch_size)]
+        BackendWrapper(locmem.EmailBackend()).send_messages(msgs)
+        del locmem.mail.outbox[:]
+
+    # leave the cost of writing the log lines out
+    logging.disable(logging.INFO)
+    try:
+        return [_timing('send_messages ({} messages)'.format(batch_size), send, max(number // 10, 1))]
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def _broker_size(users, serializer, compress_with=None):
+    """
+    Returns the size of the body of a generate_and_send_digests message for
+    `users`, as stored by the database broker (base64 encoded).
+    """
+    body = {
+        'task': 'notifier.tasks.generate_and_send_digests',
+        'id': '2f5d6a2e-8b9c-4c36-9f3e-51f0d9b5d2a1',
+        'args': [users, '2013-01-01T00:00:00', '2013-01-02T00:00:00'],
+        'kwargs': {'language': 'en', 'trace_context': {'trace_id': '0' * 32, 'span_id': '0' * 16}},
+        'retries': 0, 'eta': None, 'expires': None, 'utc': True, 'callbacks': None, 'errbacks': None,
+        'timelimit': [None, None], 'taskset': None, 'chord': None,
+    }
+    _, encoding, data = serialization.dumps(body, serializer=serializer)
+    if isinstance(data, six.text_type):
+        data = data.encode(encoding)
+    if compress_with:
+        data, _ = compression.compress(data, compress_with)
+    return len(base64.b64encode(data))
+
+
+def bench_task_payload(number=None):
+    """
+    Measure the broker bytes of a batch of users sent to
+    generate_and_send_digests as whole user dicts and in compact form, with
+    various serializers (msgpack only if it is installed).
+    """
+    variants = [
+        ('full', 'pickle', None),
+        ('full', 'json', None),
+        ('compact', 'pickle', None),
+        ('compact', 'json', None),
+        ('compact', 'json', 'zlib'),
+        ('compact', 'msgpack', 'zlib'),
+    ]
+    results = []
+    for batch_size in (5, 40):
+        users = [make_subscriber(n) for n in range(batch_size)]
+        payloads = {'full': users, 'compact': compact_users(users)}
+        for form, serializer, compress_with in variants:
+            try:
+                size = _broker_size(payloads[form], serializer, compress_with)
+            except SerializerNotInstalled:
+                continue
+            results.append((
+                'task payload ({} users, {}, {}{})'.format(
+                    batch_size, form, serializer, ' + ' + compress_with if compress_with else ''),
+                size, 'bytes'
+            ))
+    return results
+
+
+def bench_render_digest(number=200):
+    """
+    Time `render_digest` per user, and with every user in the batch sharing
+    one thread-fragment cache or one merge cache of whole renderings.
+    """
+    digest = make_digest()
+    user = make_user(1)
+
+    def render():
+        return render_digest(user, digest, 'title', 'description')
+
+    render()  # warm up translations, template loaders, etc.
+    plain = _timing('render_digest', render, number)
+    fragment_cache = {}
+    shared = _timing(
+        'render_digest (shared thread fragments)',
+        lambda: render_digest(user, digest, 'title', 'description', fragment_cache=fragment_cache),
+        number
+    )
+    merge_cache = {}
+    merged = _timing(
+        'render_digest (merged identical digests)',
+        lambda: render_digest(user, digest, 'title', 'description', merge_cache=merge_cache),
+        number
+    )
+    return [plain, shared, merged]
+
+
+def bench_trunc(number=200):
+    """
+    Time `_trunc` against the code point based implementation used on narrow
+    Python builds, for a short string and for one which needs truncating.
+    """
+    short_text = 'A short reply \U0001d54b\U0001d559.'
+    long_text = 'A long reply, with \U0001d54b\U0001d559 non-BMP characters in it. ' * 20
+    results = []
+    for label, s in (('short', short_text), ('long', long_text)):
+        for name, func in (('_trunc', _trunc), ('_trunc_code_points', _trunc_code_points)):
+            results.append(_timing(
+                '{} ({})'.format(name, label),
+                lambda: func(s, THREAD_ITEM_MAXLEN),
+                number * 50
+            ))
+    return results
+
+
+def bench_strip_tags(number=200):
+    """
+    Time `_strip_tags` against django's `strip_tags`, for a short post body and
+    for a long one of which only the start is kept.
+    """
+    short_body = '<p>Thanks, that <b>fixed</b> it!</p>'
+    long_body = '<p>A paragraph of a long answer, with <a href="#">a link</a> &amp; some <em>emphasis</em>.</p>\n' * 50
+    results = []
+    for label, body in (('short', short_body), ('long', long_body)):
+        results.append(_timing('strip_tags ({})'.format(label), lambda: strip_tags(body), number))
+        results.append(_timing(
+            '_strip_tags ({})'.format(label),
+            lambda: _strip_tags(body, THREAD_ITEM_MAXLEN),
+            number
+        ))
+    return results
+
+
+def bench_digest_memory(number=1000):
+    """
+    Measure the memory taken up by a batch of `number` large digests, and the
+    time taken to build them.
+    """
+    if tracemalloc is None:
+        return []
+
+    def make_large_digest():
+        return make_digest(num_courses=3, num_threads=MAX_COURSE_THREADS, num_items=MAX_THREAD_ITEMS, markup=False)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        digests = [make_large_digest() for _ in range(number)]
+        size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del digests
+    return [
+        ('large digests ({} of them)'.format(number), size / 1024.0 / 1024.0, 'MiB'),
+        ('large digest', size / 1024.0 / number, 'KiB each'),
+        _timing('make large digest', make_large_digest, max(number // 100, 1)),
+    ]
+
+
+def bench_build_message(number=200):
+    """
+    Time building and serializing a digest email with `EmailMultiAlternatives`
+    and with `DigestMessageBuilder`, and measure the memory allocated while
+    doing so.
+    """
+    text, html = render_digest(make_user(1), make_digest(), 'title', 'description')
+    builder = DigestMessageBuilder('Daily Discussion Digest', 'notifications@example.org')
+
+    def build_default():
+        msg = EmailMultiAlternatives('Daily Discussion Digest', text, 'notifications@example.org', ['user1@example.org'])
+        msg.attach_alternative(html, 'text/html')
+        return msg.message().as_bytes()
+
+    def build_skeleton():
+        return builder.build(['user1@example.org'], text, html).message().as_bytes()
+
+    results = []
+    for label, build in (('EmailMultiAlternatives', build_default), ('DigestMessageBuilder', build_skeleton)):
+        results.append(_timing('build message ({})'.format(label), build, number))
+        if tracemalloc is not None:
+            build()
+            tracemalloc.start()
+            try:
+                build()
+                allocated = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            results.append(('build message ({})'.format(label), allocated / 1024.0, 'KiB peak'))
+    return results
+
+
+BENCHMARKS = {
+    'build_digest_course': bench_build_digest_course,
+    'build_message': bench_build_message,
+    'digest_memory': bench_digest_memory,
+    'make_text_list': bench_make_text_list,
+    'process_cs_response': bench_process_cs_response,
+    'render_digest': bench_render_digest,
+    'send_messages': bench_send_messages,
+    'strip_tags': bench_strip_tags,
+    'task_payload': bench_task_payload,
+    'trunc': bench_trunc,
+}
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare benchmark results with baseline results (both lists of dicts with
+    "label", "value" and "unit" keys), for which lower values are better.
+
+    Returns a (label, value, baseline value, relative change, regressed) tuple
+    for each result that has a baseline with the same label and unit, where
+    `regressed` is whether the value is more than `threshold` (a fraction)
+    above the baseline.
+
+    >>> compare(
+    ...     [{'label': 'a', 'value': 1.5, 'unit': 'us'}, {'label': 'b', 'value': 1.0, 'unit': 'us'}],
+    ...     [{'label': 'a', 'value': 1.0, 'unit': 'us'}, {'label': 'b', 'value': 1.0, 'unit': 'ms'}],
+    ...     0.2)
+    [('a', 1.5, 1.0, 0.5, True)]
+    """
+    baseline = dict(((r['label'], r['unit']), r['value']) for r in baseline)
+    comparisons = []
+    for result in results:
+        base = baseline.get((result['label'], result['unit']))
+        if not base:
+            continue
+        change = (result['value'] - base) / base
+        comparisons.append((result['label'], result['value'], base, change, change > threshold))
+    return comparisons
@@ -1,11 +1,16 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import atexit
 import logging
+import random
+import threading
 import time
 
+from boto.ses.exceptions import SESMaxSendingRateExceededError
 from django.conf import settings
 from django.core.mail import get_connection as dj_get_connection
-import six
+
+from notifier import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -16,8 +21,9 @@ class BackendWrapper(object):
     for instrumentation and testing.
     """
 
-    def __init__(self, backend):
+    def __init__(self, backend, pool=None):
         self._backend = backend
+        self._pool = pool
         logger.info("initialized connection wrapper with email backend: %s", backend)
 
     def send_messages(self, email_messages):
@@ -27,22 +33,166 @@ class BackendWrapper(object):
             for message in email_messages:
                 message.to = [settings.EMAIL_REWRITE_RECIPIENT]
 
-        # send the messages
+        # send the messages, noting what the backend builds for each one
+        sends = [_instrument(msg) for msg in email_messages]
         t = time.time()
-        msg_count = self._backend.send_messages(email_messages)
+        try:
+            msg_count = self._send_with_backoff(email_messages)
+        finally:
+            for msg in email_messages:
+                del msg.message
         elapsed = time.time() - t
+        metrics.timing('email.send', elapsed)
+        metrics.incr('email.sent', msg_count)
         if msg_count > 0:
-            logger.info('sent %s messages, elapsed: %.3fs' % (msg_count, elapsed))
-            for msg in email_messages:
-                hdrs = dict((k, v) for k, v in six.iteritems(dict(msg.message()))
-                            if k.lower() not in ('date', 'from', 'subject', 'content-type', 'mime-version'))
-                logger.info("sent email: {}".format(repr(hdrs)))
+            logger.info('sent %s messages to %d recipients (%d bytes), elapsed: %.3fs',
+                        msg_count, sum(len(send['to']) for send in sends), sum(send['size'] for send in sends), elapsed)
+            for send in sends:
+                if random.random() < settings.EMAIL_LOG_SAMPLE_RATE:
+                    logger.info("sent email: %r", send)
         if msg_count != len(email_messages):
             logger.warn('send_messages() was called with %s messages but return value was %s',
-                len(email_messages), msg_count)
+                        len(email_messages), msg_count)
         return msg_count
 
+    def _concurrency(self):
+        # the extra connections are only worth opening when the pool keeps
+        # them for later batches; without it, each batch would set up
+        # EMAIL_SEND_CONCURRENCY - 1 new connections.
+        if self._pool is None:
+            return 1
+        return settings.EMAIL_SEND_CONCURRENCY
+
+    def _send(self, email_messages):
+        if self._concurrency() > 1 and len(email_messages) > 1:
+            return self._send_concurrently(email_messages)
+        return self._send_sequentially(email_messages)
+
+    def _send_with_backoff(self, email_messages):
+        """
+        Sends the messages. Whenever the provider reports that the maximum
+        send rate has been exceeded, the process's send rate is lowered, and
+        the messages which weren't sent are tried again after a jittered,
+        exponentially growing pause. The error is only raised if the next
+        attempt would start after EMAIL_THROTTLE_DEADLINE seconds.
+        """
+        deadline = time.time() + settings.EMAIL_THROTTLE_DEADLINE
+        delay = settings.EMAIL_THROTTLE_BACKOFF
+        msg_count = 0
+        while True:
+            try:
+                sent = self._send(email_messages)
+                _rate_limiter.record(sent)
+                return msg_count + sent
+            except SESMaxSendingRateExceededError:
+                pending = [msg for msg in email_messages if msg.extra_headers.get('status') != 200]
+                _rate_limiter.record(len(email_messages) - len(pending))
+                msg_count += len(email_messages) - len(pending)
+                email_messages = pending
+                pause = random.uniform(delay / 2.0, delay)
+                if time.time() + pause > deadline:
+                    raise
+                metrics.incr('email.throttled')
+                rate = _rate_limiter.slow_down()
+                logger.warn('sending throttled with %d messages left, retrying in %.1fs at %.2f messages/s',
+                            len(email_messages), pause, rate)
+                time.sleep(pause)
+                delay = min(delay * 2, settings.EMAIL_THROTTLE_MAX_BACKOFF)
+
+    def _open_backend(self):
+        if self._pool is not None:
+            return self._pool.acquire()
+        backend = dj_get_connection()
+        backend.open()
+        return backend
+
+    def _close_backend(self, backend):
+        if self._pool is not None:
+            self._pool.release(backend)
+        else:
+            _close_quietly(backend)
+
+    def _send_sequentially(self, email_messages):
+        """
+        Sends the messages one at a time over our own connection, opened for
+        the duration so that it isn't reconnected for each message, and paced
+        by the process-wide rate limit.
+
+        As with _send_concurrently, each message that is sent gets a 200
+        'status' extra header, whichever the backend, so that the caller can
+        tell which ones went out if one of them fails.
+        """
+        opened = self._backend.open()
+        sent = 0
+        try:
+            for msg in email_messages:
+                _rate_limiter.wait()
+                if self._backend.send_messages([msg]):
+                    msg.extra_headers['status'] = 200
+                    sent += 1
+        finally:
+            if opened:
+                _close_quietly(self._backend)
+        return sent
+
+    def _send_concurrently(self, email_messages):
+        """
+        Sends the messages one at a time, spread over up to
+        EMAIL_SEND_CONCURRENCY connections on separate threads (when the
+        connection pool is enabled), and paced by the process-wide rate limit.
+
+        Each message that is sent gets a 200 'status' extra header (as the
+        SES backend already does), so the caller can tell exactly which ones
+        went out. After the first failure no further messages are started,
+        and once all the threads are done the failure is re-raised.
+        """
+        num_threads = min(self._concurrency(), len(email_messages))
+        sent = [False] * len(email_messages)
+        errors = []
+
+        def send(backend, indices):
+            for i in indices:
+                if errors:
+                    return
+                _rate_limiter.wait()
+                msg = email_messages[i]
+                try:
+                    if backend.send_messages([msg]):
+                        sent[i] = True
+                        msg.extra_headers['status'] = 200
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        # our own connection, opened for the duration so that it isn't
+        # reconnected for each message, handles the first share of the work.
+        opened = self._backend.open()
+        backends = [self._backend]
+        threads = []
+        try:
+            for n in range(1, num_threads):
+                backends.append(self._open_backend())
+            for n, backend in enumerate(backends[1:], 1):
+                thread = threading.Thread(target=send, args=(backend, range(n, len(email_messages), num_threads)))
+                thread.start()
+                threads.append(thread)
+            send(self._backend, range(0, len(email_messages), num_threads))
+        finally:
+            for thread in threads:
+                thread.join()
+            for backend in backends[1:]:
+                self._close_backend(backend)
+            if opened:
+                _close_quietly(self._backend)
+        if errors:
+            raise errors[0]
+        return sum(sent)
+
     def close(self):
+        if self._pool is not None:
+            # hand the open connection back for the next task to use.
+            self._pool.release(self._backend)
+            return
         # never raise Exceptions on close().
         try:
             self._backend.close()
@@ -53,5 +203,188 @@ class BackendWrapper(object):
         return getattr(self._backend, a)
 
 
+def _instrument(msg):
+    """
+    Returns a dict with the recipients of an email message, which is filled
+    in with the Message-ID and encoded size of the message when the backend
+    builds it, so that it doesn't have to be built again just to log them.
+    """
+    send = {'to': msg.recipients(), 'message_id': None, 'size': 0}
+    build = msg.message
+
+    def message():
+        mime = build()
+        send['message_id'] = mime['Message-ID']
+        send['size'] = sum(len(part.get_payload()) for part in mime.walk() if not part.is_multipart())
+        return mime
+
+    msg.message = message
+    return send
+
+
+class RateLimiter(object):
+
+    """Spaces out calls to wait() across all the threads in the process so
+    that they happen no more than EMAIL_SEND_RATE times per second, or less
+    often for EMAIL_THROTTLE_COOLDOWN seconds after slow_down() was called.
+    """
+
+    # period (in seconds) over which the rate of recorded sends is measured
+    window = 10.0
+    # lowest rate (in messages per second) slow_down() goes down to
+    min_rate = 0.1
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._next = 0
+            self._sent = []
+            self._throttled_rate = None
+            self._throttled_at = 0
+
+    @property
+    def rate(self):
+        """
+        The current limit in messages per second, or 0 for no limit.
+        """
+        rate = settings.EMAIL_SEND_RATE
+        if self._throttled_rate and time.time() - self._throttled_at < settings.EMAIL_THROTTLE_COOLDOWN:
+            rate = min(rate or self._throttled_rate, self._throttled_rate)
+        return rate
+
+    def wait(self):
+        rate = self.rate
+        if not rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + 1.0 / rate
+        if start > now:
+            time.sleep(start - now)
+
+    def record(self, count):
+        """
+        Notes that `count` messages have just been sent.
+        """
+        with self._lock:
+            now = time.time()
+            self._sent = [t for t in self._sent if t > now - self.window] + [now] * count
+
+    def slow_down(self):
+        """
+        Lowers the limit to EMAIL_THROTTLE_RATE_FACTOR times the current one,
+        or the recent send rate if there is no limit, and returns it.
+        """
+        rate = self.rate
+        with self._lock:
+            now = time.time()
+            if not rate:
+                rate = len([t for t in self._sent if t > now - self.window]) / self.window
+            self._throttled_rate = max(rate * settings.EMAIL_THROTTLE_RATE_FACTOR, self.min_rate)
+            self._throttled_at = now
+            return self._throttled_rate
+
+
+_rate_limiter = RateLimiter()
+
+
+def _is_alive(backend):
+    """
+    Returns whether an email backend's connection is still usable.
+
+    SMTP connections are checked with a NOOP command; connections without
+    such a check (e.g. to the SES API) are assumed to be usable as long as
+    they are open.
+    """
+    if not hasattr(backend, 'connection'):
+        # e.g. the console and locmem backends, which hold no connection.
+        return True
+    if backend.connection is None:
+        return False
+    noop = getattr(backend.connection, 'noop', None)
+    if noop is None:
+        return True
+    try:
+        return noop()[0] == 250
+    except Exception as e:
+        logger.debug("email connection health check failed: %s", e)
+        return False
+
+
+def _close_quietly(backend):
+    try:
+        backend.close()
+    except Exception as e:
+        logger.debug("backend.close() failed: %s", e)
+
+
+class ConnectionPool(object):
+
+    """A per-process pool of open connections to the default email
+    backend, so that tasks run by the same worker can reuse an
+    authenticated connection instead of setting up a new one per task.
+    """
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def acquire(self):
+        """
+        Returns an open backend, reusing an idle one if it passes a health
+        check, or else opening a new one.
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                backend = self._idle.pop()
+            if _is_alive(backend):
+                self.reused += 1
+                logger.info('reusing pooled email connection (opened: %d, reused: %d)', self.opened, self.reused)
+                return backend
+            logger.info('discarding dead pooled email connection')
+            _close_quietly(backend)
+
+        backend = dj_get_connection()
+        # opening the connection up front keeps the backend from closing it
+        # again at the end of each send_messages() call.
+        backend.open()
+        self.opened += 1
+        logger.info('opened pooled email connection (opened: %d, reused: %d)', self.opened, self.reused)
+        return backend
+
+    def release(self, backend):
+        """
+        Returns a backend to the pool, or closes it if the pool is full.
+        """
+        with self._lock:
+            if len(self._idle) < settings.EMAIL_CONNECTION_POOL_SIZE:
+                self._idle.append(backend)
+                return
+        _close_quietly(backend)
+
+    def clear(self):
+        """
+        Closes all the idle connections in the pool.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for backend in idle:
+            _close_quietly(backend)
+
+
+_pool = ConnectionPool()
+atexit.register(_pool.clear)
+
+
 def get_connection(*a, **kw):
+    if settings.EMAIL_CONNECTION_POOL_SIZE and not a and not kw:
+        return BackendWrapper(_pool.acquire(), pool=_pool)
     return BackendWrapper(dj_get_connection(*a, **kw))
@@ -6,13 +6,19 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from contextlib import contextmanager
 import logging
+from operator import attrgetter
 import struct
+import sys
+from uuid import uuid4
 
 from django.conf import settings
 from django.template.loader import get_template
-from django.utils.html import strip_tags
-from django.utils.translation import ugettext as _, activate, deactivate
+from django.utils.encoding import force_text
+from django.utils.html import conditional_escape, strip_tags
+from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext as _, activate, deactivate, get_language
 from opaque_keys.edx.keys import CourseKey
+import six
 
 from notifier.user import DIGEST_NOTIFICATION_PREFERENCE_KEY, LANGUAGE_PREFERENCE_KEY
 
@@ -25,6 +31,16 @@ THREAD_TITLE_MAXLEN = 140
 # maximum number of characters to allow in thread post, before truncating
 THREAD_ITEM_MAXLEN = 140
 
+# placeholders rendered in place of the per-user fields of a merged digest.
+# they only contain characters which pass through HTML escaping unchanged.
+_MERGE_TOKEN = uuid4().hex
+_NAME_PLACEHOLDER = 'merge-name-{}'.format(_MERGE_TOKEN)
+_UNSUBSCRIBE_URL_PLACEHOLDER = 'merge-unsubscribe-url-{}'.format(_MERGE_TOKEN)
+
+# narrow Python 2 builds store non-BMP characters as surrogate pairs, so that
+# len() and slicing of unicode objects do not count code points.
+_NARROW_UNICODE_BUILD = sys.maxunicode == 0xFFFF
+
 
 logger = logging.getLogger(__name__)
 
@@ -46,6 +62,29 @@ def _trunc(s, length):
     u'one two...'
     """
 
+    if _NARROW_UNICODE_BUILD or not isinstance(s, six.text_type):
+        return _trunc_code_points(s, length)
+
+    s = s.strip()
+    if len(s) <= length:
+        # nothing to do
+        return s
+
+    # truncate, taking an extra -3 off the orig string for the ellipsis itself
+    return s[:length - 3].rsplit(' ', 1)[0].strip() + '...'
+
+
+def _trunc_code_points(s, length):
+    """
+    Formatting helper.
+
+    Implementation of _trunc for str objects, and for Python builds which do
+    not support non-BMP unicode characters.
+
+    >>> _trunc_code_points(u"one two three", 12) == _trunc(u"one two three", 12)
+    True
+    """
+
     # Some Python2.7 builds do not support non-BMP unicode characters.
     # To function properly on such systems, we convert to code points
     # inside this function before counting / slicing characters, and
@@ -65,6 +104,41 @@ def _trunc(s, length):
     return ''.join(uchr(p) for p in pts[:length - 3]).rsplit(' ', 1)[0].strip() + '...'
 
 
+# how many characters of a post body to strip tags from, per character of
+# text that will be kept from it: enough for markup-heavy posts, while
+# bounding the work done on very long ones.
+STRIP_TAGS_INPUT_FACTOR = 10
+
+
+def _strip_tags(value, length):
+    """
+    Formatting helper.
+
+    Strip HTML tags from `value`, for a result that will be truncated with
+    _trunc(result, length).
+
+    When `value` is longer than `length` * STRIP_TAGS_INPUT_FACTOR, only its
+    start, up to the last '>' within that bound, is stripped, provided that
+    gives more than `length` characters of text; otherwise all of it is. If
+    that '>' might not end a tag (e.g. it is within a comment or an attribute
+    value), which would leave markup in the stripped text, all of the value
+    is stripped too.
+
+    >>> _strip_tags('<p>one <b>two</b> three</p>', 13) == 'one two three'
+    True
+    """
+    value = force_text(value)
+    bound = length * STRIP_TAGS_INPUT_FACTOR
+    # _trunc keeps all but the last character of longer strings when length < 3
+    if length >= 3 and len(value) > bound:
+        end = value.rfind('>', 0, bound) + 1
+        if end and value.rfind('<!--', 0, end) <= value.rfind('-->', 0, end):
+            stripped = strip_tags(value[:end])
+            if '<' not in stripped and len(stripped.strip()) > length:
+                return stripped
+    return strip_tags(value)
+
+
 def _make_text_list(values):
     """
     Formatting helper.
@@ -173,6 +247,8 @@ def _activate_user_lang(user):
 
 
 class Digest(object):
+    __slots__ = ('courses',)
+
     def __init__(self, courses):
         self.courses = sorted(courses, key=lambda c: c.title.lower())
 
@@ -181,35 +257,96 @@ class Digest(object):
         return len(self.courses) == 0
 
 class DigestCourse(object):
+    __slots__ = ('course_id', 'title', 'url', 'thread_count', 'threads')
+
     def __init__(self, course_id, threads):
         self.course_id = course_id
         self.title = _get_course_title(course_id)
         self.url = _get_course_url(course_id)
         self.thread_count = len(threads) # not the same as len(self.threads), see below
-        self.threads = sorted(threads, reverse=True, key=lambda t: t.dt)[:MAX_COURSE_THREADS]
+        self.threads = sorted(threads, reverse=True, key=attrgetter('dt'))[:MAX_COURSE_THREADS]
 
     @property
     def empty(self):
         return len(self.threads) == 0
 
 class DigestThread(object):
+    __slots__ = ('title', 'url', 'items', 'dt')
+
     def __init__(self, thread_id, course_id, commentable_id, title, items):
-        self.title = _trunc(strip_tags(title), THREAD_TITLE_MAXLEN)
+        self.title = _trunc(_strip_tags(title, THREAD_TITLE_MAXLEN), THREAD_TITLE_MAXLEN)
         self.url = _get_thread_url(course_id, thread_id, commentable_id)
-        self.items = sorted(items, reverse=True, key=lambda i: i.dt)[:MAX_THREAD_ITEMS]
- 
-    @property
-    def dt(self):
-        return max(item.dt for item in self.items)
+        self.items = sorted(items, reverse=True, key=attrgetter('dt'))[:MAX_THREAD_ITEMS]
+        # the most recent item's time, since items are sorted newest first
+        self.dt = self.items[0].dt if self.items else None
 
 class DigestItem(object):
+    __slots__ = ('body', 'author', 'dt')
+
     def __init__(self, body, author, dt):
-        self.body = _trunc(strip_tags(body), THREAD_ITEM_MAXLEN)
+        self.body = _trunc(_strip_tags(body, THREAD_ITEM_MAXLEN), THREAD_ITEM_MAXLEN)
         self.author = author
         self.dt = dt
 
 
-def render_digest(user, digest, title, description):
+def _thread_key(thread):
+    """
+    Return a hashable key identifying everything that goes into the rendering
+    of a DigestThread, so that equal threads in different users' digests can
+    share one rendered fragment.
+    """
+    return (thread.url, thread.title, tuple((item.author, item.dt, item.body) for item in thread.items))
+
+
+def _render_thread(fmt, thread, fragment_cache):
+    """
+    Render a single thread block in the given format ("txt" or "html") under
+    the active language, reusing the fragment from `fragment_cache` if an
+    identical thread has already been rendered.
+    """
+    key = (fmt, get_language(), _thread_key(thread))
+    fragment = fragment_cache.get(key)
+    if fragment is None:
+        template = get_template('digest-thread.{}'.format(fmt))
+        fragment = fragment_cache[key] = mark_safe(template.render({'thread': thread}))
+    return fragment
+
+
+def _render_courses(fmt, digest, fragment_cache):
+    """
+    Return a list of (course, [rendered thread fragment, ...]) pairs for the
+    courses in `digest`.
+    """
+    return [
+        (course, [_render_thread(fmt, thread, fragment_cache) for thread in course.threads])
+        for course in digest.courses
+    ]
+
+
+def _digest_key(digest):
+    """
+    Return a hashable key identifying everything that goes into the rendering
+    of a Digest apart from the recipient's own details.
+    """
+    return tuple(
+        (course.course_id, course.thread_count, tuple(_thread_key(thread) for thread in course.threads))
+        for course in digest.courses
+    )
+
+
+def _render_bodies(context, digest, fragment_cache):
+    """
+    Render the text and html digest templates with the given context, under
+    the active language.
+    """
+    context['courses'] = _render_courses('txt', digest, fragment_cache)
+    text = get_template('digest-email.txt').render(context)
+    context['courses'] = _render_courses('html', digest, fragment_cache)
+    html = get_template('digest-email.html').render(context)
+    return (text, html)
+
+
+def render_digest(user, digest, title, description, fragment_cache=None, merge_cache=None):
     """
     Generate HTML and plaintext renderings of digest material, suitable for
     emailing.
@@ -223,10 +360,23 @@ def render_digest(user, digest, title, description):
     `title` and `description` are brief strings to be displayed at the top
     of the email message.
 
+    `fragment_cache` is an optional dict in which rendered thread blocks are
+    kept; pass the same dict when rendering a batch of digests so that
+    threads appearing in several of them are only rendered once per language.
+
+    `merge_cache` is an optional dict in which whole renderings are kept, with
+    placeholders for the user's name and unsubscribe url; pass the same dict
+    when rendering a batch so that identical digests are only rendered once
+    per language, and then filled in for each user by string substitution.
+    After the batch, len(merge_cache) is the number of distinct renderings.
+
 
     Returns two strings: (text_body, html_body).
     """
+    if fragment_cache is None:
+        fragment_cache = {}
     logger.info("rendering email message: {user_id: %s}", user['id'])
+    unsubscribe_url = _get_unsubscribe_url(user)
     context = {
         'user': user,
         'digest': digest,
@@ -236,12 +386,25 @@ def render_digest(user, digest, title, description):
         'course_names': _make_text_list([course.title for course in digest.courses]),
         'thread_count': sum(course.thread_count for course in digest.courses),
         'logo_image_url': settings.LOGO_IMAGE_URL,
-        'unsubscribe_url': _get_unsubscribe_url(user),
+        'unsubscribe_url': unsubscribe_url,
         'postal_address': settings.EMAIL_SENDER_POSTAL_ADDRESS,
         }
 
     with _activate_user_lang(user):
-        text = get_template('digest-email.txt').render(context)
-        html = get_template('digest-email.html').render(context)
-
+        if merge_cache is None:
+            return _render_bodies(context, digest, fragment_cache)
+        key = (get_language(), title, description, _digest_key(digest))
+        merged = merge_cache.get(key)
+        if merged is None:
+            context.update({
+                'user': {'name': _NAME_PLACEHOLDER},
+                'unsubscribe_url': _UNSUBSCRIBE_URL_PLACEHOLDER,
+            })
+            merged = merge_cache[key] = _render_bodies(context, digest, fragment_cache)
+
+    name = '{}'.format(user['name'])
+    text, html = merged
+    text = text.replace(_NAME_PLACEHOLDER, name).replace(_UNSUBSCRIBE_URL_PLACEHOLDER, unsubscribe_url)
+    html = html.replace(_NAME_PLACEHOLDER, conditional_escape(name)).replace(
+        _UNSUBSCRIBE_URL_PLACEHOLDER, conditional_escape(unsubscribe_url))
     return (text, html)
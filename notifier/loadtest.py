@@ -0,0 +1,325 @@
+"""
+An end-to-end load test of the digest pipeline, against local stand-ins for
+the user service and the comments service, sending into an in-memory mail
+sink.
+
+This is not part of the test suite; run it with ``python manage.py loadtest``.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import random
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import threading
+import time
+
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.test.utils import override_settings
+import six
+from six.moves import BaseHTTPServer, range, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from notifier import pull, tasks, user
+from notifier.backends import fake_ses
+from notifier.connection_wrapper import BackendWrapper
+from notifier.models import ForumDigestTask
+from notifier.user import DIGEST_NOTIFICATION_PREFERENCE_KEY
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+    'magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo'
+).split()
+
+
+class SyntheticData(object):
+
+    """Generates users and their forum activity, the same for the same seed.
+
+    There are `num_courses` courses with `num_cohorts` cohorts each. Every
+    user is enrolled in `courses_per_user` of them, and in each course they
+    either see all cohorts or belong to one of its cohorts. Each course has
+    `threads_per_course` threads with new activity, of which a
+    `cohorted_fraction` belong to a cohort, and each thread has up to
+    `items_per_thread` new posts.
+    """
+
+    def __init__(self, num_users, num_courses=10, courses_per_user=2, num_cohorts=3, threads_per_course=5,
+                 items_per_thread=3, cohorted_fraction=0.2, seed=0):
+        self.num_users = num_users
+        self.num_courses = num_courses
+        self.courses_per_user = min(courses_per_user, num_courses)
+        self.num_cohorts = num_cohorts
+        self.threads_per_course = threads_per_course
+        self.items_per_thread = items_per_thread
+        self.cohorted_fraction = cohorted_fraction
+        self.seed = seed
+
+    def _random(self, *key):
+        return random.Random('{}:{}'.format(self.seed, ':'.join(map(str, key))))
+
+    def _text(self, rnd, num_words):
+        return ' '.join(rnd.choice(WORDS) for _ in range(num_words)).capitalize() + '.'
+
+    def course_id(self, n):
+        return 'LoadTestX/Course{}/run'.format(n)
+
+    def user(self, user_id):
+        rnd = self._random('user', user_id)
+        course_info = {}
+        for c in rnd.sample(range(self.num_courses), self.courses_per_user):
+            see_all_cohorts = rnd.random() < 0.1
+            course_info[self.course_id(c)] = {
+                'see_all_cohorts': see_all_cohorts,
+                'cohort_id': None if see_all_cohorts else rnd.randrange(self.num_cohorts),
+            }
+        return {
+            'id': user_id,
+            'name': 'Load Test User {}'.format(user_id),
+            'email': 'user{}@loadtest.example.org'.format(user_id),
+            'preferences': {DIGEST_NOTIFICATION_PREFERENCE_KEY: 'token{}'.format(user_id)},
+            'course_info': course_info,
+        }
+
+    def users(self, page, page_size):
+        """
+        Returns a page of the user service's list of digest subscribers.
+        """
+        start = (page - 1) * page_size
+        user_ids = range(start + 1, min(start + page_size, self.num_users) + 1)
+        return [self.user(user_id) for user_id in user_ids], start + page_size < self.num_users
+
+    def course_threads(self, course_id):
+        rnd = self._random('course', course_id)
+        now = datetime.utcnow()
+        threads = {}
+        for t in range(self.threads_per_course):
+            thread = {
+                'commentable_id': 'commentable{}'.format(rnd.randrange(5)),
+                'title': self._text(rnd, rnd.randint(3, 10)),
+                'content': [
+                    {
+                        'body': '<p>{}</p>'.format(self._text(rnd, rnd.randint(5, 60))),
+                        'username': 'author{}'.format(rnd.randrange(100)),
+                        'updated_at': (now - timedelta(minutes=rnd.randrange(1440))).isoformat() + 'Z',
+                    }
+                    for _ in range(rnd.randint(1, self.items_per_thread))
+                ],
+            }
+            if rnd.random() < self.cohorted_fraction:
+                thread['group_id'] = rnd.randrange(self.num_cohorts)
+            threads['{}-thread{}'.format(course_id, t)] = thread
+        return threads
+
+    def notifications(self, user_ids):
+        """
+        Returns the comments service's notifications for the given users:
+        all the threads in the courses they are enrolled in (the notifier does
+        the cohort filtering).
+        """
+        courses = {}
+        result = {}
+        for user_id in user_ids:
+            result[str(user_id)] = {}
+            for course_id in self.user(int(user_id))['course_info']:
+                if course_id not in courses:
+                    courses[course_id] = self.course_threads(course_id)
+                result[str(user_id)][course_id] = courses[course_id]
+        return result
+
+
+class StandInServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """An HTTP server standing in for both the user service's
+    ``/notifier_api/v1/users/`` and the comments service's
+    ``/api/v1/notifications`` endpoints, serving data from a SyntheticData.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, data):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.data = data
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def _respond(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/notifier_api/v1/users/':
+            return self.send_error(404)
+        params = parse_qs(url.query)
+        page = int(params.get('page', ['1'])[0])
+        users, more = self.server.data.users(page, int(params.get('page_size', ['40'])[0]))
+        self._respond({'results': users, 'next': 'page={}'.format(page + 1) if more else None})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/api/v1/notifications':
+            return self.send_error(404)
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self._respond(self.server.data.notifications(form['user_ids'][0].split(',')))
+
+    def log_message(self, *args):
+        pass
+
+
+class SinkBackend(BaseEmailBackend):
+
+    """An email backend which builds each message, as a real backend would,
+    counts it and throws it away.
+    """
+
+    lock = threading.Lock()
+    messages = 0
+    size = 0
+
+    @classmethod
+    def reset(cls):
+        with cls.lock:
+            cls.messages = cls.size = 0
+
+    def send_messages(self, email_messages):
+        size = sum(len(msg.message().as_bytes()) for msg in email_messages)
+        with self.lock:
+            SinkBackend.messages += len(email_messages)
+            SinkBackend.size += size
+        return len(email_messages)
+
+
+class StageTimer(object):
+
+    """Times the calls to functions standing for the stages of the pipeline,
+    by wrapping them in place until restore() is called.
+    """
+
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self._patched = []
+
+    def wrap(self, obj, name, stage):
+        original = obj.__dict__[name]
+
+        def timed(*args, **kwargs):
+            t = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.timings[stage].append(time.time() - t)
+
+        setattr(obj, name, timed)
+        self._patched.append((obj, name, original))
+
+    def restore(self):
+        for obj, name, original in reversed(self._patched):
+            setattr(obj, name, original)
+        self._patched = []
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _peak_memory():
+    """
+    Returns the peak resident set size of the process so far, in MiB.
+    """
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(data, backend='sink', batch_size=None):
+    """
+    Runs the whole forums digest task (in this process, with celery tasks
+    executed eagerly) for the users in `data`, and returns a list of
+    (label, value, unit) results.
+
+    `backend` is either 'sink' (see SinkBackend) or 'ses-fake' (the fake SES
+    of notifier.backends, with no send rate limit). Nothing done to the
+    database is kept.
+    """
+    server = StandInServer(data)
+    server.start()
+    timer = StageTimer()
+    email_backend = {
+        'sink': 'notifier.loadtest.SinkBackend',
+        'ses-fake': 'notifier.backends.FakeSESBackend',
+    }[backend]
+    overrides = {
+        'US_URL_BASE': server.url,
+        'CS_URL_BASE': server.url,
+        'EMAIL_BACKEND': email_backend,
+        'CELERY_ALWAYS_EAGER': True,
+        'CELERY_EAGER_PROPAGATES_EXCEPTIONS': True,
+        'DEAD_MANS_SNITCH_URL': '',
+        'EMAIL_OUTBOX_DIR': None,
+        'EMAIL_REWRITE_RECIPIENT': None,
+    }
+    if batch_size:
+        overrides['FORUM_DIGEST_TASK_BATCH_SIZE'] = batch_size
+    SinkBackend.reset()
+    fake_ses.reset(max_send_rate=10 ** 9)
+    try:
+        timer.wrap(user, '_http_get', 'user service request')
+        timer.wrap(pull, '_http_post', 'comments service request')
+        timer.wrap(tasks, 'render_digest', 'render digest')
+        timer.wrap(BackendWrapper, 'send_messages', 'send batch')
+        with override_settings(**overrides), transaction.atomic():
+            # so that the run isn't skipped as already done for this period
+            ForumDigestTask.objects.all().delete()
+            start = time.time()
+            tasks.do_forums_digests.delay()
+            elapsed = time.time() - start
+            # leave the database as it was
+            transaction.set_rollback(True)
+    finally:
+        timer.restore()
+        server.stop()
+
+    emails = SinkBackend.messages if backend == 'sink' else len(fake_ses.sent)
+    results = [
+        ('users', data.num_users, ''),
+        ('emails sent', emails, ''),
+        ('elapsed', elapsed, 's'),
+        ('users per second', data.num_users / elapsed, 'users/s'),
+        ('emails per second', emails / elapsed, 'emails/s'),
+    ]
+    peak = _peak_memory()
+    if peak is not None:
+        results.append(('peak memory (RSS)', peak, 'MiB'))
+    for stage, timings in sorted(six.iteritems(timer.timings)):
+        results.extend([
+            ('{} (calls)'.format(stage), len(timings), ''),
+            ('{} (mean)'.format(stage), sum(timings) / len(timings) * 1e3, 'ms'),
+            ('{} (p95)'.format(stage), _percentile(timings, 0.95) * 1e3, 'ms'),
+            ('{} (max)'.format(stage), max(timings) * 1e3, 'ms'),
+        ])
+    return results
@@ -0,0 +1,170 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+import platform
+import time
+
+from dateutil.parser import parse as date_parse
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from notifier import metrics
+from notifier.models import ForumDigestTask, ForumDigestTaskSummary
+from notifier.tasks import _bucket_slice, _time_slice, dispatch_digests
+from notifier.user import UserServiceException
+
+
+logger = logging.getLogger(__name__)
+
+
+def _bucket(to_dt):
+    if settings.FORUM_DIGEST_TASK_BUCKETS > 1:
+        return _bucket_slice(settings.FORUM_DIGEST_TASK_INTERVAL, settings.FORUM_DIGEST_TASK_BUCKETS, to_dt)[2]
+    return None
+
+
+def missed_slices(since, until):
+    """
+    Returns the (from_dt, to_dt, bucket) time slices, as do_forums_digests
+    would schedule them, ending after `since` and no later than `until` that
+    no ForumDigestTask (of the same delivery bucket) covers.
+    """
+    minutes = settings.FORUM_DIGEST_TASK_INTERVAL
+    step = minutes // settings.FORUM_DIGEST_TASK_BUCKETS
+    interval = datetime.timedelta(minutes=minutes)
+    covered = [
+        (from_dt, to_dt, _bucket(to_dt))
+        for from_dt, to_dt in ForumDigestTask.objects.filter(to_dt__gt=since).values_list('from_dt', 'to_dt')
+    ]
+    slices = []
+    _, to_dt = _time_slice(step, since)
+    to_dt += datetime.timedelta(minutes=step)
+    while to_dt <= until:
+        from_dt, bucket = to_dt - interval, _bucket(to_dt)
+        if not any(c_bucket == bucket and c_from <= from_dt and to_dt <= c_to for c_from, c_to, c_bucket in covered):
+            slices.append((from_dt, to_dt, bucket))
+        to_dt += datetime.timedelta(minutes=step)
+    return slices
+
+
+def merge_slices(slices):
+    """
+    Merges the adjacent slices of each delivery bucket into one wider slice,
+    so that its subscribers get one digest for them instead of several.
+
+    >>> from datetime import datetime as dt
+    >>> merge_slices([(dt(2013, 1, 1, 0), dt(2013, 1, 1, 1), None), (dt(2013, 1, 1, 1), dt(2013, 1, 1, 2), None),
+    ...               (dt(2013, 1, 1, 3), dt(2013, 1, 1, 4), None)]) == [
+    ...     (dt(2013, 1, 1, 0), dt(2013, 1, 1, 2), None), (dt(2013, 1, 1, 3), dt(2013, 1, 1, 4), None)]
+    True
+    """
+    merged = {}
+    for from_dt, to_dt, bucket in sorted(slices, key=lambda s: s[1]):
+        windows = merged.setdefault(bucket, [])
+        if windows and windows[-1][1] == from_dt:
+            windows[-1] = (windows[-1][0], to_dt, bucket)
+        else:
+            windows.append((from_dt, to_dt, bucket))
+    return sorted((window for windows in merged.values() for window in windows), key=lambda s: s[1])
+
+
+class Command(BaseCommand):
+
+    help = """Send the forum digests of the time slices that the scheduler missed (e.g. while it was down).
+
+    Tasks are recorded for all the missed slices in one transaction before any is dispatched, so that a scheduler
+    running meanwhile won't send them too.
+    """
+
+    def add_arguments(self, parser):
+        """Add comand arguments."""
+        parser.add_argument('--since',
+                            help='datetime after which to look for missed time slices, in ISO-8601 format (UTC).  Required, and no earlier than FORUM_DIGEST_TASK_GC_DAYS ago.'),
+        parser.add_argument('--until',
+                            help='datetime up to which to look for missed time slices, in ISO-8601 format (UTC).  Defaults to now.'),
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=4,
+                            help='number of time slices to dispatch at once.  Defaults to 4.'),
+        parser.add_argument('--merge',
+                            action='store_true',
+                            dest='merge',
+                            help='merge adjacent missed time slices into one, so that users get one digest for them'),
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            dest='dry_run',
+                            help='output the missed time slices only (don\'t send anything)'),
+
+    def backfill(self, task_bucket):
+        task, bucket = task_bucket
+        for attempt in range(settings.DAILY_TASK_MAX_RETRIES + 1):
+            if attempt:
+                time.sleep(settings.DAILY_TASK_RETRY_DELAY)
+            try:
+                batches = dispatch_digests(task, bucket, retries=attempt)
+            except UserServiceException:
+                logger.exception("Failed to backfill forums digest task: from_dt=%s to_dt=%s", task.from_dt, task.to_dt)
+            else:
+                logger.info("Backfilled forums digest task: from_dt=%s to_dt=%s batches=%d",
+                            task.from_dt, task.to_dt, batches)
+                return True
+        return False
+
+    def backfill_in_thread(self, task_bucket):
+        try:
+            return self.backfill(task_bucket)
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        """
+        """
+        if not options.get('since'):
+            raise CommandError('--since is required')
+        since = date_parse(options['since'])
+        until = date_parse(options['until']) if options.get('until') else datetime.datetime.utcnow()
+        if since < datetime.datetime.utcnow() - datetime.timedelta(days=settings.FORUM_DIGEST_TASK_GC_DAYS):
+            # tasks older than that have been pruned, so their slices would look missed
+            raise CommandError('--since must be within FORUM_DIGEST_TASK_GC_DAYS of now')
+
+        slices = missed_slices(since, until)
+        if options.get('merge'):
+            slices = merge_slices(slices)
+        for from_dt, to_dt, bucket in slices:
+            self.stdout.write('{}  {}  {}'.format(from_dt, to_dt, bucket if bucket is not None else '-'))
+        if options.get('dry_run') or not slices:
+            return
+
+        tasks = []
+        with transaction.atomic():
+            for from_dt, to_dt, bucket in slices:
+                task, created = ForumDigestTask.objects.get_or_create(
+                    from_dt=from_dt, to_dt=to_dt, defaults={'node': platform.node()})
+                if created:
+                    ForumDigestTaskSummary.objects.create(task=task)
+                    tasks.append((task, bucket))
+        if not tasks:
+            return
+
+        concurrency = max(1, options['concurrency'])
+        try:
+            if concurrency == 1:
+                results = [self.backfill(task_bucket) for task_bucket in tasks]
+            else:
+                pool = ThreadPool(min(concurrency, len(tasks)))
+                try:
+                    results = pool.map(self.backfill_in_thread, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            metrics.flush()
+        failed = [task for (task, _), ok in zip(tasks, results) if not ok]
+        if failed:
+            raise CommandError('failed to backfill {} of {} time slices: {}'.format(
+                len(failed), len(tasks), ', '.join('{}-{}'.format(t.from_dt, t.to_dt) for t in failed)))
@@ -0,0 +1,75 @@
+"""
+Run the notifier micro-benchmarks and print their results.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import io
+import json
+import platform
+
+from django.core.management.base import BaseCommand, CommandError
+import six
+
+from notifier.benchmarks import BENCHMARKS, compare
+
+
+class Command(BaseCommand):
+
+    help = "Run micro-benchmarks of the per-user digest code paths."
+
+    def add_arguments(self, parser):
+        """Add comand arguments."""
+        parser.add_argument('names',
+                            nargs='*',
+                            help='names of the benchmarks to run (default: all of {})'.format(
+                                ', '.join(sorted(BENCHMARKS))))
+        parser.add_argument('--number',
+                            type=int,
+                            help='number of calls to time (or objects to measure) for each benchmark.')
+        parser.add_argument('--json',
+                            dest='json_file',
+                            help='write the results to this file as JSON, for use as a baseline.')
+        parser.add_argument('--baseline',
+                            help='compare the results with the ones in this JSON file (written by --json), '
+                                 'and fail if any of them regressed.')
+        parser.add_argument('--threshold',
+                            type=float,
+                            default=0.2,
+                            help='fraction by which a result may exceed its baseline before it counts as a '
+                                 'regression (default: 0.2).')
+
+    def handle(self, *args, **options):
+        names = options['names'] or sorted(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('unknown benchmark: {}'.format(name))
+        baseline = None
+        if options['baseline']:
+            with io.open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)['results']
+
+        results = []
+        for name in names:
+            kwargs = {'number': options['number']} if options['number'] else {}
+            for label, value, unit in BENCHMARKS[name](**kwargs):
+                self.stdout.write('{:<50} {:>12.1f} {}'.format(label, value, unit))
+                results.append({'benchmark': name, 'label': label, 'value': value, 'unit': unit})
+
+        if options['json_file']:
+            with io.open(options['json_file'], 'w', encoding='utf-8') as f:
+                f.write(six.text_type(json.dumps({
+                    'python': platform.python_version(),
+                    'number': options['number'],
+                    'results': results,
+                }, indent=2, sort_keys=True)))
+
+        if baseline is not None:
+            comparisons = compare(results, baseline, options['threshold'])
+            self.stdout.write('')
+            for label, value, base, change, regressed in comparisons:
+                self.stdout.write('{:<50} {:>12.1f} {:>12.1f} {:>+8.1%}{}'.format(
+                    label, value, base, change, '  REGRESSED' if regressed else ''))
+            regressions = [c for c in comparisons if c[4]]
+            if regressions:
+                raise CommandError('{} of {} results regressed by more than {:.0%}'.format(
+                    len(regressions), len(comparisons), options['threshold']))
@@ -8,15 +8,17 @@ import datetime
 
 from dateutil.parser import parse as date_parse
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.core.serializers.json import DjangoJSONEncoder
 import json
 import logging
 
+from notifier import profiling
 from notifier.digest import render_digest, Digest, DigestCourse, DigestThread, DigestItem
+from notifier.models import ForumDigestTask
 from notifier.pull import generate_digest_content
-from notifier.tasks import generate_and_send_digests
-from notifier.user import get_digest_subscribers, get_user
+from notifier.tasks import generate_and_send_digests, resume_staged_batches
+from notifier.user import compact_users, get_digest_subscribers, get_user
 
 
 logger = logging.getLogger(__name__)
@@ -26,7 +28,7 @@ class DigestJSONEncoder(DjangoJSONEncoder):
 
     def default(self, o):
         if isinstance(o, (Digest, DigestCourse, DigestThread, DigestItem)):
-            return o.__dict__
+            return dict((name, getattr(o, name)) for name in o.__slots__)
         else:
             return super(DigestJSONEncoder, self).default(o)
 
@@ -40,7 +42,7 @@ class Command(BaseCommand):
         parser.add_argument('--to_datetime',
                             help='datetime as of which to generate digest content, in ISO-8601 format (UTC).  Defaults to today at 00:00 (UTC).'),
         parser.add_argument('--minutes',
-                            type='int',
+                            type=int,
                             default=1440,
                             help='number of minutes up to TO_DATETIME for which to generate digest content.  Defaults to 1440 (one day).'),
         parser.add_argument('--users',
@@ -62,6 +64,18 @@ class Command(BaseCommand):
                             action='store_true',
                             dest='show_html',
                             help='output the rendered html body of the first user-digest generated, and exit (don\'t send anything)'),
+        parser.add_argument('--profile',
+                            action='store_true',
+                            dest='profile',
+                            help='run each batch in this process instead of queueing it, and write a profile of it to PROFILE_DIR'),
+        parser.add_argument('--report',
+                            action='store_true',
+                            dest='report',
+                            help='output a summary of each scheduled forums digest task still in the database, and exit (don\'t send anything)'),
+        parser.add_argument('--resume',
+                            action='store_true',
+                            dest='resume',
+                            help='queue again the batches still staged for the scheduled forums digest task of the time window, and exit (see FORUM_DIGEST_TASK_STAGE_USERS)'),
 
 
     def get_specific_users(self, user_ids):
@@ -107,10 +121,57 @@ class Command(BaseCommand):
         elif fmt == 'html':
             print(html, file=self.stdout)
 
+    def report(self):
+        row = '{:<19}  {:<19}  {:<20}  {:>10}  {:>9}  {:>8}  {:>8}  {:>8}  {:>7}  {:<19}  {:<19}  {:>10}'
+        self.stdout.write(row.format('from', 'to', 'node', 'dispatched', 'completed', 'users', 'digests', 'emails',
+                                     'retries', 'first send', 'last send', 'duration'))
+
+        def fmt_dt(dt):
+            return dt.strftime('%Y-%m-%d %H:%M:%S') if dt else '-'
+
+        for task in ForumDigestTask.objects.select_related('summary').order_by('-from_dt'):
+            summary = getattr(task, 'summary', None)
+            if summary is None:
+                # scheduled before summaries were recorded
+                self.stdout.write(row.format(fmt_dt(task.from_dt), fmt_dt(task.to_dt), task.node, *['-'] * 9))
+                continue
+            duration = None
+            if summary.last_send:
+                duration = datetime.timedelta(seconds=int((summary.last_send - task.created).total_seconds()))
+            self.stdout.write(row.format(
+                fmt_dt(task.from_dt), fmt_dt(task.to_dt), task.node, summary.batches_dispatched,
+                summary.batches_completed, summary.users, summary.digests, summary.emails_sent, summary.retries,
+                fmt_dt(summary.first_send), fmt_dt(summary.last_send), str(duration) if duration is not None else '-'
+            ))
+
+    def resume(self, from_dt, to_dt):
+        try:
+            task = ForumDigestTask.objects.get(from_dt=from_dt, to_dt=to_dt)
+        except ForumDigestTask.DoesNotExist:
+            raise CommandError('no forums digest task scheduled from {} to {}'.format(from_dt, to_dt))
+        self.stdout.write('queued {} staged batches'.format(resume_staged_batches(task)))
+
     def handle(self, *args, **options):
         """
         """
 
+        if options.get('report'):
+            self.report()
+            return
+
+        # determine time window
+        if options.get('to_datetime'):
+            to_datetime = date_parse(options['to_datetime'])
+        else:
+            to_datetime = datetime.datetime.utcnow().replace(
+                hour=0, minute=0, second=0, microsecond=0)
+        from_datetime = to_datetime - \
+            datetime.timedelta(minutes=options['minutes'])
+
+        if options.get('resume'):
+            self.resume(from_datetime, to_datetime)
+            return
+
         # get user data
         if options.get('users_str') is not None:
             # explicitly-specified users
@@ -124,15 +185,6 @@ class Command(BaseCommand):
             self.show_users(users)
             return
 
-        # determine time window
-        if options.get('to_datetime'):
-            to_datetime = date_parse(options['to_datetime'])
-        else:
-            to_datetime = datetime.datetime.utcnow().replace(
-                hour=0, minute=0, second=0)
-        from_datetime = to_datetime - \
-            datetime.timedelta(minutes=options['minutes'])
-
         if options.get('show_content'):
             self.show_content(users, from_datetime, to_datetime)
             return
@@ -148,6 +200,17 @@ class Command(BaseCommand):
         # invoke `tasks.generate_and_send_digests` via celery, in groups of
         # 10
         def queue_digests(some_users):
+            num_users = len(some_users)
+            if settings.FORUM_DIGEST_TASK_COMPACT_PAYLOAD:
+                some_users = compact_users(some_users)
+            if options.get('profile'):
+                with profiling.profile(profiling.digest_tag(num_users, from_datetime, to_datetime)):
+                    generate_and_send_digests.apply(
+                        (some_users, from_datetime, to_datetime),
+                        {'language': settings.LANGUAGE_CODE},
+                        throw=True
+                    )
+                return
             generate_and_send_digests.delay(
                 some_users,
                 from_datetime,
@@ -0,0 +1,74 @@
+"""
+Run an end-to-end load test of the forums digest task and print its results.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from notifier.loadtest import SyntheticData, run
+
+
+class Command(BaseCommand):
+
+    help = """Run the forums digest task end to end for synthetic users, against local
+    stand-ins for the user service and comments service (served from this
+    process), and report its throughput, peak memory and the latency of each
+    stage.  Emails are built but not sent anywhere, and nothing is kept in
+    the database."""
+
+    def add_arguments(self, parser):
+        """Add comand arguments."""
+        parser.add_argument('--users',
+                            type=int,
+                            default=1000,
+                            help='number of digest subscribers (default 1000).')
+        parser.add_argument('--courses',
+                            type=int,
+                            default=10,
+                            help='number of courses (default 10).')
+        parser.add_argument('--courses-per-user',
+                            type=int,
+                            default=2,
+                            help='number of courses each user is enrolled in (default 2).')
+        parser.add_argument('--cohorts',
+                            type=int,
+                            default=3,
+                            help='number of cohorts per course (default 3).')
+        parser.add_argument('--threads',
+                            type=int,
+                            default=5,
+                            help='number of active threads per course (default 5).')
+        parser.add_argument('--items',
+                            type=int,
+                            default=3,
+                            help='maximum number of new posts per thread (default 3).')
+        parser.add_argument('--cohorted',
+                            type=float,
+                            default=0.2,
+                            help='fraction of threads that belong to a cohort (default 0.2).')
+        parser.add_argument('--seed',
+                            type=int,
+                            default=0,
+                            help='seed for the synthetic data.')
+        parser.add_argument('--batch-size',
+                            type=int,
+                            help='number of users per digest task (default FORUM_DIGEST_TASK_BATCH_SIZE).')
+        parser.add_argument('--backend',
+                            choices=['sink', 'ses-fake'],
+                            default='sink',
+                            help='where to send the emails: a sink that discards them, or the fake SES.')
+
+    def handle(self, *args, **options):
+        data = SyntheticData(
+            options['users'],
+            num_courses=options['courses'],
+            courses_per_user=options['courses_per_user'],
+            num_cohorts=options['cohorts'],
+            threads_per_course=options['threads'],
+            items_per_thread=options['items'],
+            cohorted_fraction=options['cohorted'],
+            seed=options['seed'],
+        )
+        for label, value, unit in run(data, backend=options['backend'], batch_size=options['batch_size']):
+            self.stdout.write('{:<50} {:>12.1f} {}'.format(label, value, unit))
@@ -4,7 +4,7 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
-from notifier.tasks import do_forums_digests
+from notifier.tasks import do_forums_digests, drain_outbox
 
 # As it's name implies, when started, this Scheduler will block until forcibly stopped.
 sched = BlockingScheduler(standalone=True)
@@ -13,6 +13,10 @@ sched = BlockingScheduler(standalone=True)
 def digest_job():
     do_forums_digests.delay()
 
+
+def drain_outbox_job():
+    drain_outbox.delay()
+
 class Command(BaseCommand):
 
     help = """Start the notifier scheduler.  Important environment settings are:
@@ -25,8 +29,21 @@ class Command(BaseCommand):
         be a factor of 1440.  If 1440, the forums digest job will fire at midnight
         daily.
 
+    FORUM_DIGEST_TASK_BUCKETS (optional)
+        Number of delivery buckets (int) spread evenly over each interval.
+        Default is 1.  If greater, the forums digest job fires once per
+        bucket, each time sending digests to that bucket's subscribers only.
+        Each bucket must last a factor of 60 minutes, or a whole number of
+        hours that is a factor of 24.
+
+    EMAIL_OUTBOX_DIR (optional)
+        Outbox directory for rendered digests.  If set, the outbox drain job
+        fires every EMAIL_OUTBOX_DRAIN_INTERVAL seconds (default 60).
+
     """
 
     def handle(self, *args, **options):
         sched.add_job(digest_job, 'cron', **settings.DIGEST_CRON_SCHEDULE)
+        if settings.EMAIL_OUTBOX_DIR:
+            sched.add_job(drain_outbox_job, 'interval', seconds=settings.EMAIL_OUTBOX_DRAIN_INTERVAL)
         sched.start()
@@ -0,0 +1,105 @@
+"""
+Email message construction for digests.
+
+All the digest emails of a run share their sender, subject and MIME layout,
+so `DigestMessageBuilder` encodes those once, and the messages it builds
+only have their own bodies and recipient to encode.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.message import (
+    DNS_NAME, RFC5322_EMAIL_LINE_LENGTH_LIMIT, SafeMIMEMultipart, SafeMIMEText, forbid_multi_line_headers,
+    make_msgid, utf8_charset, utf8_charset_qp
+)
+from django.utils.encoding import force_text
+
+
+def _has_long_lines(text):
+    """
+    Returns whether any line of `text` is too long to be sent as it is once
+    encoded as utf-8. The encoded length of the lines is only measured if one
+    of them is long enough for that to be possible.
+    """
+    lines = text.splitlines()
+    # a utf-8 encoded character takes up at most four bytes
+    if not lines or max(map(len, lines)) <= RFC5322_EMAIL_LINE_LENGTH_LIMIT // 4:
+        return False
+    return any(len(line.encode('utf-8')) > RFC5322_EMAIL_LINE_LENGTH_LIMIT for line in lines)
+
+
+class _DigestMIMEText(SafeMIMEText):
+
+    """A text part which checks for over-long lines without looping over
+    every line in python.
+    """
+
+    def set_payload(self, payload, charset=None):
+        if charset == 'utf-8':
+            # quoted-printable encoding shortens lines that are too long to be
+            # sent as they are.
+            charset = utf8_charset_qp if _has_long_lines(payload) else utf8_charset
+        MIMEText.set_payload(self, payload, charset=charset)
+
+
+class DigestMessage(EmailMultiAlternatives):
+
+    """A digest email, whose MIME message is assembled from the parts its
+    builder has prepared.
+    """
+
+    def __init__(self, builder, to, text, html):
+        super(DigestMessage, self).__init__(builder.subject, text, builder.from_email, to)
+        self.attach_alternative(html, 'text/html')
+        self.builder = builder
+
+    def message(self):
+        builder = self.builder
+        encoding = builder.encoding
+        msg = SafeMIMEMultipart(_subtype=self.alternative_subtype, boundary=builder.boundary, encoding=encoding)
+        msg.attach(_DigestMIMEText(self.body, self.content_subtype, encoding))
+        for content, mimetype in self.alternatives:
+            msg.attach(_DigestMIMEText(content, mimetype.split('/', 1)[1], encoding))
+        for name, value in builder.headers:
+            MIMEMultipart.__setitem__(msg, name, value)
+        msg['To'] = ', '.join(map(force_text, self.to))
+        MIMEMultipart.__setitem__(msg, 'Date', formatdate(localtime=settings.EMAIL_USE_LOCALTIME))
+        MIMEMultipart.__setitem__(msg, 'Message-ID', make_msgid(domain=DNS_NAME))
+        for name, value in self.extra_headers.items():
+            if name.lower() != 'from':
+                msg[name] = value
+        return msg
+
+
+class DigestMessageBuilder(object):
+
+    """Builds the digest emails for one run.
+
+    The subject and sender headers are encoded when the builder is created.
+    All the messages use the same multipart boundary, a random one which
+    can't turn up in their content, so the boundary isn't searched for in
+    every body when the messages are serialized.
+    """
+
+    def __init__(self, subject, from_email):
+        self.subject = subject
+        self.from_email = from_email
+        self.encoding = settings.DEFAULT_CHARSET
+        self.headers = [
+            forbid_multi_line_headers(name, value, self.encoding)
+            for name, value in (('Subject', subject), ('From', from_email))
+        ]
+        self.boundary = '===============%s==' % uuid4().hex
+
+    def build(self, to, text, html):
+        """
+        Returns a digest email to the `to` addresses with the given text and
+        html bodies.
+        """
+        return DigestMessage(self, to, text, html)
@@ -0,0 +1,300 @@
+"""
+Timing, size and counter metrics for the digest tasks, sent to the exporters
+named in METRICS_EXPORTERS.
+
+With no exporters configured, recording a metric only costs a settings lookup.
+Histograms and counters are aggregated in the process by the exporters that
+need it, and written out when the task recording them calls `flush()`.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from bisect import bisect_left
+from collections import defaultdict
+import io
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+import six
+
+logger = logging.getLogger(__name__)
+
+TIMING = 'timing'
+SIZE = 'size'
+COUNTER = 'counter'
+
+# upper bounds of the histogram buckets for each kind of observation
+BUCKETS = {
+    TIMING: (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float('inf')),
+    SIZE: (1e3, 1e4, 1e5, 1e6, 1e7, float('inf')),
+}
+
+
+class Histogram(object):
+
+    """Counts observations in buckets of BUCKETS[kind], and keeps their sum
+    and maximum.
+    """
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.buckets = BUCKETS[kind]
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Exporter(object):
+
+    """Base class of the metrics exporters.
+
+    `record` is called for every observation (a duration in seconds, a size
+    in bytes or a counter increment), and `flush` at the end of each task.
+    """
+
+    def record(self, kind, name, value):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class AggregatingExporter(Exporter):
+
+    """An exporter which aggregates the observations into histograms and
+    counters, for its `flush` to write out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = defaultdict(int)
+
+    def record(self, kind, name, value):
+        with self._lock:
+            if kind == COUNTER:
+                self.counters[name] += value
+            else:
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram(kind)
+                self.histograms[name].add(value)
+
+
+class StatsDExporter(Exporter):
+
+    """Sends each observation as it is made to the StatsD server at
+    METRICS_STATSD_HOST:METRICS_STATSD_PORT, which does the aggregation.
+
+    Durations are sent as timers (in milliseconds), sizes as histograms and
+    counters as counters, all named with METRICS_PREFIX.
+    """
+
+    types = {TIMING: 'ms', SIZE: 'h', COUNTER: 'c'}
+
+    def __init__(self):
+        self.address = (settings.METRICS_STATSD_HOST, settings.METRICS_STATSD_PORT)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, kind, name, value):
+        if kind == TIMING:
+            value = value * 1000
+        packet = '{}.{}:{:g}|{}'.format(settings.METRICS_PREFIX, name, value, self.types[kind])
+        try:
+            self.socket.sendto(packet.encode('utf-8'), self.address)
+        except socket.error:
+            # metrics are not worth failing a task for
+            logger.debug('failed to send metric to statsd: %s', packet, exc_info=True)
+
+
+class PrometheusExporter(AggregatingExporter):
+
+    """Writes the histograms and counters recorded by the process since it
+    started to a file in METRICS_PROMETHEUS_DIR, in the Prometheus text
+    format, for the node exporter's textfile collector to pick up.
+
+    Each process writes its own file (named after its pid), replacing it
+    atomically on every flush.
+    """
+
+    suffixes = {TIMING: '_seconds', SIZE: '_bytes'}
+
+    def _name(self, name):
+        return re.sub(r'[^a-zA-Z0-9_]', '_', '{}_{}'.format(settings.METRICS_PREFIX, name))
+
+    def render(self):
+        """
+        Returns the recorded metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            for name, histogram in sorted(six.iteritems(self.histograms)):
+                name = self._name(name) + self.suffixes[histogram.kind]
+                lines.append('# TYPE {} histogram'.format(name))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(
+                        name, '+Inf' if bound == float('inf') else '{:g}'.format(bound), cumulative))
+                lines.append('{}_sum {:g}'.format(name, histogram.sum))
+                lines.append('{}_count {}'.format(name, histogram.count))
+            for name, value in sorted(six.iteritems(self.counters)):
+                name = self._name(name) + '_total'
+                lines.append('# TYPE {} counter'.format(name))
+                lines.append('{} {}'.format(name, value))
+        return ''.join(line + '\n' for line in lines)
+
+    def flush(self):
+        path = os.path.join(settings.METRICS_PROMETHEUS_DIR, '{}-{}.prom'.format(settings.METRICS_PREFIX, os.getpid()))
+        tmp_path = path + '.tmp'
+        with io.open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.rename(tmp_path, path)
+
+
+class LogExporter(AggregatingExporter):
+
+    """Logs a summary of each histogram and counter recorded since the last
+    flush.
+    """
+
+    def flush(self):
+        with self._lock:
+            histograms, counters = self.histograms, self.counters
+        self.reset()
+        for name, histogram in sorted(six.iteritems(histograms)):
+            logger.info('metric %s: count=%d sum=%.3f mean=%.3f max=%.3f',
+                        name, histogram.count, histogram.sum, histogram.sum / histogram.count, histogram.max)
+        for name, value in sorted(six.iteritems(counters)):
+            logger.info('metric %s: %d', name, value)
+
+
+EXPORTERS = {
+    'statsd': StatsDExporter,
+    'prometheus': PrometheusExporter,
+    'log': LogExporter,
+}
+
+_exporters = {}
+_exporters_lock = threading.Lock()
+
+
+def _get_exporters():
+    """
+    Returns the exporters named in METRICS_EXPORTERS (either names in
+    EXPORTERS or dotted paths to Exporter classes), created once per process.
+    """
+    names = settings.METRICS_EXPORTERS
+    if not names:
+        return ()
+    key = tuple(names)
+    exporters = _exporters.get(key)
+    if exporters is None:
+        with _exporters_lock:
+            exporters = _exporters.get(key)
+            if exporters is None:
+                exporters = _exporters[key] = tuple(
+                    (EXPORTERS[name] if name in EXPORTERS else import_string(name))() for name in names
+                )
+    return exporters
+
+
+def enabled():
+    """
+    Returns whether metrics are being recorded, for callers to skip the work
+    of measuring something when they aren't.
+    """
+    return bool(settings.METRICS_EXPORTERS)
+
+
+def _record(kind, name, value):
+    for exporter in _get_exporters():
+        exporter.record(kind, name, value)
+
+
+def timing(name, seconds):
+    """
+    Records a duration, in seconds.
+    """
+    if settings.METRICS_EXPORTERS:
+        _record(TIMING, name, seconds)
+
+
+def size(name, nbytes):
+    """
+    Records a size, in bytes.
+    """
+    if settings.METRICS_EXPORTERS:
+        _record(SIZE, name, nbytes)
+
+
+def incr(name, count=1):
+    """
+    Increments a counter.
+    """
+    if settings.METRICS_EXPORTERS:
+        _record(COUNTER, name, count)
+
+
+class _Timer(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timing(self.name, time.time() - self.start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    """
+    Returns a context manager which records how long its block takes.
+
+    >>> with timer('example'):
+    ...     pass
+    """
+    if settings.METRICS_EXPORTERS:
+        return _Timer(name)
+    return _null_timer
+
+
+def flush():
+    """
+    Has each exporter write out what it has aggregated. Failures are logged
+    rather than raised.
+    """
+    for exporter in _get_exporters():
+        try:
+            exporter.flush()
+        except Exception:
+            logger.exception('failed to flush metrics exporter %r', exporter)
@@ -4,8 +4,13 @@ Database models for notifier.
 from __future__ import absolute_import
 from __future__ import unicode_literals
 from datetime import datetime, timedelta
+import json
 
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+
+from notifier.user import compact_users, expand_users
 
 
 class ForumDigestTask(models.Model):
@@ -28,3 +33,100 @@ class ForumDigestTask(models.Model):
         """
         last_keep_dt = datetime.utcnow() - timedelta(days=day_limit)
         cls.objects.filter(created__lt=last_keep_dt).delete()
+
+
+class ForumDigestTaskSummary(models.Model):
+    """
+    ForumDigestTaskSummary model keeps running totals of what a forum digest task has done, updated once for
+    each batch of users.
+
+    It is a table of its own, rather than more columns of ForumDigestTask, so that existing databases only need
+    the new table created.
+    """
+    task = models.OneToOneField(ForumDigestTask, on_delete=models.CASCADE, primary_key=True, related_name='summary')
+    batches_dispatched = models.PositiveIntegerField(default=0, help_text="Number of batches of users queued.")
+    batches_completed = models.PositiveIntegerField(default=0, help_text="Number of batches of users done.")
+    users = models.PositiveIntegerField(default=0, help_text="Number of users in the completed batches.")
+    digests = models.PositiveIntegerField(default=0, help_text="Number of digests rendered.")
+    emails_sent = models.PositiveIntegerField(
+        default=0, help_text="Number of digests sent (not counting those still in the outbox).")
+    retries = models.PositiveIntegerField(default=0, help_text="Number of batch retries.")
+    first_send = models.DateTimeField(null=True, help_text="Time at which the first batch was sent.")
+    last_send = models.DateTimeField(null=True, help_text="Time at which the last batch was sent.")
+
+    @classmethod
+    def _update(cls, from_dt, to_dt, **kwargs):
+        # a single query, which does nothing for runs without a task (such as
+        # those of the forums_digest command)
+        cls.objects.filter(task__from_dt=from_dt, task__to_dt=to_dt).update(**kwargs)
+
+    @classmethod
+    def record_dispatched(cls, from_dt, to_dt, batches):
+        """
+        Adds `batches` to the batches dispatched by the task for the time slice.
+        """
+        cls._update(from_dt, to_dt, batches_dispatched=F('batches_dispatched') + batches)
+
+    @classmethod
+    def record_retry(cls, from_dt, to_dt):
+        """
+        Counts a retry of one of the task's batches.
+        """
+        cls._update(from_dt, to_dt, retries=F('retries') + 1)
+
+    @classmethod
+    def record_completed(cls, from_dt, to_dt, users, digests, emails_sent, send_dt=None):
+        """
+        Adds a completed batch of the task for the time slice, which sent its
+        emails at `send_dt` (if it sent any).
+        """
+        cls._update(
+            from_dt, to_dt,
+            batches_completed=F('batches_completed') + 1,
+            users=F('users') + users,
+            digests=F('digests') + digests,
+            emails_sent=F('emails_sent') + emails_sent,
+            **cls._send_times(send_dt)
+        )
+
+    @classmethod
+    def record_sent(cls, from_dt, to_dt, emails_sent, send_dt):
+        """
+        Adds emails of the task for the time slice that were sent from the
+        outbox at `send_dt`.
+        """
+        cls._update(from_dt, to_dt, emails_sent=F('emails_sent') + emails_sent, **cls._send_times(send_dt))
+
+    @staticmethod
+    def _send_times(send_dt):
+        if send_dt is None:
+            return {}
+        return {'first_send': Coalesce(F('first_send'), Value(send_dt, output_field=models.DateTimeField())), 'last_send': send_dt}
+
+
+class SubscriberBatch(models.Model):
+    """
+    SubscriberBatch model stages a batch of the digest subscribers of a forum digest task, so that the celery task
+    which sends the batch's digests only needs to be given the batch's id, and so that the batches not done yet can
+    be queued again without calling the user service.
+    """
+    task = models.ForeignKey(ForumDigestTask, on_delete=models.CASCADE, related_name='subscriber_batches')
+    number = models.PositiveIntegerField(help_text="Number of the batch in the forum digest task.")
+    users = models.TextField(help_text="JSON of the batch's users, in the form made by notifier.user.compact_users.")
+    created = models.DateTimeField(auto_now_add=True, help_text="Time at which the batch was staged.")
+
+    class Meta:
+        unique_together = (('task', 'number'),)
+
+    @classmethod
+    def stage(cls, task, number, users):
+        """
+        Returns an unsaved batch of the given user dicts, for bulk creation.
+        """
+        return cls(task=task, number=number, users=json.dumps(compact_users(users), separators=(',', ':')))
+
+    def get_users(self):
+        """
+        Returns the batch's user dicts.
+        """
+        return expand_users(json.loads(self.users))
@@ -0,0 +1,153 @@
+"""
+An on-disk outbox (a Maildir) for rendered digest emails, so that rendering
+and delivery can run, fail and be retried independently of one another.
+
+Messages are spooled into the "new" directory. A drain claims them by moving
+them into "cur", and deletes them once they have been sent, or moves them
+back into "new" to be tried again later.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import email
+from email.message import Message
+import logging
+import mailbox
+import os
+import time
+
+from dateutil.parser import parse as date_parse
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.message import MIMEMixin
+from django.utils.encoding import force_bytes
+
+logger = logging.getLogger(__name__)
+
+# the envelope isn't necessarily in the message headers (e.g. bcc), so it is
+# stored in these headers, which are removed again before sending.
+ENVELOPE_FROM_HEADER = 'X-Outbox-From'
+ENVELOPE_TO_HEADER = 'X-Outbox-To'
+# likewise, the time slice of the digest, so that its task's summary can count
+# it once it has been sent.
+TIME_SLICE_HEADER = 'X-Outbox-Time-Slice'
+
+_message_from_bytes = getattr(email, 'message_from_bytes', email.message_from_string)
+
+
+class SpooledMIME(MIMEMixin, Message):
+    """
+    A parsed message that can be serialized the same way Django's own MIME
+    classes are.
+    """
+
+
+class SpooledMessage(EmailMessage):
+
+    """An email message read back from the outbox, which sends the message as
+    it was built when it was spooled.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            mime = _message_from_bytes(f.read(), _class=SpooledMIME)
+        from_email = mime[ENVELOPE_FROM_HEADER]
+        to = mime.get_all(ENVELOPE_TO_HEADER, [])
+        time_slice = mime[TIME_SLICE_HEADER]
+        del mime[ENVELOPE_FROM_HEADER]
+        del mime[ENVELOPE_TO_HEADER]
+        del mime[TIME_SLICE_HEADER]
+        super(SpooledMessage, self).__init__(from_email=from_email, to=to)
+        self.path = path
+        # the (from_dt, to_dt) the message was spooled for, if any
+        self.time_slice = tuple(date_parse(dt) for dt in time_slice.split()) if time_slice else None
+        self._mime = mime
+
+    def message(self):
+        return self._mime
+
+
+def _maildir():
+    maildir = mailbox.Maildir(settings.EMAIL_OUTBOX_DIR, factory=None, create=True)
+    # Maildir only sets up its subdirectories when it creates the top one.
+    for name in ('tmp', 'new', 'cur'):
+        path = os.path.join(settings.EMAIL_OUTBOX_DIR, name)
+        if not os.path.isdir(path):
+            os.mkdir(path)
+    return maildir
+
+
+def _subdirs():
+    _maildir()
+    return os.path.join(settings.EMAIL_OUTBOX_DIR, 'new'), os.path.join(settings.EMAIL_OUTBOX_DIR, 'cur')
+
+
+def spool(email_messages, from_dt=None, to_dt=None):
+    """
+    Writes the messages to the outbox, noting the time slice of the digests
+    they are for, if given.
+    """
+    maildir = _maildir()
+    for msg in email_messages:
+        mime = msg.message()
+        mime[ENVELOPE_FROM_HEADER] = msg.from_email
+        for recipient in msg.recipients():
+            mime[ENVELOPE_TO_HEADER] = recipient
+        if from_dt is not None and to_dt is not None:
+            mime[TIME_SLICE_HEADER] = '{} {}'.format(from_dt.isoformat(), to_dt.isoformat())
+        # on py2, as_bytes() is as_string(), which can return unicode
+        maildir.add(force_bytes(mime.as_bytes()))
+    logger.info('spooled %d messages to outbox %s', len(email_messages), settings.EMAIL_OUTBOX_DIR)
+
+
+def claim(limit):
+    """
+    Returns up to `limit` messages from the outbox, which no other drain
+    will claim until they are requeued.
+    """
+    new_dir, cur_dir = _subdirs()
+    claimed = []
+    for name in sorted(os.listdir(new_dir)):
+        if len(claimed) >= limit:
+            break
+        path = os.path.join(cur_dir, name)
+        try:
+            os.rename(os.path.join(new_dir, name), path)
+        except OSError:
+            # claimed by another drain in the meantime.
+            continue
+        # the modification time marks when the message was claimed
+        os.utime(path, None)
+        claimed.append(SpooledMessage(path))
+    return claimed
+
+
+def delete(msg):
+    """
+    Removes a claimed message from the outbox.
+    """
+    os.remove(msg.path)
+
+
+def requeue(msg):
+    """
+    Puts a claimed message back into the outbox to be sent later.
+    """
+    new_dir, cur_dir = _subdirs()
+    os.rename(msg.path, os.path.join(new_dir, os.path.basename(msg.path)))
+
+
+def requeue_stale(max_age):
+    """
+    Puts messages back into the outbox if they were claimed more than
+    `max_age` seconds ago, e.g. by a drain whose worker died.
+    """
+    new_dir, cur_dir = _subdirs()
+    cutoff = time.time() - max_age
+    for name in os.listdir(cur_dir):
+        path = os.path.join(cur_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.rename(path, os.path.join(new_dir, name))
+                logger.warn('requeued stale outbox message %s', name)
+        except OSError:
+            continue
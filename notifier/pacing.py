@@ -0,0 +1,183 @@
+"""
+Paced dispatch of digest batches.
+
+Rather than queueing every batch as fast as the user service can be paged,
+do_forums_digests can spread the batches of a run over a window of
+FORUM_DIGEST_TASK_PACING_WINDOW seconds, at FORUM_DIGEST_TASK_PACING_RATE
+batches a minute: each batch is given a jittered due time in its slot, and is
+queued right away with a countdown to it, so that the dispatcher itself never
+waits. Workers hold on to the countdown (ETA) messages until they are due.
+
+Independently of pacing, dispatch can be held back while workers are behind:
+with FORUM_DIGEST_TASK_HIGH_WATER set, the number of outstanding batches is
+checked before each page of users is fetched and, once it reaches the high
+water mark, dispatch pauses until it is down to FORUM_DIGEST_TASK_LOW_WATER.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import logging
+import random
+import time
+
+import celery
+from django.conf import settings
+
+from notifier import metrics, tracing
+
+logger = logging.getLogger(__name__)
+
+
+class Pacer(object):
+
+    """Schedules the batches of a run. If the rate is too low to dispatch
+    every batch within the window, the batches left when it ends are queued
+    at once; if dispatch falls behind schedule (e.g. the user service is
+    slow), the schedule slips rather than the batches being rushed to catch
+    up.
+    """
+
+    def __init__(self, window, rate, clock=time.time):
+        self.window = window
+        self.interval = 60.0 / rate
+        self.clock = clock
+        self.start = clock()
+        self.next_due = self.start
+        self.last_due = self.start
+        self.overran = False
+
+    def countdown(self):
+        """
+        Returns the countdown (in seconds) to queue the next batch with.
+
+        >>> now = [0.0]
+        >>> pacer = Pacer(600, 60, clock=lambda: now[0])
+        >>> countdowns = [pacer.countdown() for _ in range(10)]
+        >>> all(i <= c <= i + 1 for i, c in enumerate(countdowns))
+        True
+        >>> now[0] = 601
+        >>> pacer.countdown(), pacer.overran
+        (0, True)
+        """
+        now = self.clock()
+        if max(self.next_due, now) - self.start >= self.window:
+            if not self.overran:
+                logger.warning('pacing window of %ss ended before the last batch was due', self.window)
+                self.overran = True
+            return 0
+        # slip the schedule if dispatch is behind it
+        slot = max(self.next_due, now)
+        self.next_due = slot + self.interval
+        due = slot + random.uniform(0, self.interval)
+        self.last_due = max(self.last_due, due)
+        return due - now
+
+
+class Backpressure(object):
+
+    """Pauses dispatch while too many batches are outstanding, as counted by
+    the `depth` callable. A pause ends when the depth is down to the low
+    water mark, or after `max_pause` seconds (in case the workers are down).
+    """
+
+    def __init__(self, depth, high_water, low_water, poll, max_pause, clock=time.time, sleep=time.sleep):
+        self.depth = depth
+        self.high_water = high_water
+        self.low_water = low_water
+        self.poll = poll
+        self.max_pause = max_pause
+        self.clock = clock
+        self.sleep = sleep
+        self.paused = 0.0
+        self.pauses = 0
+
+    def wait(self):
+        """
+        Pauses if the depth has reached the high water mark, and returns how
+        long for (in seconds).
+
+        >>> depths = [12, 9, 6, 4, 3]
+        >>> now = [0.0]
+        >>> def sleep(seconds):
+        ...     now[0] += seconds
+        >>> backpressure = Backpressure(lambda: depths.pop(0), 10, 5, 2, 60, clock=lambda: now[0], sleep=sleep)
+        >>> backpressure.wait(), backpressure.wait(), depths
+        (6.0, 0, [])
+        """
+        depth = self.depth()
+        if depth < self.high_water:
+            return 0
+        start = self.clock()
+        logger.info('pausing dispatch: %d batches outstanding', depth)
+        with tracing.span('backpressure', depth=depth) as pause:
+            while depth > self.low_water:
+                if self.clock() - start >= self.max_pause:
+                    logger.warning('resuming dispatch after %ss with %d batches outstanding', self.max_pause, depth)
+                    break
+                self.sleep(self.poll)
+                depth = self.depth()
+            paused = self.clock() - start
+            pause.tags['paused'] = round(paused, 3)
+        self.paused += paused
+        self.pauses += 1
+        metrics.timing('dispatch.backpressure_pause', paused)
+        return paused
+
+
+def queue_depth(queue=None):
+    """
+    Returns the number of messages waiting in a broker queue (by default,
+    DEFAULT_PRIORITY_QUEUE).
+    """
+    with celery.current_app.connection_or_acquire() as conn:
+        _, message_count, _ = conn.default_channel.queue_declare(
+            queue=queue or settings.DEFAULT_PRIORITY_QUEUE, passive=True)
+    return message_count
+
+
+def backpressure(task):
+    """
+    Returns a Backpressure for the run of a ForumDigestTask as configured in
+    settings, or None if it is off. Batches staged in the database (see
+    FORUM_DIGEST_TASK_STAGE_USERS) are deleted once sent, so they are counted
+    there; otherwise the depth of the broker queue is used.
+    """
+    if not settings.FORUM_DIGEST_TASK_HIGH_WATER:
+        return None
+    if settings.FORUM_DIGEST_TASK_STAGE_USERS:
+        depth = task.subscriber_batches.count
+    else:
+        depth = queue_depth
+    return Backpressure(
+        depth,
+        settings.FORUM_DIGEST_TASK_HIGH_WATER,
+        settings.FORUM_DIGEST_TASK_LOW_WATER,
+        settings.FORUM_DIGEST_TASK_BACKPRESSURE_POLL,
+        settings.FORUM_DIGEST_TASK_BACKPRESSURE_MAX_PAUSE,
+    )
+
+
+def pacer():
+    """
+    Returns a Pacer for a run as configured in settings, or None if pacing is
+    off.
+    """
+    if not settings.FORUM_DIGEST_TASK_PACING_WINDOW:
+        return None
+    return Pacer(
+        settings.FORUM_DIGEST_TASK_PACING_WINDOW,
+        settings.FORUM_DIGEST_TASK_PACING_RATE,
+    )
+
+
+def report(run_pacer, run_backpressure):
+    """
+    Logs and records how long a run's batches were spread over by its pacer
+    and how long dispatch was paused by backpressure, if either was on.
+    """
+    if run_pacer is not None:
+        spread = run_pacer.last_due - run_pacer.start
+        logger.info('paced %.1fs of batches in %.1fs', spread, run_pacer.clock() - run_pacer.start)
+        metrics.timing('dispatch.paced_spread', spread)
+    if run_backpressure is not None:
+        logger.info('dispatch was paused %d times for %.1fs in all', run_backpressure.pauses, run_backpressure.paused)
+        metrics.timing('dispatch.backpressure_paused', run_backpressure.paused)
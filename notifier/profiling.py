@@ -0,0 +1,90 @@
+"""
+Opt-in profiling of digest tasks.
+
+A profiled block is run under cProfile and, where available (python 3),
+tracemalloc, and the results are written to PROFILE_DIR as gzipped dumps:
+``<tag>.pstats.gz`` (uncompressed, it can be loaded with ``pstats.Stats``)
+and ``<tag>.tracemalloc.gz`` (loaded with ``tracemalloc.Snapshot.load``).
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from contextlib import contextmanager
+import cProfile
+import gzip
+import logging
+import marshal
+import os
+import pickle
+import random
+import time
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def digest_tag(num_users, from_dt, to_dt):
+    """
+    Returns the tag of a profile of a digest batch, naming the time window,
+    the batch size, the process and the time at which it was made.
+
+    >>> from datetime import datetime
+    >>> digest_tag(5, datetime(2013, 1, 1), datetime(2013, 1, 2)).startswith(
+    ...     'digest-20130101T0000-20130102T0000-5users-')
+    True
+    """
+    return 'digest-{:%Y%m%dT%H%M}-{:%Y%m%dT%H%M}-{}users-{}-{}'.format(
+        from_dt, to_dt, num_users, os.getpid(), int(time.time() * 1000))
+
+
+def _write(path, data):
+    with gzip.open(path, 'wb') as f:
+        f.write(data)
+
+
+@contextmanager
+def profile(tag):
+    """
+    Profiles the block, and writes the dumps tagged with `tag`.
+    """
+    tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot() if tracing else None
+        if tracing:
+            tracemalloc.stop()
+        profiler.create_stats()
+        path = os.path.join(settings.PROFILE_DIR, tag)
+        try:
+            # the format of pstats dump files
+            _write(path + '.pstats.gz', marshal.dumps(profiler.stats))
+            if snapshot is not None:
+                # the format of tracemalloc snapshot dump files
+                _write(path + '.tracemalloc.gz', pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            logger.exception('failed to write profile %s', path)
+        else:
+            logger.info('wrote profile %s', path)
+
+
+@contextmanager
+def sampled(tag):
+    """
+    Profiles the block (see `profile`) for a PROFILE_SAMPLE_RATE fraction of
+    the calls, and just runs it otherwise.
+    """
+    if settings.PROFILE_SAMPLE_RATE and random.random() < settings.PROFILE_SAMPLE_RATE:
+        with profile(tag):
+            yield
+    else:
+        yield
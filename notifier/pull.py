@@ -11,6 +11,7 @@ from django.conf import settings
 import requests
 import six
 
+from notifier import metrics, tracing
 from notifier.digest import Digest, DigestCourse, DigestThread, DigestItem
 from six.moves import map
 
@@ -45,7 +46,8 @@ def process_cs_response(payload, user_info_by_id):
     objects for each user supplied in user_info_by_id.
     """
     for user_id, user_content in six.iteritems(payload):
-        digest = _build_digest(user_content, user_info_by_id[user_id])
+        with metrics.timer('digest.build'):
+            digest = _build_digest(user_content, user_info_by_id[user_id])
         if not digest.empty:
             yield user_id, digest
 
@@ -163,6 +165,11 @@ def generate_digest_content(users_by_id, from_dt, to_dt):
     }
 
     logger.info('calling comments service to pull digests for %d user(s)', len(users_by_id))
-    resp = _http_post(api_url, headers=headers, data=data)
+    with metrics.timer('comments_service.request'), \
+            tracing.span('comments_service.request', users=len(users_by_id)):
+        headers['traceparent'] = tracing.traceparent()
+        resp = _http_post(api_url, headers=headers, data=data)
+    if metrics.enabled():
+        metrics.size('comments_service.payload', len(resp.content))
 
     return process_cs_response(resp.json(), users_by_id)
@@ -6,6 +6,8 @@ import logging
 import os
 import platform
 
+from django.core.exceptions import ImproperlyConfigured
+
 here = lambda *x: join(abspath(dirname(__file__)), *x)
 PROJECT_ROOT = here('..')
 root = lambda *x: abspath(join(abspath(PROJECT_ROOT), *x))
@@ -88,6 +90,43 @@ EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS')
 
 # email settings independent of backend
 EMAIL_REWRITE_RECIPIENT = os.getenv('EMAIL_REWRITE_RECIPIENT')
+# number of open email backend connections each worker process keeps for reuse
+# by later tasks (0 disables pooling, so that each task opens its own).
+EMAIL_CONNECTION_POOL_SIZE = int(os.getenv('EMAIL_CONNECTION_POOL_SIZE', 0))
+# number of connections over which each batch of messages is sent in parallel
+# (1 sends the whole batch through a single connection).  Only takes effect
+# with EMAIL_CONNECTION_POOL_SIZE set, so that the extra connections are reused
+# rather than opened anew for every batch.
+EMAIL_SEND_CONCURRENCY = int(os.getenv('EMAIL_SEND_CONCURRENCY', 1))
+# maximum number of messages per second a worker process sends (0 for no limit).
+EMAIL_SEND_RATE = float(os.getenv('EMAIL_SEND_RATE', 0))
+# when the provider reports that the maximum send rate has been exceeded, the
+# unsent messages are retried after a pause, starting at EMAIL_THROTTLE_BACKOFF
+# seconds and doubling up to EMAIL_THROTTLE_MAX_BACKOFF, until
+# EMAIL_THROTTLE_DEADLINE seconds after the send started; meanwhile the worker
+# process sends at EMAIL_THROTTLE_RATE_FACTOR times its previous rate, for
+# EMAIL_THROTTLE_COOLDOWN seconds after the last time it was throttled.
+EMAIL_THROTTLE_BACKOFF = float(os.getenv('EMAIL_THROTTLE_BACKOFF', 1))
+EMAIL_THROTTLE_MAX_BACKOFF = float(os.getenv('EMAIL_THROTTLE_MAX_BACKOFF', 60))
+EMAIL_THROTTLE_DEADLINE = float(os.getenv('EMAIL_THROTTLE_DEADLINE', 600))
+EMAIL_THROTTLE_RATE_FACTOR = 0.5
+EMAIL_THROTTLE_COOLDOWN = 300
+# fraction of sent messages for which a log line with the recipients,
+# Message-ID and size is written (every batch is logged regardless).
+EMAIL_LOG_SAMPLE_RATE = float(os.getenv('EMAIL_LOG_SAMPLE_RATE', 1))
+# directory of an outbox (a Maildir) into which generate_and_send_digests spools
+# rendered messages for the drain_outbox task to send, instead of sending them
+# itself (unset to send them right away).
+EMAIL_OUTBOX_DIR = os.getenv('EMAIL_OUTBOX_DIR')
+# number of messages drain_outbox sends per batch
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', 50))
+# interval (in seconds) at which the scheduler triggers drain_outbox
+EMAIL_OUTBOX_DRAIN_INTERVAL = int(os.getenv('EMAIL_OUTBOX_DRAIN_INTERVAL', 60))
+# time (in seconds) after which messages claimed by a drain that has not
+# finished with them are put back into the outbox
+EMAIL_OUTBOX_CLAIM_TIMEOUT = int(os.getenv('EMAIL_OUTBOX_CLAIM_TIMEOUT', 3600))
+EMAIL_OUTBOX_MAX_RETRIES = 5
+EMAIL_OUTBOX_RETRY_DELAY = 60
 
 # LMS links, images, etc
 LMS_URL_BASE = os.getenv('LMS_URL_BASE', 'http://localhost:8000')
@@ -103,6 +142,29 @@ US_HTTP_AUTH_USER = os.getenv('US_HTTP_AUTH_USER', '')
 US_HTTP_AUTH_PASS = os.getenv('US_HTTP_AUTH_PASS', '')
 US_RESULT_PAGE_SIZE = int(os.getenv('US_RESULT_PAGE_SIZE', 40))
 
+# Metrics
+# comma-separated exporters to send task metrics to: any of 'statsd',
+# 'prometheus' and 'log', or dotted paths to notifier.metrics.Exporter
+# subclasses (empty to record no metrics).
+METRICS_EXPORTERS = [name for name in os.getenv('METRICS_EXPORTERS', '').split(',') if name]
+METRICS_PREFIX = os.getenv('METRICS_PREFIX', 'notifier')
+METRICS_STATSD_HOST = os.getenv('METRICS_STATSD_HOST', 'localhost')
+METRICS_STATSD_PORT = int(os.getenv('METRICS_STATSD_PORT', 8125))
+# directory in which each worker process writes its metrics for the
+# prometheus node exporter's textfile collector
+METRICS_PROMETHEUS_DIR = os.getenv('METRICS_PROMETHEUS_DIR', '.')
+
+# Profiling
+# fraction of generate_and_send_digests tasks to profile (0 to profile none),
+# writing the profiles to PROFILE_DIR (see notifier.profiling).
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', '.')
+
+# Tracing
+# file to which the spans of forum digest runs are appended, as JSON lines
+# (unset to not export spans; trace ids are logged regardless).
+TRACE_SPANS_FILE = os.getenv('TRACE_SPANS_FILE')
+
 # Logging
 LOG_FILE = os.getenv('LOG_FILE')
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
@@ -124,22 +186,58 @@ FORUM_DIGEST_TASK_RETRY_DELAY = 300
 FORUM_DIGEST_TASK_INTERVAL = int(os.getenv('FORUM_DIGEST_TASK_INTERVAL', 1440))
 # number of days to keep forum digest task entries in the database before they are deleted
 FORUM_DIGEST_TASK_GC_DAYS = int(os.getenv('FORUM_DIGEST_TASK_GC_DAYS', 30))
+# send generate_and_send_digests only the user fields it uses, in a compact
+# form (see notifier.user.compact_users), instead of whole user dicts
+FORUM_DIGEST_TASK_COMPACT_PAYLOAD = bool(os.getenv('FORUM_DIGEST_TASK_COMPACT_PAYLOAD', ''))
+# stage each batch of subscribers in the database and send its task only the
+# batch's id (see notifier.models.SubscriberBatch)
+FORUM_DIGEST_TASK_STAGE_USERS = bool(os.getenv('FORUM_DIGEST_TASK_STAGE_USERS', ''))
+# spread the dispatch of a run's digest batches over this many seconds (see
+# notifier.pacing); 0 to dispatch them as fast as users are fetched.  Paced
+# batches are queued with a countdown, so workers hold them for up to this long
+FORUM_DIGEST_TASK_PACING_WINDOW = int(os.getenv('FORUM_DIGEST_TASK_PACING_WINDOW', 0))
+# number of digest batches to dispatch per minute while pacing
+FORUM_DIGEST_TASK_PACING_RATE = float(os.getenv('FORUM_DIGEST_TASK_PACING_RATE', 60))
+# send digests in this many delivery buckets spread evenly over each
+# FORUM_DIGEST_TASK_INTERVAL, rather than to every subscriber at once; must be
+# a factor of FORUM_DIGEST_TASK_INTERVAL, with buckets that divide an hour or
+# are a whole number of hours that divides a day (see bucket_cron_schedule)
+FORUM_DIGEST_TASK_BUCKETS = int(os.getenv('FORUM_DIGEST_TASK_BUCKETS', 1))
+# how subscribers are assigned to delivery buckets: 'hash' (of the user id) or
+# 'time_zone' (see notifier.user.get_digest_bucket)
+FORUM_DIGEST_TASK_BUCKET_BY = os.getenv('FORUM_DIGEST_TASK_BUCKET_BY', 'hash')
+# pause the dispatch of digest batches while this many are outstanding (see
+# notifier.pacing); 0 for no limit
+FORUM_DIGEST_TASK_HIGH_WATER = int(os.getenv('FORUM_DIGEST_TASK_HIGH_WATER', 0))
+# resume paused dispatch once no more than this many batches are outstanding
+FORUM_DIGEST_TASK_LOW_WATER = int(os.getenv('FORUM_DIGEST_TASK_LOW_WATER', FORUM_DIGEST_TASK_HIGH_WATER // 2))
+# seconds between checks of the outstanding batches while dispatch is paused
+FORUM_DIGEST_TASK_BACKPRESSURE_POLL = int(os.getenv('FORUM_DIGEST_TASK_BACKPRESSURE_POLL', 10))
+# resume paused dispatch after this many seconds regardless
+FORUM_DIGEST_TASK_BACKPRESSURE_MAX_PAUSE = int(os.getenv('FORUM_DIGEST_TASK_BACKPRESSURE_MAX_PAUSE', 3600))
+# serializer of generate_and_send_digests messages (e.g. 'json', or 'msgpack'
+# with msgpack-python installed; unset for CELERY_TASK_SERIALIZER)
+FORUM_DIGEST_TASK_SERIALIZER = os.getenv('FORUM_DIGEST_TASK_SERIALIZER')
 
 
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'filters': {
+        'trace': {
+            '()': 'notifier.tracing.TraceLogFilter',
+        },
     },
     'formatters': {
         'default': {
-            'format': '%(asctime)s [%(levelname)s] [service_name={}] [%(module)s] %(message)s'.format(SERVICE_NAME)
+            'format': ('%(asctime)s [%(levelname)s] [service_name={}] [%(module)s] '
+                       '[trace=%(trace_id)s span=%(span_id)s] %(message)s').format(SERVICE_NAME)
         },
         'rsyslog': {
             'format': ("[service_variant={service_variant}]"
                        "[%(name)s][env:{logging_env}] %(levelname)s "
                        "[{hostname} %(process)d] [%(filename)s:%(lineno)d] "
-                       "- %(message)s").format(
+                       "[trace=%(trace_id)s span=%(span_id)s] - %(message)s").format(
                            service_variant=SERVICE_NAME, 
                            logging_env=NOTIFIER_ENV.lower(), 
                            hostname=platform.node().split(".")[0])
@@ -149,7 +247,8 @@ LOGGING = {
         'default': {
             'level': 'DEBUG',
             'class': 'logging.StreamHandler',
-            'formatter': 'default'
+            'formatter': 'default',
+            'filters': ['trace'],
         },
     },
     'loggers': {
@@ -171,6 +270,7 @@ if RSYSLOG_ENABLED:
             'class': 'logging.handlers.SysLogHandler',
             'address': '/dev/log',
             'formatter': 'rsyslog',
+            'filters': ['trace'],
             'facility': logging.handlers.SysLogHandler.LOG_LOCAL0,
         }
     })
@@ -182,6 +282,7 @@ if LOG_FILE:
             'level': 'DEBUG',
             'class': 'logging.FileHandler',
             'formatter': 'default',
+            'filters': ['trace'],
             'filename': LOG_FILE
         },
     })
@@ -190,8 +291,29 @@ if LOG_FILE:
 TIME_ZONE = 'UTC'  # what task workers see
 CELERY_TIMEZONE = 'UTC'  # what the main celery process sees 
 
+
+def bucket_cron_schedule(interval, buckets):
+    """
+    Returns the cron schedule on which to fire once per delivery bucket, when
+    `interval` minutes are split into `buckets` buckets. Cron fields restart
+    every hour and every day, so the length of a bucket must either divide an
+    hour, or be a whole number of hours that divides a day.
+    """
+    bucket_minutes, remainder = divmod(interval, buckets)
+    if remainder == 0 and 60 % bucket_minutes == 0:
+        return {'minute': '*/{}'.format(bucket_minutes)}
+    if remainder == 0 and bucket_minutes % 60 == 0 and 1440 % bucket_minutes == 0:
+        return {'hour': '*/{}'.format(bucket_minutes // 60), 'minute': 0}
+    raise ImproperlyConfigured(
+        'FORUM_DIGEST_TASK_BUCKETS={} splits FORUM_DIGEST_TASK_INTERVAL={} into delivery buckets that neither '
+        'divide an hour nor are a whole number of hours that divides a day'.format(buckets, interval))
+
+
 # set up schedule for forum digest job
-if FORUM_DIGEST_TASK_INTERVAL==1440:
+if FORUM_DIGEST_TASK_BUCKETS > 1:
+    # fire once per delivery bucket
+    DIGEST_CRON_SCHEDULE = bucket_cron_schedule(FORUM_DIGEST_TASK_INTERVAL, FORUM_DIGEST_TASK_BUCKETS)
+elif FORUM_DIGEST_TASK_INTERVAL==1440:
     # in the production case, make the 24 hour cycle happen at a 
     # predetermined time of day (midnight UTC).
     DIGEST_CRON_SCHEDULE = {'hour': 0}
@@ -211,6 +333,9 @@ BROKER_CONNECTION_TIMEOUT = 1
 BROKER_HEARTBEAT = 10.0
 BROKER_HEARTBEAT_CHECKRATE = 2
 
+# compression of task messages ('zlib' or 'bzip2'; unset for none)
+CELERY_MESSAGE_COMPRESSION = os.getenv('CELERY_MESSAGE_COMPRESSION')
+
 # Each worker should only fetch one message at a time
 CELERYD_PREFETCH_MULTIPLIER = 1
 
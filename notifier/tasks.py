@@ -11,14 +11,20 @@ import requests
 
 from boto.ses.exceptions import SESMaxSendingRateExceededError
 import celery
+from dateutil.parser import parse as date_parse
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.db.models import Max
+import six
 
+from notifier import metrics, outbox, pacing, profiling, tracing
 from notifier.connection_wrapper import get_connection
 from notifier.digest import render_digest
-from notifier.models import ForumDigestTask
+from notifier.message import DigestMessageBuilder
+from notifier.models import ForumDigestTask, ForumDigestTaskSummary, SubscriberBatch
 from notifier.pull import generate_digest_content, CommentsServiceException
-from notifier.user import get_digest_subscribers, UserServiceException
+from notifier.user import (
+    compact_users, expand_users, get_digest_bucket, get_digest_subscribers, UserServiceException
+)
 
 logger = logging.getLogger(__name__)
 
@@ -27,48 +33,155 @@ DEFAULT_LANGUAGE = 'en'
 
 
 @celery.task(rate_limit=settings.FORUM_DIGEST_TASK_RATE_LIMIT,
-             max_retries=settings.FORUM_DIGEST_TASK_MAX_RETRIES)
-def generate_and_send_digests(users, from_dt, to_dt, language=None):
+             max_retries=settings.FORUM_DIGEST_TASK_MAX_RETRIES,
+             serializer=settings.FORUM_DIGEST_TASK_SERIALIZER)
+def generate_and_send_digests(users, from_dt, to_dt, language=None, trace_context=None):
     """
     This task generates and sends forum digest emails to multiple users in a
     single background operation.
 
     `users` is an iterable of dictionaries, as returned by the edx user_api
-    (required keys are "id", "name", "email", "preferences", and "course_info").
+    (required keys are "id", "name", "email", "preferences", and "course_info"),
+    or the compact form of a list of them made by compact_users.
 
-    `from_dt` and `to_dt` are datetime objects representing the start and end
+    `from_dt` and `to_dt` are datetime objects (or, from serializers which
+    don't support those, ISO 8601 strings) representing the start and end
     of the time window for which to generate a digest.
+
+    `trace_context` is the context of the span which dispatched the task (see
+    notifier.tracing), whose trace the task's spans join.
+
+    A PROFILE_SAMPLE_RATE fraction of the calls are profiled (see
+    notifier.profiling).
     """
+    if isinstance(users, dict):
+        users = expand_users(users)
+    if isinstance(from_dt, six.string_types):
+        from_dt, to_dt = date_parse(from_dt), date_parse(to_dt)
+    _send_digest_batch(generate_and_send_digests, users, from_dt, to_dt, language, trace_context)
+
+
+@celery.task(rate_limit=settings.FORUM_DIGEST_TASK_RATE_LIMIT,
+             max_retries=settings.FORUM_DIGEST_TASK_MAX_RETRIES,
+             serializer=settings.FORUM_DIGEST_TASK_SERIALIZER)
+def generate_and_send_staged_digests(run_id, batch_id, language=None, trace_context=None):
+    """
+    This task does what generate_and_send_digests does, for a batch of users
+    that do_forums_digests has staged in the SubscriberBatch table: `run_id`
+    is the id of the batch's ForumDigestTask and `batch_id` its number.
+
+    The batch is deleted once its digests have been sent, so that the batches
+    left are those still to be done (see forums_digest --resume).
+    """
+    try:
+        batch = SubscriberBatch.objects.select_related('task').get(task_id=run_id, number=batch_id)
+    except SubscriberBatch.DoesNotExist:
+        logger.warning("Staged batch already done; skipping: run_id=%s batch_id=%s", run_id, batch_id)
+        return
+    _send_digest_batch(
+        generate_and_send_staged_digests, batch.get_users(), batch.task.from_dt, batch.task.to_dt, language,
+        trace_context)
+    batch.delete()
+
+
+def _send_digest_batch(task, users, from_dt, to_dt, language, trace_context):
     settings.LANGUAGE_CODE = language or settings.LANGUAGE_CODE or DEFAULT_LANGUAGE
     users_by_id = dict((str(u['id']), u) for u in users)
+    with tracing.span('generate_and_send_digests', trace_context, users=len(users_by_id)), \
+            profiling.sampled(profiling.digest_tag(len(users_by_id), from_dt, to_dt)):
+        _generate_and_send_digests(task, users_by_id, from_dt, to_dt)
+
+
+def _generate_and_send_digests(task, users_by_id, from_dt, to_dt):
     msgs = []
+    # rendered thread blocks and whole digests, shared by all the digests in
+    # this batch (see render_digest)
+    fragment_cache = {}
+    merge_cache = {}
+    message_builder = DigestMessageBuilder(settings.FORUM_DIGEST_EMAIL_SUBJECT, settings.FORUM_DIGEST_EMAIL_SENDER)
     try:
         with closing(get_connection()) as cx:
             for user_id, digest in generate_digest_content(users_by_id, from_dt, to_dt):
                 user = users_by_id[user_id]
                 # format the digest
-                text, html = render_digest(
-                    user, digest, settings.FORUM_DIGEST_EMAIL_TITLE, settings.FORUM_DIGEST_EMAIL_DESCRIPTION)
+                with metrics.timer('digest.render'):
+                    text, html = render_digest(
+                        user, digest, settings.FORUM_DIGEST_EMAIL_TITLE, settings.FORUM_DIGEST_EMAIL_DESCRIPTION,
+                        fragment_cache=fragment_cache, merge_cache=merge_cache)
                 # send the message through our mailer
-                msg = EmailMultiAlternatives(
-                    settings.FORUM_DIGEST_EMAIL_SUBJECT,
-                    text,
-                    settings.FORUM_DIGEST_EMAIL_SENDER,
-                    [user['email']]
-                )
-                msg.attach_alternative(html, "text/html")
-                msgs.append(msg)
+                msgs.append(message_builder.build([user['email']], text, html))
+            metrics.incr('digest.users', len(users_by_id))
+            metrics.incr('digest.digests', len(msgs))
+            sent_count = 0
+            send_dt = None
             if msgs:
-                cx.send_messages(msgs)
+                logger.info(
+                    'rendered %d distinct digest(s) for %d user(s), dedup ratio: %.2f',
+                    len(merge_cache), len(msgs), 1 - float(len(merge_cache)) / len(msgs))
+                with tracing.span('send', messages=len(msgs)):
+                    if settings.EMAIL_OUTBOX_DIR:
+                        # leave delivery to drain_outbox
+                        outbox.spool(msgs, from_dt, to_dt)
+                    else:
+                        send_dt = datetime.utcnow()
+                        sent_count = cx.send_messages(msgs)
+            ForumDigestTaskSummary.record_completed(
+                from_dt, to_dt, len(users_by_id), len(msgs), sent_count, send_dt=send_dt)
             if settings.DEAD_MANS_SNITCH_URL:
                 requests.post(settings.DEAD_MANS_SNITCH_URL)
     except (CommentsServiceException, SESMaxSendingRateExceededError) as e:
         # only retry if no messages were successfully sent yet.
         if not any((getattr(msg, 'extra_headers', {}).get('status') == 200 for msg in msgs)):
-            raise generate_and_send_digests.retry(exc=e)
+            if task.request.retries < task.max_retries:
+                ForumDigestTaskSummary.record_retry(from_dt, to_dt)
+            raise task.retry(exc=e)
         else:
             # raise right away, since we don't support partial retry
             raise
+    finally:
+        metrics.flush()
+
+
+@celery.task(
+    bind=True,
+    max_retries=settings.EMAIL_OUTBOX_MAX_RETRIES,
+    default_retry_delay=settings.EMAIL_OUTBOX_RETRY_DELAY)
+def drain_outbox(self):
+    """
+    This task sends the messages that generate_and_send_digests has spooled to
+    the outbox, in batches of EMAIL_OUTBOX_BATCH_SIZE, until the outbox is
+    empty.
+
+    Messages that could not be sent are put back into the outbox, and the task
+    is retried. A message whose batch failed partway is kept as sent if the
+    connection marked it as such (see BackendWrapper._send_sequentially). Sent
+    messages are counted in the summary of the task they were spooled by.
+    """
+    outbox.requeue_stale(settings.EMAIL_OUTBOX_CLAIM_TIMEOUT)
+    try:
+        with closing(get_connection()) as cx:
+            while True:
+                msgs = outbox.claim(settings.EMAIL_OUTBOX_BATCH_SIZE)
+                if not msgs:
+                    break
+                send_dt = datetime.utcnow()
+                try:
+                    cx.send_messages(msgs)
+                finally:
+                    sent_by_slice = {}
+                    for msg in msgs:
+                        if msg.extra_headers.get('status') == 200:
+                            outbox.delete(msg)
+                            if msg.time_slice is not None:
+                                sent_by_slice[msg.time_slice] = sent_by_slice.get(msg.time_slice, 0) + 1
+                        else:
+                            outbox.requeue(msg)
+                    for (from_dt, to_dt), sent in sent_by_slice.items():
+                        ForumDigestTaskSummary.record_sent(from_dt, to_dt, sent, send_dt)
+    except Exception as e:
+        raise drain_outbox.retry(exc=e)
+    finally:
+        metrics.flush()
 
 
 def _time_slice(minutes, now=None):
@@ -111,28 +224,45 @@ def _time_slice(minutes, now=None):
     assert 1440 % minutes == 0
     now = now or datetime.utcnow()
     midnight = now.replace(hour=0, minute=0, second=0, microsecond=0) 
-    minutes_since_midnight = (now - midnight).seconds / 60
-    dt_end = midnight + timedelta(minutes=(minutes_since_midnight / minutes) * minutes)
+    minutes_since_midnight = (now - midnight).seconds // 60
+    dt_end = midnight + timedelta(minutes=(minutes_since_midnight // minutes) * minutes)
     dt_start = dt_end - timedelta(minutes=minutes)
     return (dt_start, dt_end)
 
+
+def _bucket_slice(minutes, num_buckets, now=None):
+    """
+    Returns the time slice of the specified length (in minutes) for the most
+    recently-due of `num_buckets` delivery buckets spread evenly over each
+    slice, as of the specified datetime (defaults to utcnow), along with the
+    bucket's index. Each bucket's slices are consecutive, just as with
+    `_time_slice`; they are offset from those of the first bucket.
+
+    >>> _bucket_slice(1440, 24, datetime(2013, 1, 1, 0, 0))
+    (datetime.datetime(2012, 12, 31, 0, 0), datetime.datetime(2013, 1, 1, 0, 0), 0)
+    >>> _bucket_slice(1440, 24, datetime(2013, 1, 1, 5, 30))
+    (datetime.datetime(2012, 12, 31, 5, 0), datetime.datetime(2013, 1, 1, 5, 0), 5)
+    >>> _bucket_slice(60, 4, datetime(2013, 1, 1, 1, 50))
+    (datetime.datetime(2013, 1, 1, 0, 45), datetime.datetime(2013, 1, 1, 1, 45), 3)
+    """
+    assert minutes % num_buckets == 0
+    step = minutes // num_buckets
+    _, dt_end = _time_slice(step, now)
+    midnight = dt_end.replace(hour=0, minute=0)
+    bucket = (dt_end - midnight).seconds // 60 // step % num_buckets
+    return (dt_end - timedelta(minutes=minutes), dt_end, bucket)
+
 @celery.task(
     bind=True,
     max_retries=settings.DAILY_TASK_MAX_RETRIES,
     default_retry_delay=settings.DAILY_TASK_RETRY_DELAY)
 def do_forums_digests(self):
 
-    def batch_digest_subscribers():
-        batch = []
-        for v in get_digest_subscribers():
-            batch.append(v)
-            if len(batch)==settings.FORUM_DIGEST_TASK_BATCH_SIZE:
-                yield batch
-                batch = []
-        if batch:
-            yield batch
-
-    from_dt, to_dt = _time_slice(settings.FORUM_DIGEST_TASK_INTERVAL)
+    if settings.FORUM_DIGEST_TASK_BUCKETS > 1:
+        from_dt, to_dt, bucket = _bucket_slice(settings.FORUM_DIGEST_TASK_INTERVAL, settings.FORUM_DIGEST_TASK_BUCKETS)
+    else:
+        from_dt, to_dt = _time_slice(settings.FORUM_DIGEST_TASK_INTERVAL)
+        bucket = None
 
     # Remove old tasks from the database so that the table doesn't keep growing forever.
     ForumDigestTask.prune_old_tasks(settings.FORUM_DIGEST_TASK_GC_DAYS)
@@ -144,6 +274,7 @@ def do_forums_digests(self):
             defaults={'node': platform.node()}
         )
         if created:
+            ForumDigestTaskSummary.objects.create(task=task)
             logger.info("Beginning forums digest task: from_dt=%s to_dt=%s", from_dt, to_dt)
         else:
             logger.info(
@@ -153,9 +284,127 @@ def do_forums_digests(self):
             return
     else:
         logger.info("Retrying forums digest task: from_dt=%s to_dt=%s", from_dt, to_dt)
+        task = ForumDigestTask.objects.get(from_dt=from_dt, to_dt=to_dt)
 
     try:
-        for user_batch in batch_digest_subscribers():
-            generate_and_send_digests.delay(user_batch, from_dt, to_dt, language=settings.LANGUAGE_CODE)
+        dispatch_digests(task, bucket, retries=self.request.retries)
     except UserServiceException as e:
         raise do_forums_digests.retry(exc=e)
+    finally:
+        metrics.flush()
+
+
+def dispatch_digests(task, bucket=None, retries=0):
+    """
+    Queues the digests of a ForumDigestTask's time slice, a batch of
+    subscribers (of the given delivery bucket only, if any) at a time, and
+    returns the number of batches queued. `retries` is the number of earlier
+    attempts, for the trace.
+    """
+
+    def before_page(page):
+        if staged:
+            _dispatch_staged_batches(staged, run_pacer)
+            del staged[:]
+        if run_backpressure is not None:
+            run_backpressure.wait()
+        pages.append(page)
+
+    def batch_digest_subscribers():
+        """
+        Yields (page, batch) pairs, where `page` is the user service page
+        that the first user of the batch came from.
+        """
+        batch = []
+        for v in get_digest_subscribers(before_page=before_page):
+            if bucket is not None and get_digest_bucket(
+                    v, settings.FORUM_DIGEST_TASK_BUCKETS, settings.FORUM_DIGEST_TASK_INTERVAL,
+                    by=settings.FORUM_DIGEST_TASK_BUCKET_BY) != bucket:
+                continue
+            if not batch:
+                page = pages[-1] if pages else None
+            batch.append(v)
+            if len(batch)==settings.FORUM_DIGEST_TASK_BATCH_SIZE:
+                yield page, batch
+                batch = []
+        if batch:
+            yield page, batch
+
+    from_dt, to_dt = task.from_dt, task.to_dt
+    batches = 0
+    run_pacer = pacing.pacer()
+    run_backpressure = pacing.backpressure(task)
+    # with FORUM_DIGEST_TASK_STAGE_USERS, batches are staged until the next
+    # page of users is fetched (or the last one is done), and numbered after
+    # any left by an earlier attempt
+    staged = []
+    pages = []
+    if settings.FORUM_DIGEST_TASK_STAGE_USERS:
+        first_number = (task.subscriber_batches.aggregate(n=Max('number'))['n'] or 0) + 1
+    try:
+        with tracing.span('do_forums_digests', from_dt=from_dt.isoformat(), to_dt=to_dt.isoformat(),
+                          bucket=bucket, retries=retries):
+            for page, user_batch in batch_digest_subscribers():
+                if settings.FORUM_DIGEST_TASK_STAGE_USERS:
+                    staged.append((batches, page, SubscriberBatch.stage(task, first_number + batches, user_batch)))
+                else:
+                    _dispatch_batch(batches, page, user_batch, from_dt, to_dt, run_pacer)
+                batches += 1
+            if staged:
+                _dispatch_staged_batches(staged, run_pacer)
+        pacing.report(run_pacer, run_backpressure)
+    finally:
+        # counted in a single update, rather than one per batch
+        ForumDigestTaskSummary.record_dispatched(from_dt, to_dt, batches)
+    return batches
+
+
+def _queue(task, args, kwargs, run_pacer):
+    """
+    Queues a digest task, with a countdown from `run_pacer` if it is not None.
+    """
+    if run_pacer is None:
+        task.delay(*args, **kwargs)
+        return
+    countdown = run_pacer.countdown()
+    tracing.current_span().tags['countdown'] = round(countdown, 3)
+    task.apply_async(args, kwargs, countdown=countdown)
+
+
+def _dispatch_batch(index, page, user_batch, from_dt, to_dt, run_pacer=None):
+    """
+    Queues generate_and_send_digests for a batch of users, whose first user
+    came from the given user service page.
+    """
+    with tracing.span('dispatch', batch=index, page=page):
+        if settings.FORUM_DIGEST_TASK_COMPACT_PAYLOAD:
+            user_batch = compact_users(user_batch)
+        _queue(
+            generate_and_send_digests, (user_batch, from_dt, to_dt),
+            {'language': settings.LANGUAGE_CODE, 'trace_context': tracing.current_context()}, run_pacer)
+
+
+def _dispatch_staged_batches(staged, run_pacer=None):
+    """
+    Saves the batches of a list of (index, page, SubscriberBatch) triples in
+    one query, then queues generate_and_send_staged_digests for each of them.
+    """
+    SubscriberBatch.objects.bulk_create([batch for _, _, batch in staged])
+    for index, page, batch in staged:
+        with tracing.span('dispatch', batch=index, page=page, staged=batch.number):
+            _queue(
+                generate_and_send_staged_digests, (batch.task_id, batch.number),
+                {'language': settings.LANGUAGE_CODE, 'trace_context': tracing.current_context()}, run_pacer)
+
+
+def resume_staged_batches(task):
+    """
+    Queues generate_and_send_staged_digests again for each batch of the
+    forum digest task that is still staged, and returns how many there were.
+    This is for runs cut short by a crash; batches still queued or running
+    will be sent twice.
+    """
+    numbers = list(task.subscriber_batches.order_by('number').values_list('number', flat=True))
+    for number in numbers:
+        generate_and_send_staged_digests.delay(task.pk, number, language=settings.LANGUAGE_CODE)
+    return len(numbers)
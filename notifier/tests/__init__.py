@@ -13,10 +13,24 @@ from notifier.tests import test_tasks
 from notifier.tests import test_user
 from notifier.tests import test_commands
 from notifier.tests import test_digest
+from notifier.tests import test_connection_wrapper
+from notifier.tests import test_outbox
+from notifier.tests import test_message
+from notifier.tests import test_backends
+from notifier.tests import test_metrics
+from notifier.tests import test_profiling
+from notifier.tests import test_tracing
+from notifier.tests import test_pacing
 
 # imports to pick up module doctests
+from notifier import benchmarks
 from notifier import digest
+from notifier import metrics
+from notifier import pacing
+from notifier import profiling
 from notifier import tasks
+from notifier import user
+from notifier.management.commands import backfill_digests
 
 
 def add_unit_tests(suite, module):
@@ -41,8 +55,40 @@ def suite():
 
     # user
     add_unit_tests(suite, test_user)
+    add_doc_tests(suite, user)
 
     # commands
     add_unit_tests(suite, test_commands)
+    add_doc_tests(suite, backfill_digests)
+
+    # connection wrapper
+    add_unit_tests(suite, test_connection_wrapper)
+
+    # outbox
+    add_unit_tests(suite, test_outbox)
+
+    # message
+    add_unit_tests(suite, test_message)
+
+    # backends
+    add_unit_tests(suite, test_backends)
+
+    # metrics
+    add_doc_tests(suite, metrics)
+    add_unit_tests(suite, test_metrics)
+
+    # profiling
+    add_doc_tests(suite, profiling)
+    add_unit_tests(suite, test_profiling)
+
+    # tracing
+    add_unit_tests(suite, test_tracing)
+
+    # pacing
+    add_doc_tests(suite, pacing)
+    add_unit_tests(suite, test_pacing)
+
+    # benchmarks
+    add_doc_tests(suite, benchmarks)
 
     return suite
@@ -0,0 +1,55 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from boto.ses.exceptions import SESMaxSendingRateExceededError
+from django.core.mail import EmailMessage
+from django.test import TestCase
+
+from notifier.backends import FakeSESBackend, fake_ses
+from six.moves import range
+
+
+def make_messages(n):
+    return [EmailMessage('subject', 'body', 'from@example.com', ['user%d@example.com' % i]) for i in range(n)]
+
+
+class FakeSESBackendTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        fake_ses.reset(max_send_rate=1000)
+        self.addCleanup(fake_ses.reset)
+
+    def test_send(self):
+        msgs = make_messages(5)
+        self.assertEqual(FakeSESBackend().send_messages(msgs), 5)
+        self.assertEqual(fake_ses.calls, 5)
+        self.assertEqual(
+            [sent['destinations'] for sent in fake_ses.sent],
+            [msg.recipients() for msg in msgs])
+        self.assertTrue(all(msg.extra_headers['status'] == 200 for msg in msgs))
+        self.assertEqual(
+            [msg.extra_headers['message_id'] for msg in msgs],
+            [sent['message_id'] for sent in fake_ses.sent])
+
+    def test_rejected(self):
+        fake_ses.reset(max_send_rate=1000, rejected=['user1@example.com'])
+        msgs = make_messages(3)
+        self.assertRaises(Exception, FakeSESBackend().send_messages, msgs)
+        self.assertEqual([msg.extra_headers.get('status') for msg in msgs], [200, 400, None])
+        self.assertEqual(len(fake_ses.sent), 1)
+
+    def test_rejected_fail_silently(self):
+        fake_ses.reset(max_send_rate=1000, rejected=['user1@example.com'])
+        self.assertEqual(FakeSESBackend(fail_silently=True).send_messages(make_messages(3)), 2)
+
+    def test_throttled(self):
+        fake_ses.reset(max_send_rate=2)
+        backend = FakeSESBackend()
+        backend._throttle = None
+        msgs = make_messages(3)
+        self.assertRaises(SESMaxSendingRateExceededError, backend.send_messages, msgs)
+        self.assertEqual([msg.extra_headers.get('status') for msg in msgs], [200, 200, 400])
+        self.assertEqual(len(fake_ses.sent), 2)
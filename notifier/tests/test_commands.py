@@ -3,15 +3,25 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 import datetime
+import io
 import json
 from os.path import dirname, join
+import shutil
+import tempfile
 
 from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 from django.test.utils import override_settings
-from mock import patch, Mock
+from mock import ANY, patch, Mock
+import six
+from six import StringIO
 
-from notifier.management.commands import forums_digest
+from notifier.digest import Digest, DigestCourse, DigestItem, DigestThread
+from notifier.management.commands import backfill_digests, forums_digest
+from notifier.models import ForumDigestTask, ForumDigestTaskSummary, SubscriberBatch
+from notifier.user import DIGEST_NOTIFICATION_PREFERENCE_KEY, UserServiceException
 
 class CommandsTestCase(TestCase):
 
@@ -23,3 +33,185 @@ class CommandsTestCase(TestCase):
                        BROKER_BACKEND='memory',)
     def test_forums_digest(self):
         pass
+
+    def test_forums_digest_report(self):
+        task = ForumDigestTask.objects.create(
+            from_dt=datetime.datetime(2013, 1, 2), to_dt=datetime.datetime(2013, 1, 3), node='node-1')
+        ForumDigestTask.objects.filter(pk=task.pk).update(created=datetime.datetime(2013, 1, 3))
+        ForumDigestTaskSummary.objects.create(
+            task=task, batches_dispatched=3, batches_completed=2, users=10, digests=8, emails_sent=8, retries=1,
+            first_send=datetime.datetime(2013, 1, 3, 0, 1), last_send=datetime.datetime(2013, 1, 3, 0, 2, 30))
+        ForumDigestTask.objects.create(
+            from_dt=datetime.datetime(2013, 1, 1), to_dt=datetime.datetime(2013, 1, 2), node='node-2')
+        stdout = StringIO()
+        call_command('forums_digest', report=True, stdout=stdout)
+        header, first, second = stdout.getvalue().splitlines()
+        self.assertEqual(first.split(), [
+            '2013-01-02', '00:00:00', '2013-01-03', '00:00:00', 'node-1', '3', '2', '10', '8', '8', '1',
+            '2013-01-03', '00:01:00', '2013-01-03', '00:02:30', '0:02:30'])
+        self.assertEqual(second.split()[:5], ['2013-01-01', '00:00:00', '2013-01-02', '00:00:00', 'node-2'])
+        self.assertEqual(second.split()[5:], ['-'] * 9)
+
+    def test_forums_digest_resume(self):
+        task = ForumDigestTask.objects.create(
+            from_dt=datetime.datetime(2013, 1, 2), to_dt=datetime.datetime(2013, 1, 3), node='node-1')
+        for number in (3, 5):
+            SubscriberBatch.stage(task, number, [{
+                'id': number, 'name': 'user', 'email': 'user@dummy.edu',
+                'preferences': {DIGEST_NOTIFICATION_PREFERENCE_KEY: 'pref'}, 'course_info': {},
+            }]).save()
+        stdout = StringIO()
+        with patch('notifier.tasks.generate_and_send_staged_digests') as t:
+            call_command('forums_digest', resume=True, to_datetime='2013-01-03T00:00:00', stdout=stdout)
+        self.assertEqual(t.delay.call_args_list, [
+            ((task.pk, 3), {'language': settings.LANGUAGE_CODE}),
+            ((task.pk, 5), {'language': settings.LANGUAGE_CODE}),
+        ])
+        self.assertEqual(stdout.getvalue().strip(), 'queued 2 staged batches')
+
+    def test_forums_digest_resume_not_scheduled(self):
+        self.assertRaises(
+            CommandError, call_command, 'forums_digest', resume=True, to_datetime='2013-01-03T00:00:00')
+
+    @override_settings(FORUM_DIGEST_TASK_INTERVAL=60)
+    def test_backfill_digests_missed_slices(self):
+        def hour(h):
+            return datetime.datetime(2013, 1, 1, h)
+
+        ForumDigestTask.objects.create(from_dt=hour(0), to_dt=hour(1), node='node-1')
+        # merged by an earlier backfill
+        ForumDigestTask.objects.create(from_dt=hour(2), to_dt=hour(4), node='node-1')
+        self.assertEqual(backfill_digests.missed_slices(hour(0), hour(6)), [
+            (hour(1), hour(2), None), (hour(4), hour(5), None), (hour(5), hour(6), None)])
+        self.assertEqual(backfill_digests.missed_slices(hour(2), hour(4)), [])
+
+    @override_settings(FORUM_DIGEST_TASK_INTERVAL=1440, FORUM_DIGEST_TASK_BUCKETS=4)
+    def test_backfill_digests_missed_slices_buckets(self):
+        def at(d, h):
+            return datetime.datetime(2013, 1, d, h)
+
+        ForumDigestTask.objects.create(from_dt=at(1, 6), to_dt=at(2, 6), node='node-1')
+        # the slice ending at at(2, 0) is before `since`, and bucket 1's is covered
+        self.assertEqual(backfill_digests.missed_slices(at(2, 0), at(2, 12)), [(at(1, 12), at(2, 12), 2)])
+
+    @override_settings(FORUM_DIGEST_TASK_INTERVAL=60, FORUM_DIGEST_TASK_BATCH_SIZE=10)
+    def test_backfill_digests(self):
+        now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+        def hour(h):
+            return now - datetime.timedelta(hours=h)
+
+        ForumDigestTask.objects.create(from_dt=hour(4), to_dt=hour(3), node='node-1')
+        stdout = StringIO()
+        users = [{'id': 1}, {'id': 2}]
+        with patch('notifier.tasks.get_digest_subscribers', side_effect=lambda before_page=None: iter(users)), \
+                patch('notifier.tasks.generate_and_send_digests') as t:
+            call_command('backfill_digests', since=hour(4).isoformat(), until=hour(0).isoformat(), merge=True,
+                         concurrency=1, stdout=stdout)
+        self.assertEqual(stdout.getvalue().splitlines(), ['{}  {}  -'.format(hour(3), hour(0))])
+        t.delay.assert_called_once_with(
+            [{'id': 1}, {'id': 2}], hour(3), hour(0), language=settings.LANGUAGE_CODE, trace_context=ANY)
+        summary = ForumDigestTask.objects.get(from_dt=hour(3), to_dt=hour(0)).summary
+        self.assertEqual(summary.batches_dispatched, 1)
+        # nothing is missed any more
+        stdout = StringIO()
+        call_command('backfill_digests', since=hour(4).isoformat(), until=hour(0).isoformat(), stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+
+    @override_settings(FORUM_DIGEST_TASK_INTERVAL=60, DAILY_TASK_MAX_RETRIES=1, DAILY_TASK_RETRY_DELAY=0)
+    def test_backfill_digests_concurrency(self):
+        now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+        def hour(h):
+            return now - datetime.timedelta(hours=h)
+
+        def dispatch(task, bucket, retries):
+            if task.to_dt == hour(0):
+                raise UserServiceException('could not connect!')
+            return 1
+
+        with patch('notifier.management.commands.backfill_digests.dispatch_digests', side_effect=dispatch) as d:
+            with self.assertRaises(CommandError) as e:
+                call_command('backfill_digests', since=hour(3).isoformat(), until=hour(0).isoformat(), concurrency=2,
+                             stdout=StringIO())
+        self.assertEqual(d.call_count, 4)
+        self.assertIn('failed to backfill 1 of 3 time slices', str(e.exception))
+
+    @override_settings(FORUM_DIGEST_TASK_INTERVAL=60)
+    def test_backfill_digests_dry_run(self):
+        now = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+        def hour(h):
+            return now - datetime.timedelta(hours=h)
+
+        stdout = StringIO()
+        call_command('backfill_digests', since=hour(2).isoformat(), until=hour(0).isoformat(), dry_run=True,
+                     stdout=stdout)
+        self.assertEqual(len(stdout.getvalue().splitlines()), 2)
+        self.assertFalse(ForumDigestTask.objects.exists())
+
+    def test_backfill_digests_too_old(self):
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=settings.FORUM_DIGEST_TASK_GC_DAYS + 1)
+        with self.assertRaises(CommandError) as e:
+            call_command('backfill_digests', since=since.isoformat())
+        self.assertIn('FORUM_DIGEST_TASK_GC_DAYS', str(e.exception))
+
+    def test_backfill_digests_no_since(self):
+        with self.assertRaises(CommandError) as e:
+            call_command('backfill_digests')
+        self.assertIn('--since is required', str(e.exception))
+
+    def test_digest_json_encoder(self):
+        dt = datetime.datetime(2013, 1, 1)
+        digest = Digest([
+            DigestCourse("org/num/run", [
+                DigestThread("0", "org/num/run", "commentable", "title", [DigestItem("body", "author", dt)])
+            ])
+        ])
+        encoded = json.loads(json.dumps(digest, cls=forums_digest.DigestJSONEncoder))
+        course = encoded["courses"][0]
+        self.assertEqual(course["course_id"], "org/num/run")
+        self.assertEqual(course["thread_count"], 1)
+        thread = course["threads"][0]
+        self.assertEqual(thread["title"], "title")
+        self.assertEqual(thread["dt"], "2013-01-01T00:00:00")
+        self.assertEqual(thread["items"], [{"body": "body", "author": "author", "dt": "2013-01-01T00:00:00"}])
+
+    def test_loadtest(self):
+        stdout = StringIO()
+        call_command('loadtest', users=6, courses=2, threads=2, batch_size=4, stdout=stdout)
+        results = {}
+        for line in stdout.getvalue().splitlines():
+            results[line[:50].strip()] = float(line[50:].split()[0])
+        self.assertEqual(results['users'], 6)
+        self.assertEqual(results['emails sent'], 6)
+        self.assertIn('elapsed', results)
+        # every stage of the pipeline is timed, with a send per batch of users
+        self.assertGreaterEqual(results['user service request (calls)'], 1)
+        self.assertGreaterEqual(results['comments service request (calls)'], 2)
+        self.assertEqual(results['render digest (calls)'], 6)
+        self.assertEqual(results['send batch (calls)'], 2)
+        self.assertFalse(ForumDigestTask.objects.exists())
+
+    def test_benchmark_baseline(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        baseline_file = join(tmp_dir, 'baseline.json')
+        call_command('benchmark', 'make_text_list', number=5, json_file=baseline_file, stdout=StringIO())
+        with io.open(baseline_file, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+        # within the threshold of a baseline of the same results
+        stdout = StringIO()
+        call_command('benchmark', 'make_text_list', number=5, baseline=baseline_file, threshold=1e6, stdout=stdout)
+        self.assertNotIn('REGRESSED', stdout.getvalue())
+
+        # and over it, once the baseline is made much faster
+        for result in baseline['results']:
+            result['value'] /= 1e6
+        with io.open(baseline_file, 'w', encoding='utf-8') as f:
+            f.write(six.text_type(json.dumps(baseline)))
+        stdout = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'make_text_list', number=5, baseline=baseline_file, stdout=stdout)
+        self.assertIn('REGRESSED', stdout.getvalue())
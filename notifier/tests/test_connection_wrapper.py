@@ -0,0 +1,300 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import time
+
+from boto.ses.exceptions import SESMaxSendingRateExceededError
+from django.core.mail import EmailMessage, EmailMultiAlternatives
+from django.core.mail.backends import locmem
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+
+from notifier.connection_wrapper import BackendWrapper, ConnectionPool, RateLimiter, _rate_limiter, get_connection
+
+
+def make_backend(noop_code=250):
+    backend = Mock()
+    backend.connection.noop.return_value = (noop_code, b'OK')
+    return backend
+
+
+@override_settings(EMAIL_CONNECTION_POOL_SIZE=1)
+class ConnectionPoolTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        self.pool = ConnectionPool()
+
+    def test_reuse(self):
+        backend = make_backend()
+        with patch('notifier.connection_wrapper.dj_get_connection', return_value=backend) as p:
+            self.assertIs(self.pool.acquire(), backend)
+            backend.open.assert_called_once_with()
+            self.pool.release(backend)
+            self.assertIs(self.pool.acquire(), backend)
+        self.assertEqual(p.call_count, 1)
+        self.assertEqual((self.pool.opened, self.pool.reused), (1, 1))
+        self.assertFalse(backend.close.called)
+
+    def test_dead_connection_replaced(self):
+        dead, fresh = make_backend(noop_code=421), make_backend()
+        self.pool.release(dead)
+        with patch('notifier.connection_wrapper.dj_get_connection', return_value=fresh):
+            self.assertIs(self.pool.acquire(), fresh)
+        dead.close.assert_called_once_with()
+        self.assertEqual((self.pool.opened, self.pool.reused), (1, 0))
+
+    def test_closed_connection_replaced(self):
+        closed, fresh = make_backend(), make_backend()
+        closed.connection = None
+        self.pool.release(closed)
+        with patch('notifier.connection_wrapper.dj_get_connection', return_value=fresh):
+            self.assertIs(self.pool.acquire(), fresh)
+
+    def test_release_when_full(self):
+        first, second = make_backend(), make_backend()
+        self.pool.release(first)
+        self.pool.release(second)
+        self.assertFalse(first.close.called)
+        second.close.assert_called_once_with()
+
+    def test_clear(self):
+        backend = make_backend()
+        self.pool.release(backend)
+        self.pool.clear()
+        backend.close.assert_called_once_with()
+
+
+class GetConnectionTestCase(TestCase):
+    """
+    """
+
+    @override_settings(EMAIL_CONNECTION_POOL_SIZE=0)
+    def test_pool_disabled(self):
+        backend = make_backend()
+        with patch('notifier.connection_wrapper.dj_get_connection', return_value=backend):
+            conn = get_connection()
+            conn.close()
+        self.assertFalse(backend.open.called)
+        backend.close.assert_called_once_with()
+
+    @override_settings(EMAIL_CONNECTION_POOL_SIZE=1)
+    def test_pool_enabled(self):
+        backend = make_backend()
+        with patch('notifier.connection_wrapper._pool', ConnectionPool()), \
+                patch('notifier.connection_wrapper.dj_get_connection', return_value=backend) as p:
+            get_connection().close()
+            get_connection().close()
+        self.assertEqual(p.call_count, 1)
+        self.assertFalse(backend.close.called)
+
+
+class FakeBackend(object):
+
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+        self.sent = []
+
+    def open(self):
+        return False
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        for msg in messages:
+            if msg.subject in self.fail_on:
+                raise Exception('failed to send %s' % msg.subject)
+            self.sent.append(msg.subject)
+        return len(messages)
+
+
+@override_settings(EMAIL_SEND_CONCURRENCY=3, EMAIL_SEND_RATE=0, EMAIL_CONNECTION_POOL_SIZE=3)
+class ConcurrentSendTestCase(TestCase):
+    """
+    """
+
+    def make_messages(self, n):
+        return [EmailMessage('msg%d' % i, 'body', 'from@example.com', ['to@example.com']) for i in range(n)]
+
+    def test_send_concurrently(self):
+        backends = [FakeBackend(), FakeBackend(), FakeBackend()]
+        msgs = self.make_messages(10)
+        with patch('notifier.connection_wrapper.dj_get_connection', side_effect=backends[1:]):
+            self.assertEqual(BackendWrapper(backends[0], pool=ConnectionPool()).send_messages(msgs), 10)
+        self.assertEqual(
+            sorted(subject for backend in backends for subject in backend.sent),
+            sorted(msg.subject for msg in msgs))
+        self.assertTrue(all(backend.sent for backend in backends))
+        self.assertTrue(all(msg.extra_headers['status'] == 200 for msg in msgs))
+
+    def test_failure(self):
+        backends = [FakeBackend(fail_on=['msg0']), FakeBackend(), FakeBackend()]
+        msgs = self.make_messages(9)
+        with patch('notifier.connection_wrapper.dj_get_connection', side_effect=backends[1:]):
+            self.assertRaises(Exception, BackendWrapper(backends[0], pool=ConnectionPool()).send_messages, msgs)
+        sent = set(subject for backend in backends for subject in backend.sent)
+        self.assertNotIn('msg0', sent)
+        for msg in msgs:
+            self.assertEqual(msg.extra_headers.get('status') == 200, msg.subject in sent)
+
+    @override_settings(EMAIL_SEND_CONCURRENCY=1)
+    def test_concurrency_disabled(self):
+        backend = FakeBackend()
+        with patch('notifier.connection_wrapper.dj_get_connection') as p:
+            self.assertEqual(BackendWrapper(backend, pool=ConnectionPool()).send_messages(self.make_messages(3)), 3)
+        self.assertFalse(p.called)
+
+    @override_settings(EMAIL_CONNECTION_POOL_SIZE=0)
+    def test_pool_disabled(self):
+        backend = FakeBackend()
+        with patch('notifier.connection_wrapper.dj_get_connection') as p:
+            self.assertEqual(BackendWrapper(backend).send_messages(self.make_messages(3)), 3)
+        self.assertFalse(p.called)
+        self.assertEqual(backend.sent, ['msg0', 'msg1', 'msg2'])
+
+    @override_settings(EMAIL_SEND_CONCURRENCY=1, EMAIL_SEND_RATE=10)
+    def test_rate_limited(self):
+        backend = FakeBackend()
+        with patch('notifier.connection_wrapper.dj_get_connection') as p, \
+                patch('notifier.connection_wrapper._rate_limiter.wait') as wait:
+            self.assertEqual(BackendWrapper(backend, pool=ConnectionPool()).send_messages(self.make_messages(3)), 3)
+        self.assertFalse(p.called)
+        self.assertEqual(wait.call_count, 3)
+        self.assertEqual(backend.sent, ['msg0', 'msg1', 'msg2'])
+
+
+class RateLimiterTestCase(TestCase):
+    """
+    """
+
+    @override_settings(EMAIL_SEND_RATE=10)
+    def test_wait(self):
+        limiter = RateLimiter()
+        with patch('notifier.connection_wrapper.time.sleep') as sleep:
+            limiter.wait()
+            limiter.wait()
+        self.assertEqual(sleep.call_count, 1)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.1, places=2)
+
+    @override_settings(EMAIL_SEND_RATE=0)
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        with patch('notifier.connection_wrapper.time.sleep') as sleep:
+            limiter.wait()
+            limiter.wait()
+        self.assertFalse(sleep.called)
+
+
+@override_settings(EMAIL_SEND_CONCURRENCY=1, EMAIL_REWRITE_RECIPIENT=None)
+class InstrumentationTestCase(TestCase):
+    """
+    """
+
+    def make_message(self, n):
+        msg = EmailMultiAlternatives('subject', 'text body', 'from@example.com', ['to%d@example.com' % n])
+        msg.attach_alternative('<p>html body</p>', 'text/html')
+        return msg
+
+    @override_settings(EMAIL_LOG_SAMPLE_RATE=1)
+    def test_sends_logged(self):
+        msgs = [self.make_message(n) for n in range(3)]
+        with patch.object(EmailMultiAlternatives, 'message', autospec=True,
+                          side_effect=EmailMultiAlternatives.message) as build, \
+                patch('notifier.connection_wrapper.logger') as logger:
+            self.assertEqual(BackendWrapper(locmem.EmailBackend()).send_messages(msgs), 3)
+        # each message is only built once, by the backend
+        self.assertEqual(build.call_count, 3)
+        sends = [c[0][1] for c in logger.info.call_args_list if c[0][0] == 'sent email: %r']
+        self.assertEqual([send['to'] for send in sends], [msg.to for msg in msgs])
+        self.assertTrue(all(send['message_id'] and send['size'] > 0 for send in sends))
+        self.assertFalse(any('message' in vars(msg) for msg in msgs))
+
+    @override_settings(EMAIL_LOG_SAMPLE_RATE=0)
+    def test_sampling(self):
+        with patch('notifier.connection_wrapper.logger') as logger:
+            BackendWrapper(locmem.EmailBackend()).send_messages([self.make_message(n) for n in range(3)])
+        self.assertFalse(any(c[0][0] == 'sent email: %r' for c in logger.info.call_args_list))
+        self.assertEqual(logger.info.call_args[0][1:3], (3, 3))
+
+
+class ThrottledBackend(FakeBackend):
+
+    """Sends the first message, then reports that the send rate has been
+    exceeded `throttle_count` times.
+    """
+
+    def __init__(self, throttle_count):
+        super(ThrottledBackend, self).__init__()
+        self.throttle_count = throttle_count
+
+    def send_messages(self, messages):
+        for msg in messages:
+            if self.sent and self.throttle_count:
+                self.throttle_count -= 1
+                msg.extra_headers['status'] = 400
+                raise SESMaxSendingRateExceededError(400, 'Throttling')
+            self.sent.append(msg.subject)
+            msg.extra_headers['status'] = 200
+        return len(messages)
+
+
+@override_settings(EMAIL_SEND_CONCURRENCY=1, EMAIL_SEND_RATE=0, EMAIL_THROTTLE_BACKOFF=1,
+                   EMAIL_THROTTLE_MAX_BACKOFF=4, EMAIL_THROTTLE_DEADLINE=600)
+class ThrottleBackoffTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        _rate_limiter.reset()
+        self.addCleanup(_rate_limiter.reset)
+
+    def make_messages(self, n):
+        return [EmailMessage('msg%d' % i, 'body', 'from@example.com', ['to@example.com']) for i in range(n)]
+
+    def test_backoff(self):
+        backend = ThrottledBackend(throttle_count=3)
+        msgs = self.make_messages(4)
+        with patch('notifier.connection_wrapper.time.sleep'), \
+                patch('notifier.connection_wrapper.logger') as logger:
+            self.assertEqual(BackendWrapper(backend).send_messages(msgs), 4)
+        self.assertEqual(backend.sent, ['msg0', 'msg1', 'msg2', 'msg3'])
+        # the backoff pauses double (with jitter) up to the maximum
+        pauses = [c[0][2] for c in logger.warn.call_args_list if c[0][0].startswith('sending throttled')]
+        self.assertEqual(len(pauses), 3)
+        for pause, delay in zip(pauses, (1, 2, 4)):
+            self.assertTrue(delay / 2.0 <= pause <= delay)
+        # and the remaining messages are paced
+        self.assertTrue(_rate_limiter.rate > 0)
+
+    def test_deadline(self):
+        backend = ThrottledBackend(throttle_count=10)
+        msgs = self.make_messages(3)
+        with patch('notifier.connection_wrapper.time.sleep'), \
+                override_settings(EMAIL_THROTTLE_DEADLINE=0):
+            self.assertRaises(SESMaxSendingRateExceededError, BackendWrapper(backend).send_messages, msgs)
+        self.assertEqual(backend.sent, ['msg0'])
+        self.assertEqual([msg.extra_headers.get('status') for msg in msgs], [200, 400, None])
+
+
+class RateLimiterSlowDownTestCase(TestCase):
+    """
+    """
+
+    @override_settings(EMAIL_SEND_RATE=10, EMAIL_THROTTLE_RATE_FACTOR=0.5, EMAIL_THROTTLE_COOLDOWN=300)
+    def test_slow_down(self):
+        limiter = RateLimiter()
+        self.assertEqual(limiter.slow_down(), 5)
+        self.assertEqual(limiter.slow_down(), 2.5)
+        self.assertEqual(limiter.rate, 2.5)
+        with patch('notifier.connection_wrapper.time.time', return_value=time.time() + 301):
+            self.assertEqual(limiter.rate, 10)
+
+    @override_settings(EMAIL_SEND_RATE=0, EMAIL_THROTTLE_RATE_FACTOR=0.5)
+    def test_slow_down_from_recent_rate(self):
+        limiter = RateLimiter()
+        limiter.record(20)
+        self.assertEqual(limiter.slow_down(), 20 / limiter.window * 0.5)
@@ -2,19 +2,102 @@
 
 from __future__ import absolute_import
 from __future__ import unicode_literals
+from datetime import datetime
+import io
+import json
+from os.path import dirname, join
+import random
 from uuid import uuid4
 
 from unittest import skip
+from django.template.loader import get_template
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.html import strip_tags
 from mock import patch
 
 from notifier import settings
-from notifier.digest import Digest, DigestCourse, DigestItem, DigestThread, render_digest
+from notifier.digest import (
+    Digest, DigestCourse, DigestItem, DigestThread, render_digest, _strip_tags, _trunc, _trunc_code_points
+)
 from notifier.user import DIGEST_NOTIFICATION_PREFERENCE_KEY, LANGUAGE_PREFERENCE_KEY
+from six.moves import range
 
 TEST_COURSE_ID = "test_org/test_num/test_course"
 TEST_COMMENTABLE = "test_commentable"
 
+# characters to draw random _trunc inputs from: ASCII, whitespace, Latin-1,
+# combining marks, CJK and non-BMP characters
+TRUNC_ALPHABET = "ab \t\n.\"'\\&<>%sïøçñ\u0301\u0308ｲんﾉ丂刀\U0001d54b\U0001d559\U0001f600"
+
+
+class TruncTestCase(TestCase):
+    """
+    Check that _trunc gives the same results as the code point based
+    implementation it replaces.
+    """
+    def _assert_same(self, s, length):
+        self.assertEqual(_trunc(s, length), _trunc_code_points(s, length), (s, length))
+
+    def test_examples(self):
+        for s in ("", " ", "one two three", "  padded words  ", "nospacesatallinthisone",
+                  "𝕋𝕙𝕚𝕤 𝕡𝕠𝕤𝕥 𝕔𝕠𝕟𝕥𝕒𝕚𝕟𝕤 𝕔𝕙𝕒𝕣𝕒𝕔𝕥𝕖𝕣𝕤 𝕠𝕦𝕥𝕤𝕚𝕕𝕖 𝕥𝕙𝕖 𝔹𝕄ℙ"):
+            for length in range(0, 20):
+                self._assert_same(s, length)
+
+    def test_random_inputs(self):
+        rand = random.Random(0)
+        for _ in range(5000):
+            s = "".join(rand.choice(TRUNC_ALPHABET) for _ in range(rand.randint(0, 200)))
+            self._assert_same(s, rand.randint(0, 160))
+
+
+# fragments to assemble random, well-formed _strip_tags inputs from
+STRIP_TAGS_FRAGMENTS = [
+    "<p>", "</p>", "<b>", "</b>", "<br/>", "<!-- c -->", '<a href="x">', "</a>", "<script>x</script>", "<style>p{}</style>",
+    "&amp;", "&#39;", "&#x41;", "&nbsp;", "&lt;", "&gt;", " ", "  ", "\n", "word", "é", "\U0001d54b", "\"", "'",
+    "<!DOCTYPE html>", "<?pi?>", "<!-- a > b -->", '<a href="x>y">', "<img alt='1 > 0'>",
+    "<!--[if gte mso 9]><xml><w:WordDocument></w:WordDocument></xml><![endif]-->",
+]
+
+
+class StripTagsTestCase(TestCase):
+    """
+    Check that _strip_tags is equivalent to strip_tags, once truncated.
+    """
+    def _assert_equivalent(self, value, length):
+        self.assertEqual(_trunc(_strip_tags(value, length), length), _trunc(strip_tags(value), length), (value, length))
+
+    def test_forum_bodies(self):
+        with io.open(join(dirname(__file__), "forum_bodies.json"), encoding="utf-8") as f:
+            bodies = json.load(f)
+        for body in bodies:
+            for length in (0, 3, 17, 40, 140, 1000):
+                self._assert_equivalent(body, length)
+
+    def test_random_inputs(self):
+        rand = random.Random(0)
+        for _ in range(5000):
+            value = "".join(rand.choice(STRIP_TAGS_FRAGMENTS) for _ in range(rand.randint(0, 100)))
+            self._assert_equivalent(value, rand.choice([0, 2, 3, 5, 8, 17, 30, 140]))
+
+    def test_bounded(self):
+        value = "<p>one two three</p>" + "<p>four</p>" * 100
+        with patch("notifier.digest.strip_tags", wraps=strip_tags) as mock_strip_tags:
+            self.assertEqual(_trunc(_strip_tags(value, 10), 10), _trunc(strip_tags(value), 10))
+        mock_strip_tags.assert_called_once_with(value[:value.rfind(">", 0, 100) + 1])
+
+    def test_cut_within_comment(self):
+        # as pasted from Word, with the '>'s of a conditional comment
+        value = "<!--[if gte mso 9]>" + "<xml><w:WordDocument></w:WordDocument></xml>" * 5 + "<![endif]-->"
+        value += "<p>Hello everyone, this is my post.</p>"
+        self.assertEqual(_strip_tags(value, 20), "Hello everyone, this is my post.")
+
+    def test_not_enough_text_in_bound(self):
+        value = "<p>" + "<b></b>" * 100 + "one two three</p>"
+        self.assertEqual(_strip_tags(value, 10), "one two three")
+
+
 @patch("notifier.digest.THREAD_ITEM_MAXLEN", 17)
 class DigestItemTestCase(TestCase):
     def _test_unicode_data(self, input_text, expected_text):
@@ -39,6 +122,17 @@ class DigestItemTestCase(TestCase):
         self._test_unicode_data("This post contains %s string interpolation #{syntax}", "This post...")
 
 
+class DigestThreadDtTestCase(TestCase):
+    def test_dt_is_most_recent_item(self):
+        dts = [datetime(2013, 1, 1, 0, minute) for minute in (5, 30, 10)]
+        thread = DigestThread("0", TEST_COURSE_ID, TEST_COMMENTABLE, "title", [DigestItem("body", None, dt) for dt in dts])
+        self.assertEqual(thread.dt, max(dts))
+        self.assertEqual([item.dt for item in thread.items], sorted(dts, reverse=True))
+
+    def test_dt_without_items(self):
+        self.assertIsNone(DigestThread("0", TEST_COURSE_ID, TEST_COMMENTABLE, "title", []).dt)
+
+
 @patch("notifier.digest.THREAD_TITLE_MAXLEN", 17)
 class DigestThreadTestCase(TestCase):
     def _test_unicode_data(self, input_text, expected_text):
@@ -139,6 +233,47 @@ class RenderDigestTestCase(TestCase):
         render_digest(self.user, self.digest, "dummy", "dummy")
         mock_activate.assert_not_called()
 
+    def test_shared_fragment_cache(self):
+        fragment_cache = {}
+        expected = render_digest(self.user, self.digest, "dummy", "dummy")
+        self.assertEqual(render_digest(self.user, self.digest, "dummy", "dummy", fragment_cache), expected)
+        # one fragment per format for the digest's single thread
+        self.assertEqual(len(fragment_cache), 2)
+        other_user = dict(self.user, id="1", name="other")
+        self.set_digest("test title")
+        with patch("notifier.digest.get_template", wraps=get_template) as mock_get_template:
+            render_digest(other_user, self.digest, "dummy", "dummy", fragment_cache)
+        rendered = [c[0][0] for c in mock_get_template.call_args_list]
+        self.assertNotIn("digest-thread.txt", rendered)
+        self.assertNotIn("digest-thread.html", rendered)
+        self.assertEqual(len(fragment_cache), 2)
+
+    def test_merge_cache(self):
+        merge_cache = {}
+        users = [
+            dict(self.user, id="1", name="first"),
+            dict(self.user, id="2", name="<second & co>", preferences={DIGEST_NOTIFICATION_PREFERENCE_KEY: uuid4()}),
+        ]
+        for user in users:
+            self.assertEqual(
+                render_digest(user, self.digest, "dummy", "dummy", merge_cache=merge_cache),
+                render_digest(user, self.digest, "dummy", "dummy")
+            )
+        self.assertEqual(len(merge_cache), 1)
+        # a digest with different content is rendered separately
+        self.set_digest("another title")
+        render_digest(users[0], self.digest, "dummy", "dummy", merge_cache=merge_cache)
+        self.assertEqual(len(merge_cache), 2)
+
+    @override_settings(LMS_URL_BASE='http://localhost:8000/?a=1&b="2"')
+    def test_merge_cache_unsubscribe_url(self):
+        merge_cache = {}
+        for user in [dict(self.user, id="1", name="first"), dict(self.user, id="2", name="second")]:
+            text, html = render_digest(user, self.digest, "dummy", "dummy", merge_cache=merge_cache)
+            self.assertEqual((text, html), render_digest(user, self.digest, "dummy", "dummy"))
+            self.assertIn('/?a=1&b="2"/notification_prefs/', text)
+            self.assertIn('href="http://localhost:8000/?a=1&amp;b=&quot;2&quot;/notification_prefs/', html)
+
     def test_unsubscribe_url(self):
         text, html = render_digest(self.user, self.digest, "dummy", "dummy")
         expected_url = "{lms_url_base}/notification_prefs/unsubscribe/{token}/".format(
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase
+
+from notifier.message import DigestMessageBuilder
+
+
+class DigestMessageBuilderTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        self.builder = DigestMessageBuilder('Discussion Digest ☃', 'Notifications <notifications@example.org>')
+
+    def assertSameMessage(self, text, html):
+        expected = EmailMultiAlternatives(
+            self.builder.subject, text, self.builder.from_email, ['user@example.org'],
+            alternatives=[(html, 'text/html')]
+        ).message()
+        actual = self.builder.build(['user@example.org'], text, html).message()
+
+        variable = ('content-type', 'date', 'message-id')
+        self.assertEqual(
+            [(k, v) for k, v in expected.items() if k.lower() not in variable],
+            [(k, v) for k, v in actual.items() if k.lower() not in variable]
+        )
+        self.assertEqual(actual.get_content_type(), 'multipart/alternative')
+        self.assertTrue(actual['Message-ID'])
+        self.assertTrue(actual['Date'])
+        for expected_part, actual_part in zip(expected.get_payload(), actual.get_payload()):
+            self.assertEqual(expected_part.items(), actual_part.items())
+            self.assertEqual(expected_part.get_payload(), actual_part.get_payload())
+
+    def test_same_as_django(self):
+        self.assertSameMessage('Hi ☃,\n\ntext body\n', '<p>Hi ☃,</p>\n<p>html body</p>\n')
+
+    def test_long_lines(self):
+        # the same number of characters, but only the second one is too long
+        # once encoded
+        self.assertSameMessage('x' * 900, '☃' * 900)
+
+    def test_messages_are_independent(self):
+        first = self.builder.build(['first@example.org'], 'first', '<p>first</p>').message()
+        second = self.builder.build(['second@example.org'], 'second', '<p>second</p>').message()
+        self.assertEqual(first['To'], 'first@example.org')
+        self.assertEqual(second['To'], 'second@example.org')
+        self.assertNotEqual(first['Message-ID'], second['Message-ID'])
+        self.assertEqual(second.get_payload()[0].get_payload(), 'second')
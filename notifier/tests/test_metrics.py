@@ -0,0 +1,114 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import os
+import shutil
+import socket
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from notifier import metrics
+
+
+class RecordingExporter(metrics.AggregatingExporter):
+
+    flushes = 0
+
+    def flush(self):
+        RecordingExporter.flushes += 1
+
+
+class MetricsTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        metrics._exporters.clear()
+        self.addCleanup(metrics._exporters.clear)
+
+    @override_settings(METRICS_EXPORTERS=[])
+    def test_disabled(self):
+        self.assertIs(metrics.timer('x'), metrics._null_timer)
+        with patch('notifier.metrics._record') as record:
+            with metrics.timer('x'):
+                pass
+            metrics.timing('x', 1)
+            metrics.size('x', 1)
+            metrics.incr('x')
+            metrics.flush()
+        self.assertFalse(record.called)
+        self.assertEqual(metrics._exporters, {})
+
+    @override_settings(METRICS_EXPORTERS=['notifier.tests.test_metrics.RecordingExporter'])
+    def test_exporter_by_path(self):
+        RecordingExporter.flushes = 0
+        with metrics.timer('x'):
+            pass
+        metrics.size('y', 2000)
+        metrics.incr('z', 3)
+        metrics.incr('z')
+        metrics.flush()
+        exporter, = metrics._get_exporters()
+        self.assertIs(metrics._get_exporters()[0], exporter)
+        self.assertEqual(exporter.histograms['x'].count, 1)
+        self.assertEqual(exporter.histograms['y'].counts, [0, 1, 0, 0, 0, 0])
+        self.assertEqual(exporter.counters, {'z': 4})
+        self.assertEqual(RecordingExporter.flushes, 1)
+
+    @override_settings(METRICS_EXPORTERS=['log'])
+    def test_log(self):
+        metrics.timing('digest.render', 0.5)
+        metrics.timing('digest.render', 1.5)
+        metrics.incr('digest.users', 5)
+        with patch('notifier.metrics.logger') as logger:
+            metrics.flush()
+            metrics.flush()
+        self.assertEqual(
+            [c[0] for c in logger.info.call_args_list],
+            [
+                ('metric %s: count=%d sum=%.3f mean=%.3f max=%.3f', 'digest.render', 2, 2.0, 1.0, 1.5),
+                ('metric %s: %d', 'digest.users', 5),
+            ])
+
+    def test_prometheus(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with override_settings(METRICS_EXPORTERS=['prometheus'], METRICS_PROMETHEUS_DIR=directory):
+            metrics.size('comments_service.payload', 2000)
+            metrics.incr('digest.users', 5)
+            metrics.flush()
+            metrics.incr('digest.users', 5)
+            metrics.flush()
+        with open(os.path.join(directory, 'notifier-{}.prom'.format(os.getpid()))) as f:
+            self.assertEqual(f.read(), (
+                '# TYPE notifier_comments_service_payload_bytes histogram\n'
+                'notifier_comments_service_payload_bytes_bucket{le="1000"} 0\n'
+                'notifier_comments_service_payload_bytes_bucket{le="10000"} 1\n'
+                'notifier_comments_service_payload_bytes_bucket{le="100000"} 1\n'
+                'notifier_comments_service_payload_bytes_bucket{le="1e+06"} 1\n'
+                'notifier_comments_service_payload_bytes_bucket{le="1e+07"} 1\n'
+                'notifier_comments_service_payload_bytes_bucket{le="+Inf"} 1\n'
+                'notifier_comments_service_payload_bytes_sum 2000\n'
+                'notifier_comments_service_payload_bytes_count 1\n'
+                '# TYPE notifier_digest_users_total counter\n'
+                'notifier_digest_users_total 10\n'
+            ))
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        with override_settings(METRICS_EXPORTERS=['statsd'], METRICS_STATSD_HOST='127.0.0.1',
+                               METRICS_STATSD_PORT=server.getsockname()[1]):
+            metrics.timing('digest.render', 0.25)
+            metrics.size('comments_service.payload', 2000)
+            metrics.incr('digest.users', 5)
+        self.assertEqual(
+            [server.recv(1024) for _ in range(3)],
+            [b'notifier.digest.render:250|ms', b'notifier.comments_service.payload:2000|h',
+             b'notifier.digest.users:5|c'])
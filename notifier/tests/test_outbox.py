@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from notifier import outbox
+from notifier.connection_wrapper import get_connection
+
+
+class OutboxTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        self.outbox_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.outbox_dir)
+        override = override_settings(EMAIL_OUTBOX_DIR=os.path.join(self.outbox_dir, 'outbox'))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def make_message(self, n):
+        msg = EmailMultiAlternatives(
+            'Daily Digest', 'text body ☃', 'from@example.com', ['to%d@example.com' % n], bcc=['bcc@example.com'])
+        msg.attach_alternative('<p>html body ☃</p>', 'text/html')
+        return msg
+
+    def test_round_trip(self):
+        msgs = [self.make_message(n) for n in range(3)]
+        outbox.spool(msgs)
+        claimed = outbox.claim(10)
+        self.assertEqual(len(claimed), 3)
+        self.assertEqual(
+            sorted(msg.recipients() for msg in claimed),
+            sorted(msg.recipients() for msg in msgs))
+        for msg in claimed:
+            self.assertEqual(msg.from_email, 'from@example.com')
+            mime = msg.message()
+            self.assertIsNone(mime[outbox.ENVELOPE_TO_HEADER])
+            self.assertEqual(mime['Subject'], 'Daily Digest')
+            text, html = mime.get_payload()
+            self.assertEqual(text.get_payload(decode=True).decode('utf-8'), 'text body ☃')
+            self.assertEqual(html.get_payload(decode=True).decode('utf-8'), '<p>html body ☃</p>')
+
+    def test_time_slice(self):
+        from_dt, to_dt = datetime.datetime(2013, 1, 1), datetime.datetime(2013, 1, 2)
+        outbox.spool([self.make_message(0)], from_dt, to_dt)
+        outbox.spool([self.make_message(1)])
+        msgs = sorted(outbox.claim(10), key=lambda msg: msg.recipients())
+        self.assertEqual([msg.time_slice for msg in msgs], [(from_dt, to_dt), None])
+        self.assertIsNone(msgs[0].message()[outbox.TIME_SLICE_HEADER])
+
+    @override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    def test_send(self):
+        outbox.spool([self.make_message(0)])
+        msgs = outbox.claim(10)
+        get_connection().send_messages(msgs)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].recipients(), ['to0@example.com', 'bcc@example.com'])
+
+    def test_claim(self):
+        outbox.spool([self.make_message(n) for n in range(3)])
+        first = outbox.claim(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(outbox.claim(2)), 1)
+        self.assertEqual(outbox.claim(2), [])
+        outbox.requeue(first[0])
+        outbox.delete(first[1])
+        self.assertEqual([msg.recipients() for msg in outbox.claim(2)], [first[0].recipients()])
+
+    def test_requeue_stale(self):
+        outbox.spool([self.make_message(n) for n in range(2)])
+        stale, fresh = outbox.claim(2)
+        os.utime(stale.path, (time.time() - 120, time.time() - 120))
+        outbox.requeue_stale(60)
+        self.assertEqual([msg.recipients() for msg in outbox.claim(2)], [stale.recipients()])
@@ -0,0 +1,112 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from notifier import pacing
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class PacerTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_pacer(self, window=3600, rate=6):
+        return pacing.Pacer(window, rate, clock=self.clock)
+
+    def test_rate(self):
+        pacer = self.make_pacer()
+        due = [self.clock.now + pacer.countdown() for _ in range(20)]
+        # one batch in each 10 second slot, all queued without waiting
+        for i, dt in enumerate(due):
+            self.assertGreaterEqual(dt, 1000 + 10 * i)
+            self.assertLessEqual(dt, 1000 + 10 * (i + 1))
+        self.assertEqual(self.clock.now, 1000)
+        self.assertEqual(pacer.last_due, max(due))
+
+    def test_slip(self):
+        pacer = self.make_pacer()
+        pacer.countdown()
+        # the user service took a minute to return the next page
+        self.clock.now += 60
+        self.assertLessEqual(pacer.countdown(), 10)
+        countdown = pacer.countdown()
+        self.assertGreaterEqual(self.clock.now + countdown, 1070)
+
+    def test_window(self):
+        pacer = self.make_pacer(window=60)
+        for _ in range(6):
+            self.assertGreater(pacer.countdown(), 0)
+        self.assertFalse(pacer.overran)
+        # the batches left once the window is used up are queued at once
+        self.assertEqual(pacer.countdown(), 0)
+        self.assertTrue(pacer.overran)
+
+    def test_off(self):
+        self.assertIsNone(pacing.pacer())
+
+    @override_settings(FORUM_DIGEST_TASK_PACING_WINDOW=600, FORUM_DIGEST_TASK_PACING_RATE=30)
+    def test_settings(self):
+        pacer = pacing.pacer()
+        self.assertEqual(pacer.window, 600)
+        self.assertEqual(pacer.interval, 2)
+
+    def test_report(self):
+        pacer = self.make_pacer()
+        pacer.last_due = 1012.5
+        backpressure = self.make_backpressure([])
+        backpressure.paused = 30.0
+        with patch('notifier.pacing.metrics') as m:
+            pacing.report(pacer, backpressure)
+            pacing.report(None, None)
+        self.assertEqual(m.timing.call_args_list, [
+            (('dispatch.paced_spread', 12.5),), (('dispatch.backpressure_paused', 30.0),)])
+
+    def make_backpressure(self, depths, max_pause=600):
+        return pacing.Backpressure(
+            lambda: depths.pop(0), 100, 50, 10, max_pause, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_backpressure(self):
+        depths = [99, 100, 80, 60, 50, 120, 40]
+        backpressure = self.make_backpressure(depths)
+        self.assertEqual(backpressure.wait(), 0)
+        self.assertEqual(backpressure.wait(), 30)
+        self.assertEqual(backpressure.wait(), 10)
+        self.assertEqual(depths, [])
+        self.assertEqual(backpressure.pauses, 2)
+        self.assertEqual(backpressure.paused, 40)
+
+    def test_backpressure_max_pause(self):
+        backpressure = self.make_backpressure([200] * 10, max_pause=30)
+        self.assertEqual(backpressure.wait(), 30)
+
+    def test_backpressure_off(self):
+        self.assertIsNone(pacing.backpressure(None))
+
+    @override_settings(FORUM_DIGEST_TASK_HIGH_WATER=100)
+    def test_backpressure_queue_depth(self):
+        with patch('notifier.pacing.celery') as c:
+            channel = c.current_app.connection_or_acquire.return_value.__enter__.return_value.default_channel
+            channel.queue_declare.return_value = ('notifier.default', 42, 1)
+            backpressure = pacing.backpressure(None)
+            self.assertEqual(backpressure.depth(), 42)
+        channel.queue_declare.assert_called_once_with(queue=settings.DEFAULT_PRIORITY_QUEUE, passive=True)
@@ -0,0 +1,57 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from notifier import profiling
+
+
+class ProfilingTestCase(TestCase):
+    """
+    """
+
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        override = override_settings(PROFILE_DIR=self.profile_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_profile(self):
+        with profiling.profile('tag'):
+            sorted(range(1000))
+        with gzip.open(os.path.join(self.profile_dir, 'tag.pstats.gz')) as f:
+            stats = f.read()
+        self.assertTrue(stats)
+        if profiling.tracemalloc is not None:
+            with gzip.open(os.path.join(self.profile_dir, 'tag.tracemalloc.gz')) as f:
+                snapshot = pickle.load(f)
+            self.assertIsInstance(snapshot, profiling.tracemalloc.Snapshot)
+            self.assertFalse(profiling.tracemalloc.is_tracing())
+
+    def test_profile_error(self):
+        def fail():
+            with profiling.profile('tag'):
+                raise ValueError
+        self.assertRaises(ValueError, fail)
+        self.assertTrue(os.path.exists(os.path.join(self.profile_dir, 'tag.pstats.gz')))
+
+    @override_settings(PROFILE_SAMPLE_RATE=0)
+    def test_not_sampled(self):
+        with profiling.sampled('tag'):
+            pass
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    @override_settings(PROFILE_SAMPLE_RATE=1)
+    def test_sampled(self):
+        with profiling.sampled('tag'):
+            pass
+        self.assertIn('tag.pstats.gz', os.listdir(self.profile_dir))
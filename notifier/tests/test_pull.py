@@ -10,7 +10,7 @@ import itertools
 from dateutil.parser import parse as date_parse
 from django.test import TestCase
 from django.test.utils import override_settings
-from mock import Mock, patch
+from mock import ANY, Mock, patch
 import requests
 
 from notifier.digest import (
@@ -248,6 +248,7 @@ class GenerateDigestContentTestCase(DigestTestCase):
             expected_api_url = '*test_cs_url*/api/v1/notifications'
             expected_headers = {
                 'X-Edx-Api-Key': '*test_cs_key*',
+                'traceparent': ANY,
             }
             expected_post_data = {
                 'user_ids': 'a,b,c',
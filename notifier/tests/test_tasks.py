@@ -6,18 +6,25 @@ import datetime
 import json
 from os.path import dirname, join
 import platform
+import shutil
+import tempfile
 
 from boto.ses.exceptions import SESMaxSendingRateExceededError
 from django.conf import settings
 from django.core import mail as djmail
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from django.test.utils import override_settings
-from mock import patch, Mock
-
-from notifier.models import ForumDigestTask
-from notifier.tasks import generate_and_send_digests, do_forums_digests
+from mock import ANY, patch, Mock
+
+from notifier.models import ForumDigestTask, ForumDigestTaskSummary, SubscriberBatch
+from notifier import outbox, pacing
+from notifier.settings import bucket_cron_schedule
+from notifier.tasks import (
+    generate_and_send_digests, generate_and_send_staged_digests, do_forums_digests, drain_outbox
+)
 from notifier.pull import process_cs_response, CommentsServiceException
-from notifier.user import UserServiceException, DIGEST_NOTIFICATION_PREFERENCE_KEY
+from notifier.user import UserServiceException, DIGEST_NOTIFICATION_PREFERENCE_KEY, compact_users, get_digest_bucket
 from .utils import make_user_info
 from six.moves import range
 
@@ -100,6 +107,147 @@ class TasksTestCase(TestCase):
             # message has expected to, from, subj, and content
             self._check_message(user, digest, djmail.outbox[0])
 
+    def test_generate_and_send_digests_compact_payload(self):
+        """
+        """
+        data = json.load(
+            open(join(dirname(__file__), 'cs_notifications.result.json')))
+
+        user_id, digest = next(self._process_cs_response_with_user_info(data))
+        user = usern(int(user_id))
+        from_dt = datetime.datetime(2013, 1, 1)
+        to_dt = datetime.datetime(2013, 1, 2)
+        with patch('notifier.tasks.generate_digest_content', return_value=[(user_id, digest)]) as p:
+            # as sent through a serializer without datetimes
+            task_result = generate_and_send_digests.delay(
+                compact_users([user]), from_dt.isoformat(), to_dt.isoformat())
+            self.assertTrue(task_result.successful())
+            p.assert_called_once_with({user_id: user}, from_dt, to_dt)
+            self.assertEqual(1, len(djmail.outbox))
+            self._check_message(user, digest, djmail.outbox[0])
+
+    def test_generate_and_send_staged_digests(self):
+        """
+        """
+        data = json.load(
+            open(join(dirname(__file__), 'cs_notifications.result.json')))
+
+        user_id, digest = next(self._process_cs_response_with_user_info(data))
+        user = usern(int(user_id))
+        from_dt = datetime.datetime(2013, 1, 1)
+        to_dt = datetime.datetime(2013, 1, 2)
+        task = ForumDigestTask.objects.create(from_dt=from_dt, to_dt=to_dt, node='some-node')
+        SubscriberBatch.stage(task, 1, [user]).save()
+        with patch('notifier.tasks.generate_digest_content', return_value=[(user_id, digest)]) as p:
+            task_result = generate_and_send_staged_digests.delay(task.pk, 1)
+            self.assertTrue(task_result.successful())
+            p.assert_called_once_with({user_id: user}, from_dt, to_dt)
+            self.assertEqual(1, len(djmail.outbox))
+            self._check_message(user, digest, djmail.outbox[0])
+            self.assertFalse(SubscriberBatch.objects.exists())
+
+            # a batch already sent is skipped
+            task_result = generate_and_send_staged_digests.delay(task.pk, 1)
+            self.assertTrue(task_result.successful())
+            self.assertEqual(p.call_count, 1)
+            self.assertEqual(1, len(djmail.outbox))
+
+    def test_generate_and_send_staged_digests_retry(self):
+        """
+        """
+        from_dt = datetime.datetime(2013, 1, 1)
+        to_dt = datetime.datetime(2013, 1, 2)
+        task = ForumDigestTask.objects.create(from_dt=from_dt, to_dt=to_dt, node='some-node')
+        SubscriberBatch.stage(task, 1, [usern(n) for n in range(2, 11)]).save()
+        with patch('notifier.tasks.generate_digest_content', side_effect=CommentsServiceException('timed out')) as p:
+            self.assertRaises(CommentsServiceException, generate_and_send_staged_digests.delay, task.pk, 1)
+            self.assertEqual(p.call_count, settings.FORUM_DIGEST_TASK_MAX_RETRIES + 1)
+        # kept for the batch to be resumed
+        self.assertTrue(SubscriberBatch.objects.filter(task=task, number=1).exists())
+
+    def test_generate_and_send_digests_identical_digests(self):
+        """
+        """
+        data = json.load(
+            open(join(dirname(__file__), 'cs_notifications.result.json')))
+
+        user_id, digest = next(self._process_cs_response_with_user_info(data))
+        users = [usern(1), usern(2)]
+        with patch('notifier.tasks.generate_digest_content', return_value=[('1', digest), ('2', digest)]):
+            task_result = generate_and_send_digests.delay(
+                users,
+                datetime.datetime.now(),
+                datetime.datetime.now())
+            self.assertTrue(task_result.successful())
+
+            # each user gets their own copy of the shared rendering
+            self.assertEqual(2, len(djmail.outbox))
+            for user, message in zip(users, djmail.outbox):
+                self._check_message(user, digest, message)
+                self.assertIn(user['preferences'][DIGEST_NOTIFICATION_PREFERENCE_KEY], message.body)
+
+    def test_generate_and_send_digests_outbox(self):
+        """
+        """
+        data = json.load(
+            open(join(dirname(__file__), 'cs_notifications.result.json')))
+
+        user_id, digest = next(self._process_cs_response_with_user_info(data))
+        user = usern(int(user_id))
+        dt1 = datetime.datetime(2013, 1, 1)
+        dt2 = datetime.datetime(2013, 1, 2)
+        task = ForumDigestTask.objects.create(from_dt=dt1, to_dt=dt2, node='some-node')
+        ForumDigestTaskSummary.objects.create(task=task)
+        outbox_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outbox_dir)
+        with patch('notifier.tasks.generate_digest_content', return_value=[(user_id, digest)]), \
+                override_settings(EMAIL_OUTBOX_DIR=outbox_dir):
+            task_result = generate_and_send_digests.delay([user], dt1, dt2)
+            self.assertTrue(task_result.successful())
+
+            # message was spooled, not sent
+            self.assertEqual(0, len(getattr(djmail, 'outbox', [])))
+            self.assertEqual(ForumDigestTaskSummary.objects.get().emails_sent, 0)
+
+            task_result = drain_outbox.delay()
+            self.assertTrue(task_result.successful())
+            self.assertEqual(1, len(djmail.outbox))
+            self.assertEqual(djmail.outbox[0].recipients(), [user['email']])
+            self.assertEqual(outbox.claim(10), [])
+
+        summary = ForumDigestTaskSummary.objects.get()
+        self.assertEqual(summary.emails_sent, 1)
+        self.assertIsNotNone(summary.last_send)
+
+    @override_settings(EMAIL_OUTBOX_MAX_RETRIES=0)
+    def test_drain_outbox_partial_failure(self):
+        """
+        """
+        outbox_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outbox_dir)
+        sent = []
+
+        def send_messages(messages):
+            # like the SMTP backend, which doesn't mark the messages it sends
+            for msg in messages:
+                if sent:
+                    raise Exception('connection lost')
+                sent.append(msg.recipients())
+            return len(messages)
+
+        mock_backend = Mock(name='mock_backend', send_messages=Mock(side_effect=send_messages))
+        with override_settings(EMAIL_OUTBOX_DIR=outbox_dir), \
+                patch('notifier.connection_wrapper.dj_get_connection', return_value=mock_backend):
+            outbox.spool([
+                djmail.EmailMessage('subject', 'body', 'from@dummy.edu', ['user%d@dummy.edu' % n]) for n in range(3)
+            ])
+            self.assertRaises(Exception, drain_outbox.delay)
+            # the message sent before the failure isn't sent again
+            self.assertEqual(len(sent), 1)
+            left = [msg.recipients() for msg in outbox.claim(10)]
+            self.assertEqual(len(left), 2)
+            self.assertNotIn(sent[0], left)
+
     @override_settings(EMAIL_REWRITE_RECIPIENT='rewritten-address@domain.org')
     def test_generate_and_send_digests_rewrite_recipient(self):
         """
@@ -124,6 +272,7 @@ class TasksTestCase(TestCase):
             for message in djmail.outbox:
                 self.assertEqual(message.to, ['rewritten-address@domain.org'])
 
+    @override_settings(EMAIL_THROTTLE_DEADLINE=0)
     def test_generate_and_send_digests_retry_ses(self):
         """
         """
@@ -185,7 +334,7 @@ class TasksTestCase(TestCase):
             task_result = do_forums_digests.delay()
             self.assertTrue(task_result.successful())
             self.assertEqual(t.delay.call_count, 2)
-            t.delay.assert_called_with([usern(10)], dt1, dt2, language=settings.LANGUAGE_CODE)
+            t.delay.assert_called_with([usern(10)], dt1, dt2, language=settings.LANGUAGE_CODE, trace_context=ANY)
 
 
     @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10)
@@ -224,6 +373,206 @@ class TasksTestCase(TestCase):
             self.assertEqual(model.to_dt, dt2)
             self.assertEqual(model.node, platform.node())
 
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10, FORUM_DIGEST_TASK_COMPACT_PAYLOAD=True)
+    def test_do_forums_digests_compact_payload(self):
+        dt1 = datetime.datetime.utcnow()
+        dt2 = dt1 + datetime.timedelta(days=1)
+        with patch('notifier.tasks.get_digest_subscribers', return_value=(usern(n) for n in range(11))), \
+                patch('notifier.tasks.generate_and_send_digests') as t, \
+                patch('notifier.tasks._time_slice', return_value=(dt1, dt2)):
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+            t.delay.assert_called_with(
+                compact_users([usern(10)]), dt1, dt2, language=settings.LANGUAGE_CODE, trace_context=ANY)
+
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10, FORUM_DIGEST_TASK_STAGE_USERS=True, US_RESULT_PAGE_SIZE=20)
+    def test_do_forums_digests_stage_users(self):
+        dt1 = datetime.datetime.utcnow()
+        dt2 = dt1 + datetime.timedelta(days=1)
+        with patch('notifier.tasks.get_digest_subscribers', return_value=(usern(n) for n in range(25))), \
+                patch('notifier.tasks.generate_and_send_staged_digests') as t, \
+                patch('notifier.tasks.generate_and_send_digests') as u, \
+                patch('notifier.tasks._time_slice', return_value=(dt1, dt2)):
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+            self.assertEqual(u.delay.call_count, 0)
+        task = ForumDigestTask.objects.get()
+        self.assertEqual(
+            t.delay.call_args_list,
+            [((task.pk, n), {'language': settings.LANGUAGE_CODE, 'trace_context': ANY}) for n in (1, 2, 3)])
+        batches = task.subscriber_batches.order_by('number')
+        self.assertEqual([b.number for b in batches], [1, 2, 3])
+        self.assertEqual(batches[0].get_users(), [usern(n) for n in range(10)])
+        self.assertEqual(batches[2].get_users(), [usern(n) for n in range(20, 25)])
+
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10, FORUM_DIGEST_TASK_PACING_WINDOW=3600,
+                       FORUM_DIGEST_TASK_PACING_RATE=6)
+    def test_do_forums_digests_paced(self):
+        dt1 = datetime.datetime.utcnow()
+        dt2 = dt1 + datetime.timedelta(days=1)
+        with patch('notifier.tasks.get_digest_subscribers', return_value=(usern(n) for n in range(25))), \
+                patch('notifier.tasks.generate_and_send_digests') as t, \
+                patch('notifier.tasks._time_slice', return_value=(dt1, dt2)):
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+        self.assertEqual(t.delay.call_count, 0)
+        self.assertEqual(t.apply_async.call_count, 3)
+        for i, (args, kwargs) in enumerate(t.apply_async.call_args_list):
+            self.assertEqual(args[0], ([usern(n) for n in range(10 * i, min(10 * (i + 1), 25))], dt1, dt2))
+            self.assertEqual(args[1], {'language': settings.LANGUAGE_CODE, 'trace_context': ANY})
+            # jittered within the batch's 10 second slot
+            self.assertGreaterEqual(kwargs['countdown'], 10 * i - 1)
+            self.assertLessEqual(kwargs['countdown'], 10 * (i + 1))
+
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10, FORUM_DIGEST_TASK_STAGE_USERS=True, US_RESULT_PAGE_SIZE=20,
+                       FORUM_DIGEST_TASK_HIGH_WATER=2, FORUM_DIGEST_TASK_LOW_WATER=0)
+    def test_do_forums_digests_backpressure(self):
+        dt1 = datetime.datetime.utcnow()
+        dt2 = dt1 + datetime.timedelta(days=1)
+
+        requested = []
+        sleeps = []
+
+        def get_digest_subscribers(before_page=None):
+            # 50 users, in pages of 20
+            for page in range(1, 4):
+                before_page(page)
+                requested.append(page)
+                for n in range(20 * (page - 1), min(20 * page, 50)):
+                    yield usern(n)
+
+        def sleep(seconds):
+            # the workers send the staged batches meanwhile
+            sleeps.append((seconds, list(requested)))
+            SubscriberBatch.objects.all().delete()
+
+        make_backpressure = pacing.backpressure
+
+        def backpressure(task):
+            run_backpressure = make_backpressure(task)
+            run_backpressure.sleep = sleep
+            return run_backpressure
+
+        with patch('notifier.tasks.get_digest_subscribers', side_effect=get_digest_subscribers), \
+                patch('notifier.tasks.generate_and_send_staged_digests') as t, \
+                patch('notifier.tasks._time_slice', return_value=(dt1, dt2)), \
+                patch('notifier.pacing.backpressure', side_effect=backpressure):
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+        self.assertEqual(t.delay.call_count, 5)
+        # paused before the second and third pages were requested
+        poll = settings.FORUM_DIGEST_TASK_BACKPRESSURE_POLL
+        self.assertEqual(sleeps, [(poll, [1]), (poll, [1, 2])])
+        self.assertEqual(ForumDigestTask.objects.get().subscriber_batches.count(), 1)
+
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=4)
+    def test_do_forums_digests_pages(self):
+        dt1 = datetime.datetime.utcnow()
+        dt2 = dt1 + datetime.timedelta(days=1)
+
+        def get_digest_subscribers(before_page=None):
+            # 30 users, in pages of 10
+            for page in range(1, 4):
+                before_page(page)
+                for n in range(10 * (page - 1), 10 * page):
+                    yield usern(n)
+
+        with patch('notifier.tasks.get_digest_subscribers', side_effect=get_digest_subscribers), \
+                patch('notifier.tasks._dispatch_batch') as d, \
+                patch('notifier.tasks._time_slice', return_value=(dt1, dt2)):
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+        # the page that the first user of each batch came from
+        self.assertEqual([call[0][:2] for call in d.call_args_list], [
+            (0, 1), (1, 1), (2, 1), (3, 2), (4, 2), (5, 3), (6, 3), (7, 3)])
+        self.assertEqual(d.call_args_list[3][0][2], [usern(n) for n in range(12, 16)])
+
+    def test_bucket_cron_schedule(self):
+        self.assertEqual(bucket_cron_schedule(1440, 4), {'hour': '*/6', 'minute': 0})
+        self.assertEqual(bucket_cron_schedule(1440, 96), {'minute': '*/15'})
+        self.assertEqual(bucket_cron_schedule(60, 4), {'minute': '*/15'})
+        # 90 and 45 minute buckets don't line up with the hours of a day
+        self.assertRaises(ImproperlyConfigured, bucket_cron_schedule, 1440, 16)
+        self.assertRaises(ImproperlyConfigured, bucket_cron_schedule, 1440, 32)
+        # nor do 5 hour ones
+        self.assertRaises(ImproperlyConfigured, bucket_cron_schedule, 600, 2)
+        # and the buckets must split the interval evenly
+        self.assertRaises(ImproperlyConfigured, bucket_cron_schedule, 60, 7)
+
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10, FORUM_DIGEST_TASK_BUCKETS=4)
+    def test_do_forums_digests_buckets(self):
+        dt1 = datetime.datetime(2013, 1, 1, 6)
+        dt2 = dt1 + datetime.timedelta(days=1)
+        users = [usern(n) for n in range(40)]
+        with patch('notifier.tasks.get_digest_subscribers', return_value=iter(users)), \
+                patch('notifier.tasks.generate_and_send_digests') as t, \
+                patch('notifier.tasks._bucket_slice', return_value=(dt1, dt2, 1)) as bs:
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+        bs.assert_called_once_with(settings.FORUM_DIGEST_TASK_INTERVAL, 4)
+        sent = [user for call in t.delay.call_args_list for user in call[0][0]]
+        self.assertEqual(sent, [user for user in users if get_digest_bucket(user, 4, 1440) == 1])
+        self.assertTrue(0 < len(sent) < len(users))
+        self.assertTrue(ForumDigestTask.objects.filter(from_dt=dt1, to_dt=dt2).exists())
+
+    @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10)
+    def test_do_forums_digests_summary(self):
+        dt1 = datetime.datetime.utcnow()
+        dt2 = dt1 + datetime.timedelta(days=1)
+        with patch('notifier.tasks.get_digest_subscribers', return_value=(usern(n) for n in range(11))), \
+                patch('notifier.tasks.generate_and_send_digests'), \
+                patch('notifier.tasks._time_slice', return_value=(dt1, dt2)):
+            task_result = do_forums_digests.delay()
+            self.assertTrue(task_result.successful())
+            summary = ForumDigestTask.objects.get().summary
+            self.assertEqual(summary.batches_dispatched, 2)
+            self.assertEqual(summary.batches_completed, 0)
+
+    def test_generate_and_send_digests_summary(self):
+        """
+        """
+        data = json.load(
+            open(join(dirname(__file__), 'cs_notifications.result.json')))
+        dt1 = datetime.datetime(2013, 1, 1)
+        dt2 = datetime.datetime(2013, 1, 2)
+        task = ForumDigestTask.objects.create(from_dt=dt1, to_dt=dt2, node='some-node')
+        ForumDigestTaskSummary.objects.create(task=task)
+
+        with patch(
+            'notifier.tasks.generate_digest_content',
+            return_value=list(self._process_cs_response_with_user_info(data))
+        ):
+            for _ in range(2):
+                task_result = generate_and_send_digests.delay([usern(n) for n in range(2, 11)], dt1, dt2)
+                self.assertTrue(task_result.successful())
+
+        summary = ForumDigestTaskSummary.objects.get()
+        self.assertEqual(summary.batches_completed, 2)
+        self.assertEqual(summary.users, 18)
+        self.assertEqual(summary.digests, 18)
+        self.assertEqual(summary.emails_sent, 18)
+        self.assertEqual(summary.retries, 0)
+        self.assertIsNotNone(summary.first_send)
+        self.assertLessEqual(summary.first_send, summary.last_send)
+
+    def test_generate_and_send_digests_summary_retry(self):
+        """
+        """
+        dt1 = datetime.datetime(2013, 1, 1)
+        dt2 = datetime.datetime(2013, 1, 2)
+        task = ForumDigestTask.objects.create(from_dt=dt1, to_dt=dt2, node='some-node')
+        ForumDigestTaskSummary.objects.create(task=task)
+
+        with patch('notifier.tasks.generate_digest_content', side_effect=CommentsServiceException('timed out')):
+            self.assertRaises(
+                CommentsServiceException,
+                generate_and_send_digests.delay,
+                [usern(n) for n in range(2, 11)], dt1, dt2)
+
+        summary = ForumDigestTaskSummary.objects.get()
+        self.assertEqual(summary.retries, settings.FORUM_DIGEST_TASK_MAX_RETRIES)
+        self.assertEqual(summary.batches_completed, 0)
+
 
     @override_settings(FORUM_DIGEST_TASK_BATCH_SIZE=10)
     def test_do_forums_digests_already_scheduled(self):
@@ -0,0 +1,68 @@
+"""
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from notifier import tracing
+
+
+class TracingTestCase(TestCase):
+    """
+    """
+
+    def test_nesting(self):
+        self.assertIsNone(tracing.current_context())
+        with tracing.span('root') as root:
+            self.assertEqual(tracing.current_context(), root.context)
+            with tracing.span('child') as child:
+                self.assertEqual(child.trace_id, root.trace_id)
+                self.assertEqual(child.parent_id, root.span_id)
+            self.assertIs(tracing.current_span(), root)
+        self.assertIsNone(root.parent_id)
+        self.assertIsNone(tracing.current_span())
+
+    def test_remote_context(self):
+        context = {'trace_id': 'a' * 32, 'span_id': 'b' * 16}
+        with tracing.span('local'):
+            with tracing.span('remote child', context) as child:
+                self.assertEqual(child.trace_id, 'a' * 32)
+                self.assertEqual(child.parent_id, 'b' * 16)
+                self.assertEqual(tracing.traceparent(), '00-{}-{}-01'.format('a' * 32, child.span_id))
+
+    def test_log_filter(self):
+        record = logging.LogRecord('name', logging.INFO, 'path', 1, 'message', (), None)
+        tracing.TraceLogFilter().filter(record)
+        self.assertEqual((record.trace_id, record.span_id), ('-', '-'))
+        with tracing.span('root') as root:
+            tracing.TraceLogFilter().filter(record)
+        self.assertEqual((record.trace_id, record.span_id), (root.trace_id, root.span_id))
+
+    def test_export(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'spans.jsonl')
+        with override_settings(TRACE_SPANS_FILE=path):
+            with tracing.span('root', batch=1) as root:
+                with tracing.span('child') as child:
+                    pass
+        with open(path) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual([s['name'] for s in spans], ['child', 'root'])
+        self.assertEqual(spans[0]['span_id'], child.span_id)
+        self.assertEqual(spans[0]['parent_id'], root.span_id)
+        self.assertEqual(spans[1]['span_id'], root.span_id)
+        self.assertEqual(spans[1]['tags'], {'batch': 1})
+        self.assertGreaterEqual(spans[1]['duration'], spans[0]['duration'])
+
+    @override_settings(TRACE_SPANS_FILE=None)
+    def test_no_export(self):
+        with tracing.span('root'):
+            pass
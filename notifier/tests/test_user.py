@@ -2,11 +2,15 @@
 """
 from __future__ import absolute_import
 from __future__ import unicode_literals
+from datetime import datetime
+
 from django.test import TestCase
 from django.test.utils import override_settings
 from mock import patch
 
-from notifier.user import get_digest_subscribers, DIGEST_NOTIFICATION_PREFERENCE_KEY
+from notifier.user import (
+    get_digest_bucket, get_digest_subscribers, DIGEST_NOTIFICATION_PREFERENCE_KEY, TIME_ZONE_PREFERENCE_KEY
+)
 
 from .utils import make_mock_json_response
 
@@ -138,6 +142,26 @@ class UserTestCase(TestCase):
             self.assertRaises(StopIteration, next, g)
 
 
+    @override_settings(US_URL_BASE="test_server_url", US_RESULT_PAGE_SIZE=3)
+    def test_get_digest_subscribers_before_page(self):
+        """
+        """
+        pages = [
+            {"count": 4, "next": "not none", "previous": None, "results": [mkresult(1), mkresult(2), mkresult(3)]},
+            {"count": 4, "next": None, "previous": "not none", "results": [mkresult(4)]},
+        ]
+        calls = []
+
+        def get(url, params, headers):
+            calls.append(('get', params['page']))
+            return make_mock_json_response(json=pages[params['page'] - 1])
+
+        with patch('requests.get', side_effect=get):
+            res = list(get_digest_subscribers(before_page=lambda page: calls.append(('before_page', page))))
+        self.assertEqual(len(res), 4)
+        self.assertEqual(calls, [('before_page', 1), ('get', 1), ('before_page', 2), ('get', 2)])
+
+
     @override_settings(US_URL_BASE="test_server_url", US_RESULT_PAGE_SIZE=3, US_HTTP_AUTH_USER='someuser', US_HTTP_AUTH_PASS='somepass')
     def test_get_digest_subscribers_basic_auth(self):
         """
@@ -162,5 +186,44 @@ class UserTestCase(TestCase):
                 mkexpected(mkresult(2)), 
                 mkexpected(mkresult(3))], res)
 
-
-
+    def test_get_digest_bucket_hash(self):
+        buckets = [get_digest_bucket(mkresult(n), 4, 1440) for n in range(400)]
+        for bucket in range(4):
+            self.assertGreater(buckets.count(bucket), 50)
+
+    def test_get_digest_bucket_time_zone(self):
+        user = mkresult(1)
+        user['preferences'][TIME_ZONE_PREFERENCE_KEY] = 'Asia/Kolkata'
+        # midnight at 18:30 UTC, so the 19:00 bucket
+        self.assertEqual(get_digest_bucket(user, 24, 1440, by='time_zone'), 19)
+        self.assertEqual(get_digest_bucket(user, 4, 1440, by='time_zone'), 0)
+        user['preferences'][TIME_ZONE_PREFERENCE_KEY] = 'UTC'
+        self.assertEqual(get_digest_bucket(user, 24, 1440, by='time_zone'), 0)
+
+    def test_get_digest_bucket_dst(self):
+        user = mkresult(1)
+        user['preferences'][TIME_ZONE_PREFERENCE_KEY] = 'Europe/London'
+        # the same bucket either side of the start and end of British Summer Time
+        for now in (datetime(2013, 3, 30, 12), datetime(2013, 3, 31, 12),
+                    datetime(2013, 10, 26, 12), datetime(2013, 10, 27, 12)):
+            self.assertEqual(get_digest_bucket(user, 24, 1440, by='time_zone', now=now), 0)
+        # and in the southern hemisphere, where DST is on in January
+        user['preferences'][TIME_ZONE_PREFERENCE_KEY] = 'Australia/Sydney'
+        buckets = set(
+            get_digest_bucket(user, 24, 1440, by='time_zone', now=datetime(2013, month, 1)) for month in range(1, 13))
+        self.assertEqual(buckets, {14})
+
+    def test_get_digest_bucket_dst_transition(self):
+        user = mkresult(1)
+        user['preferences'][TIME_ZONE_PREFERENCE_KEY] = 'America/New_York'
+        # around the spring-forward and fall-back hours, including UTC times
+        # that read as skipped (02:30) or repeated (01:30) New York times, and
+        # the UTC times at which New York is in those hours
+        for now in (datetime(2013, 3, 10, 2, 30), datetime(2013, 3, 10, 7, 30),
+                    datetime(2013, 11, 3, 1, 30), datetime(2013, 11, 3, 5, 30), datetime(2013, 11, 3, 6, 30)):
+            self.assertEqual(get_digest_bucket(user, 24, 1440, by='time_zone', now=now), 5)
+
+    def test_get_digest_bucket_unknown_time_zone(self):
+        user = mkresult(1)
+        user['preferences'][TIME_ZONE_PREFERENCE_KEY] = 'Nowhere/Special'
+        self.assertEqual(get_digest_bucket(user, 24, 1440, by='time_zone'), get_digest_bucket(user, 24, 1440))
@@ -0,0 +1,144 @@
+"""
+Lightweight tracing of forum digest runs.
+
+do_forums_digests starts a trace, and every batch task it dispatches carries
+the trace context along, so that the spans of a run (user service pages,
+dispatches, batches, comments service requests, sends) share a trace id.
+The current trace and span ids are added to log records (see
+TraceLogFilter) and, as a W3C ``traceparent`` header, to comments service
+requests. Finished spans are appended as JSON lines to TRACE_SPANS_FILE, if
+it is set.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import binascii
+from contextlib import contextmanager
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+import six
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_export_lock = threading.Lock()
+
+
+def _new_id(nbytes):
+    return binascii.hexlify(os.urandom(nbytes)).decode('ascii')
+
+
+class Span(object):
+
+    """A timed operation in a trace. Its parent is either the span that was
+    current when it started, or a span of another process, given by its
+    trace context.
+    """
+
+    def __init__(self, name, trace_id=None, parent_id=None, tags=None):
+        self.name = name
+        self.trace_id = trace_id or _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.tags = tags or {}
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def context(self):
+        """
+        The trace context to hand to other processes: a dict of the trace and
+        span ids, small enough to send along with a task.
+        """
+        return {'trace_id': self.trace_id, 'span_id': self.span_id}
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.end - self.start if self.end is not None else None,
+            'pid': os.getpid(),
+            'tags': self.tags,
+        }
+
+
+def current_span():
+    """
+    Returns the span current in this thread, or None.
+    """
+    return getattr(_local, 'span', None)
+
+
+def current_context():
+    """
+    Returns the trace context of the current span, or None.
+    """
+    current = current_span()
+    return current.context if current is not None else None
+
+
+@contextmanager
+def span(name, context=None, **tags):
+    """
+    Runs the block as a new span, the child of the span of trace `context`
+    if given, or else of the current span, if any (otherwise it starts a new
+    trace). Tags are recorded with the span.
+    """
+    parent = current_span()
+    if context:
+        new = Span(name, context['trace_id'], context['span_id'], tags)
+    elif parent is not None:
+        new = Span(name, parent.trace_id, parent.span_id, tags)
+    else:
+        new = Span(name, tags=tags)
+    _local.span = new
+    try:
+        yield new
+    finally:
+        new.end = time.time()
+        _local.span = parent
+        if settings.TRACE_SPANS_FILE:
+            _export(new)
+
+
+def _export(finished):
+    line = json.dumps(finished.to_dict(), sort_keys=True) + '\n'
+    try:
+        with _export_lock:
+            with io.open(settings.TRACE_SPANS_FILE, 'a', encoding='utf-8') as f:
+                f.write(six.text_type(line))
+    except (IOError, OSError):
+        logger.debug('failed to export span %s', finished.span_id, exc_info=True)
+
+
+def traceparent():
+    """
+    Returns the W3C Trace Context ``traceparent`` header value for the
+    current span, or None if there is none.
+    """
+    current = current_span()
+    if current is None:
+        return None
+    return '00-{}-{}-01'.format(current.trace_id, current.span_id)
+
+
+class TraceLogFilter(logging.Filter):
+
+    """Adds the `trace_id` and `span_id` of the current span (or '-') to log
+    records, for formatters to include.
+    """
+
+    def filter(self, record):
+        current = current_span()
+        record.trace_id = current.trace_id if current is not None else '-'
+        record.span_id = current.span_id if current is not None else '-'
+        return True
@@ -3,19 +3,25 @@ Functions in support of generating formatted digest emails of forums activity.
 """
 from __future__ import absolute_import
 from __future__ import unicode_literals
+from datetime import datetime
+import hashlib
 import logging
 import sys
 
 from django.conf import settings
+import pytz
 import requests
 import six
+from six.moves import range
 
+from notifier import metrics, tracing
 
 logger = logging.getLogger(__name__)
 
 
 DIGEST_NOTIFICATION_PREFERENCE_KEY = 'notification_pref'
 LANGUAGE_PREFERENCE_KEY = 'pref-lang'
+TIME_ZONE_PREFERENCE_KEY = 'time_zone'
 
 
 class UserServiceException(Exception):
@@ -44,12 +50,15 @@ def _http_get(*a, **kw):
         ))
     return response
 
-def get_digest_subscribers():
+def get_digest_subscribers(before_page=None):
     """
     Generator function that calls the edX user API and yields a dict for each
     user opted in for digest notifications.
 
     The returned dicts will have keys "id", "name", and "email" (all strings).
+
+    If given, `before_page` is called with the number of each page right
+    before the page is requested.
     """
     api_url = settings.US_URL_BASE + '/notifier_api/v1/users/'
     params = {
@@ -59,7 +68,11 @@ def get_digest_subscribers():
 
     logger.info('calling user api for digest subscribers')
     while True:
-        data = _http_get(api_url, params=params, headers=_headers(), **_auth()).json()
+        if before_page is not None:
+            before_page(params['page'])
+        with metrics.timer('user_service.page'), tracing.span('user_service.page', page=params['page']):
+            data = _http_get(api_url, params=params, headers=_headers(), **_auth()).json()
+        metrics.incr('user_service.users', len(data['results']))
         for result in data['results']:
             yield result
         if data['next'] is None:
@@ -67,6 +80,104 @@ def get_digest_subscribers():
         params['page'] += 1
 
 
+def compact_users(users):
+    """
+    Returns a compact form of a list of user dicts, as returned by the user
+    service, for sending to generate_and_send_digests through the broker.
+
+    Only the fields that the digest code uses are kept, course ids are listed
+    once for the whole list, and each user is a list rather than a dict:
+    [id, name, email, unsubscribe token, language, course info], where course
+    info is a flat list of (course index, see all cohorts, cohort id) triples.
+
+    >>> users = [{
+    ...     'id': 1, 'name': 'Ann', 'email': 'ann@example.org', 'username': 'ann',
+    ...     'preferences': {DIGEST_NOTIFICATION_PREFERENCE_KEY: 'tok', 'other': 'x'},
+    ...     'course_info': {'org/a/run': {'see_all_cohorts': False, 'cohort_id': 2}},
+    ... }]
+    >>> compact = compact_users(users)
+    >>> compact == {'courses': ['org/a/run'], 'users': [[1, 'Ann', 'ann@example.org', 'tok', None, [0, 0, 2]]]}
+    True
+    >>> expand_users(compact) == [{
+    ...     'id': 1, 'name': 'Ann', 'email': 'ann@example.org',
+    ...     'preferences': {DIGEST_NOTIFICATION_PREFERENCE_KEY: 'tok'},
+    ...     'course_info': {'org/a/run': {'see_all_cohorts': False, 'cohort_id': 2}},
+    ... }]
+    True
+    """
+    course_index = {}
+    compact = []
+    for user in users:
+        course_info = []
+        for course_id, info in six.iteritems(user['course_info']):
+            if course_id not in course_index:
+                course_index[course_id] = len(course_index)
+            course_info.extend([course_index[course_id], int(info['see_all_cohorts']), info['cohort_id']])
+        preferences = user['preferences']
+        compact.append([
+            user['id'], user['name'], user['email'], preferences[DIGEST_NOTIFICATION_PREFERENCE_KEY],
+            preferences.get(LANGUAGE_PREFERENCE_KEY), course_info
+        ])
+    return {'courses': sorted(course_index, key=course_index.get), 'users': compact}
+
+
+def expand_users(compact):
+    """
+    Returns the list of user dicts of a compact form made by compact_users.
+    """
+    courses = compact['courses']
+    users = []
+    for user_id, name, email, token, language, course_info in compact['users']:
+        preferences = {DIGEST_NOTIFICATION_PREFERENCE_KEY: token}
+        if language is not None:
+            preferences[LANGUAGE_PREFERENCE_KEY] = language
+        users.append({
+            'id': user_id,
+            'name': name,
+            'email': email,
+            'preferences': preferences,
+            'course_info': dict(
+                (courses[course_info[i]], {'see_all_cohorts': bool(course_info[i + 1]), 'cohort_id': course_info[i + 2]})
+                for i in range(0, len(course_info), 3)
+            ),
+        })
+    return users
+
+
+def get_digest_bucket(user, num_buckets, interval, by='hash', now=None):
+    """
+    Returns which of `num_buckets` delivery buckets, spread evenly over each
+    time slice of `interval` minutes, a user's digests are sent in.
+
+    With `by` 'hash', users are spread over the buckets by a hash of their
+    id, which doesn't change between processes or runs. With 'time_zone', a
+    user is put in the first bucket at or after midnight in their time zone
+    preference, so that a daily digest arrives at the start of their day;
+    users without a known time zone are hashed. Midnight is taken in the zone's
+    standard time (as of `now`, defaulting to utcnow), so that users don't
+    change buckets, and get a digest window that overlaps or leaves a gap with
+    the last one, when daylight saving time starts or ends.
+
+    >>> user = {'id': 7, 'preferences': {TIME_ZONE_PREFERENCE_KEY: 'America/New_York'}}
+    >>> get_digest_bucket(user, 24, 1440, by='time_zone', now=datetime(2013, 1, 1))
+    5
+    >>> get_digest_bucket(user, 24, 1440, by='time_zone', now=datetime(2013, 7, 1))
+    5
+    >>> get_digest_bucket(user, 24, 1440) == get_digest_bucket({'id': '7'}, 24, 1440)
+    True
+    """
+    time_zone = user.get('preferences', {}).get(TIME_ZONE_PREFERENCE_KEY)
+    if by == 'time_zone' and time_zone in pytz.all_timezones_set:
+        local = pytz.utc.localize(now or datetime.utcnow()).astimezone(pytz.timezone(time_zone))
+        offset = local.utcoffset() - local.dst()
+        # minutes into the slice of the user's midnight, in UTC
+        midnight = -(offset.days * 1440 + offset.seconds // 60) % interval
+        step = interval // num_buckets
+        return (midnight + step - 1) // step % num_buckets
+    digest = hashlib.md5(six.text_type(user['id']).encode('utf-8')).hexdigest()
+    return int(digest, 16) % num_buckets
+
+
 def get_user(user_id):
     api_url = '{}/notifier_api/v1/users/{}/'.format(settings.US_URL_BASE, user_id)
     logger.info('calling user api for user %s', user_id)